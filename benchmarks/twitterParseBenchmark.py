@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Compare the single-pass lxml extraction in TwitterFeed.parse with the previous PyQuery
+# per-tweet extraction over saved search pages. Each fixture is either the JSON response
+# to a search timeline request, or the raw items_html it contains. The bundled fixture is a
+# synthetic page that reproduces the markup of the Twitter search timeline.
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import json
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'twitterScrape'))
+from TwitterFeed import TwitterFeed
+
+def pyqueryparse(html):
+    from pyquery import PyQuery
+    import lxml
+
+    def text(tweet):
+        text = []
+
+        def add_text(tag, no_tail=False):
+            if tag.tag in TwitterFeed.FORCE_SPACE_TAGS:
+                text.append(u' ')
+            if tag.text and not isinstance(tag, lxml.etree._Comment):
+                text.append(tag.text)
+            if tag.tag == 'img':
+                text.append(tag.get("alt") or '')
+            for child in tag.getchildren():
+                add_text(child)
+            if not no_tail and tag.tail:
+                text.append(tag.tail)
+
+        for tag in tweet:
+            add_text(tag, no_tail=True)
+
+        return u''.join(text)
+
+    tweets = []
+    for tweet in PyQuery(html).items('div.js-stream-tweet'):
+        tweetPQ = PyQuery(tweet)
+        if tweetPQ("span.js-retweet-text").text() != '':
+            continue
+
+        ret = {}
+        ret['id']    = int(tweetPQ.attr("data-tweet-id"))
+        conversation = int(tweetPQ.attr("data-conversation-id"))
+        if conversation != ret['id']:
+            ret['conversation'] = conversation
+
+        ret['date']      = datetime.utcfromtimestamp(
+                                int(tweetPQ("small.time span.js-short-timestamp").attr("data-time")))
+        ret['user']      = tweetPQ.attr("data-screen-name")
+        ret['user-id']   = tweetPQ.attr("data-user-id")
+        ret['lang']      = tweetPQ("p.js-tweet-text").attr("lang")
+        ret['text']      = text(tweetPQ("p.js-tweet-text"))
+        ret['replies']   = int(tweetPQ("span.ProfileTweet-action--reply span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
+        ret['retweets']  = int(tweetPQ("span.ProfileTweet-action--retweet span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
+        ret['favorites'] = int(tweetPQ("span.ProfileTweet-action--favorite span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
+        quotetweet = tweetPQ("div.QuoteTweet-innerContainer")
+        if quotetweet:
+            ret['quote']         = int(quotetweet.attr("data-item-id"))
+            ret['quote-user-id'] = int(quotetweet.attr("data-user-id"))
+            ret['quote-user']    = quotetweet.attr("data-screen-name")
+
+        geoSpan = tweetPQ('span.Tweet-geo')
+        ret['geo'] = geoSpan.attr('title') if geoSpan else ''
+
+        ret['mentions']  = " ".join(TwitterFeed.MENTIONREGEXP.findall(ret['text']))
+        ret['hashtags']  = " ".join(TwitterFeed.HASHTAGREGEXP.findall(ret['text']))
+
+        tweets.append(ret)
+
+    return tweets
+
+def twitterParseBenchmark(arglist):
+    parser = argparse.ArgumentParser(description='Benchmark twitter search page parsing.',
+                                     fromfile_prefix_chars='@')
+
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    parser.add_argument('-r', '--repeat',    type=int, default=20, help='Number of times to parse each fixture')
+    parser.add_argument('--no-pyquery',      action='store_true', help='Do not time the previous PyQuery extraction')
+
+    parser.add_argument('fixture', type=str, nargs='*', help='Saved search page(s), default is the bundled fixtures.')
+
+    args = parser.parse_args(arglist)
+
+    if not args.fixture:
+        fixturedir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+        args.fixture = [os.path.join(fixturedir, filename) for filename in sorted(os.listdir(fixturedir))]
+
+    pages = []
+    for fixture in args.fixture:
+        data = open(fixture, 'rb').read().decode('utf-8')
+        try:
+            data = json.loads(data)['items_html']
+        except ValueError:
+            pass
+
+        pages.append(data)
+
+    tweetcount = sum(len(TwitterFeed.parse(page)) for page in pages)
+    print("Parsing " + str(len(pages)) + " pages containing " + str(tweetcount) + " tweets, " + str(args.repeat) + " times.", file=sys.stderr)
+
+    lxmltime = min(timeit.repeat(lambda: [TwitterFeed.parse(page) for page in pages], number=args.repeat, repeat=3))
+    print("lxml:    " + '{:.2f}'.format(1000.0 * lxmltime / args.repeat / len(pages)) + " ms per page", file=sys.stderr)
+
+    if not args.no_pyquery:
+        for fixture, page in zip(args.fixture, pages):
+            if TwitterFeed.parse(page) != pyqueryparse(page):
+                print("WARNING: Extracted tweets differ for fixture: " + fixture, file=sys.stderr)
+
+        pyquerytime = min(timeit.repeat(lambda: [pyqueryparse(page) for page in pages], number=args.repeat, repeat=3))
+        print("PyQuery: " + '{:.2f}'.format(1000.0 * pyquerytime / args.repeat / len(pages)) + " ms per page", file=sys.stderr)
+        print("Speedup: " + '{:.1f}'.format(pyquerytime / lxmltime) + "x", file=sys.stderr)
+
+if __name__ == '__main__':
+    twitterParseBenchmark(None)
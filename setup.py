@@ -3,7 +3,7 @@ from setuptools import setup
 setup(
     name = "twitterScrape",
     packages = ["twitterScrape"],
-    install_requires = ["argparse", "python-twitter", "unicodecsv", "wordcloud", "requests_oauthlib", "pyquery", "lxml", "pymp-pypi", "pytimeparse", "csvProcess==0.1"],
+    install_requires = ["argparse", "python-twitter", "unicodecsv", "wordcloud", "requests_oauthlib", "lxml", "pytimeparse", "csvProcess==0.1"],
     dependency_links=["git+https://github.com/BarraQDA/csvProcess.git#egg=csvProcess-0.1"],
     python_requires = "<3",
     entry_points = {
@@ -0,0 +1,71 @@
+from __future__ import print_function
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'twitterScrape'))
+from TwitterFeed import TwitterRead, TwitterWrite, TwitterIndex
+
+class TestTwitterIndex(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'tweets.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Write tweets in descending id order; a tweet with no date is like one that could not be hydrated.
+    def write(self, ids, undated=()):
+        twitterwrite = TwitterWrite(self.filename, fieldnames=['id', 'date', 'text'])
+        for id in ids:
+            twitterwrite.write({'id':   id,
+                                'date': '' if id in undated else datetime(2017, 1, 1, 0, 0, id).isoformat(' '),
+                                'text': 'tweet ' + str(id)})
+        twitterwrite.close()
+
+    def test_undated_last_row(self):
+        self.write(range(50, 0, -1), undated=[1])
+        index = TwitterIndex(self.filename, stride=10)
+        self.assertEqual(index.build(), 50)
+        self.assertEqual(index.entries[-1][1:], (1, None))
+
+        # The last entry points at the last row, so resuming from it loses nothing
+        with open(self.filename) as infile:
+            infile.seek(index.entries[-1][0])
+            self.assertTrue(infile.readline().startswith('1,'))
+
+        index.save()
+        loaded = TwitterIndex.load(self.filename)
+        self.assertEqual(loaded.entries, index.entries)
+
+    def test_undated_stride_row(self):
+        self.write(range(50, 0, -1), undated=[40])
+        index = TwitterIndex(self.filename, stride=10)
+        index.build()
+        self.assertEqual([id for offset, id, date in index.entries], [50, 40, 30, 20, 10, 1])
+        self.assertEqual(index.entries[1][2], None)
+
+        # Seeking by date skips the undated entry, seeking by id uses it
+        index.save()
+        reader = TwitterRead(self.filename, until=datetime(2017, 1, 1, 0, 0, 35))
+        self.assertEqual(next(reader)['id'], 34)
+        reader = TwitterRead(self.filename)
+        reader.seekid(40)
+        self.assertEqual(next(reader)['id'], 40)
+
+    def test_seekid_without_dates(self):
+        # A list of ids, such as the input to twitterHydrate, has no date column at all
+        twitterwrite = TwitterWrite(self.filename, fieldnames=['id'])
+        for id in range(20000, 0, -1):
+            twitterwrite.write({'id': id})
+        twitterwrite.close()
+
+        reader = TwitterRead(self.filename)
+        reader.seekid(12345)
+        self.assertEqual(next(reader)['id'], 12345)
+
+if __name__ == '__main__':
+    unittest.main()
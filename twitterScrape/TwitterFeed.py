@@ -13,29 +13,122 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json,re,sys,ssl
+import json,re,sys,ssl,socket,threading,heapq,ast,copy,operator,itertools,array,time
 if sys.version_info[0] < 3:
     from urllib import quote
+    from urlparse import urljoin, urlsplit
     import urllib2 as urllibrequest
     import cookielib as cookiejar
+    import httplib
+    import Queue as queue
     import unicodecsv as csv
+    import cPickle as pickle
 else:
-    from urllib.parse import quote
+    from urllib.parse import quote, urljoin, urlsplit
     import urllib.request as urllibrequest
     import http.cookiejar as cookiejar
+    import http.client as httplib
+    import queue
     import csv
+    import pickle
 
-from pyquery import PyQuery
-import lxml
+import lxml.etree
 import os
 import shutil
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import parser as dateparser
+import dateutil.tz
 from future.utils import implements_iterator
 
+class TwitterResponse(object):
+    # Minimal response wrapper so that cookiejar can extract cookies from an httplib response
+    def __init__(self, response):
+        self.response = response
+
+    def info(self):
+        return self.response.msg
+
+class TwitterConnectionPool(object):
+    def __init__(self, size=4):
+        self.size     = size
+        self.context  = ssl._create_unverified_context()
+        self.lock     = threading.Lock()
+        self.idle     = {}
+        self.opened   = 0
+        self.reused   = 0
+
+    def connection(self, scheme, host, timeout):
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                self.reused += 1
+                connection = idle.pop()
+                connection.timeout = timeout
+                if connection.sock:
+                    connection.sock.settimeout(timeout)
+
+                return connection, True
+
+            self.opened += 1
+
+        if scheme == 'https':
+            return httplib.HTTPSConnection(host, timeout=timeout, context=self.context), False
+        else:
+            return httplib.HTTPConnection(host, timeout=timeout), False
+
+    def release(self, scheme, host, connection):
+        with self.lock:
+            idle = self.idle.setdefault((scheme, host), [])
+            if len(idle) < self.size:
+                idle.append(connection)
+                return
+
+        connection.close()
+
+    def open(self, url, headers, cookieJar=None, timeout=None):
+        for redirect in range(5):
+            scheme, host, path, query, fragment = urlsplit(url)
+            request = urllibrequest.Request(url, headers=dict(headers))
+            if cookieJar is not None:
+                cookieJar.add_cookie_header(request)
+
+            while True:
+                connection, reused = self.connection(scheme, host, timeout)
+                try:
+                    connection.request('GET', (path or '/') + ('?' + query if query else ''),
+                                       headers=dict(request.header_items()))
+                    response = connection.getresponse()
+                    data = response.read()
+                    break
+                except (socket.error, httplib.HTTPException) as err:
+                    connection.close()
+                    # A kept-alive connection may have been closed by the server, so retry
+                    # once on a new connection before giving up.
+                    if not reused:
+                        raise urllibrequest.URLError(err)
+
+            if cookieJar is not None:
+                cookieJar.extract_cookies(TwitterResponse(response), request)
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(scheme, host, connection)
+
+            location = response.getheader('Location')
+            if response.status in (301, 302, 303, 307) and location:
+                url = urljoin(url, location)
+                continue
+            elif response.status != 200:
+                raise urllibrequest.HTTPError(url, response.status, response.reason, response.msg, None)
+
+            return data
+
+        raise urllibrequest.HTTPError(url, response.status, "Too many redirects", response.msg, None)
+
 @implements_iterator
 class TwitterFeed(object):
-    def __init__(self, language=None, user=None, since=None, until=None, query=None, timeout=None):
+    def __init__(self, language=None, user=None, since=None, until=None, query=None, timeout=None, prefetch=0):
         urlGetData = ''
         urlGetData += (' lang:' + language) if language else ''
         urlGetData += (' from:' + user)     if user     else ''
@@ -46,121 +139,249 @@ class TwitterFeed(object):
         self.timeout = timeout
         self.url = 'https://twitter.com/i/search/timeline?f=tweets&q=' + quote(urlGetData) + '&src=typd&max_position='
         self.position = ''
-        self.opener = None
+        self.pageposition = None
         self.cookieJar = cookiejar.CookieJar()
         self.tweets = None
 
-    PARSER=None
+        # Number of pages to fetch ahead of the consumer in a background thread
+        self.prefetch = prefetch
+        self.pages = None
+        self.stop = None
+
+    def __del__(self):
+        if self.stop is not None:
+            self.stop.set()
+
+    # Connection pool shared by all feeds so that reopened feeds reuse kept-alive connections
+    POOL=TwitterConnectionPool()
+    HEADERS=[
+        ('User-Agent', "Mozilla/5.0 (Windows NT 6.1; Win64; x64)"),
+        ('Accept', "application/json, text/javascript, */*; q=0.01"),
+        ('Accept-Language', "de,en-US;q=0.7,en;q=0.3"),
+        ('X-Requested-With', "XMLHttpRequest"),
+        ('Connection', "keep-alive")
+    ]
     FORCE_SPACE_TAGS={'a'}
     MENTIONREGEXP=re.compile(r'(?:@(\w+))', re.UNICODE)
     HASHTAGREGEXP=re.compile(r'(?:#(\w+))', re.UNICODE)
 
-    def __next__(self):
+    # Each page is parsed once and its elements walked in a single pass, assigning each element
+    # that carries tweet data to the most recent tweet. Class predicates in XPath turn out to be
+    # several times slower than testing the class attribute during the walk.
+    TWEETTAGS=('div', 'span', 'p')
+    COUNTXPATH=lxml.etree.XPath(".//span[contains(concat(' ', normalize-space(@class), ' '), ' ProfileTweet-actionCount ')]/@data-tweet-stat-count")
+    ACTIONCLASSES={'ProfileTweet-action--reply':    'replies',
+                   'ProfileTweet-action--retweet':  'retweets',
+                   'ProfileTweet-action--favorite': 'favorites'}
+
+    # Define our own text extraction function as pyquery's is buggy - it puts spaces
+    # in the middle of URLs.
+    @staticmethod
+    def text(element):
+        text = []
+
+        def add_text(tag, no_tail=False):
+            if tag.tag in TwitterFeed.FORCE_SPACE_TAGS:
+                text.append(u' ')
+            if tag.text and not isinstance(tag, lxml.etree._Comment):
+                text.append(tag.text)
+            if tag.tag == 'img':
+                text.append(tag.get("alt") or '')
+            for child in tag:
+                add_text(child)
+            if not no_tail and tag.tail:
+                text.append(tag.tail)
+
+        add_text(element, no_tail=True)
+        return u''.join(text)
+
+    @staticmethod
+    def parse(html):
+        """Extract tweets from a page of search results. Returns a list of dictionaries, with
+           None in place of an unrecognised tweet, after which no further tweets are extracted."""
+
+        def build(element, fields):
+            # Skip retweets - this doesn't seem to ever happen???
+            if fields.get('retweet'):
+                return False
 
-        # Define our own text extraction function as pyquery's is buggy - it puts spaces
-        # in the middle of URLs.
-        def text(tweet):
-            text = []
-
-            def add_text(tag, no_tail=False):
-                if tag.tag in TwitterFeed.FORCE_SPACE_TAGS:
-                    text.append(u' ')
-                if tag.text and not isinstance(tag, lxml.etree._Comment):
-                    text.append(tag.text)
-                if tag.tag == 'img':
-                    text.append(tag.get("alt") or '')
-                for child in tag.getchildren():
-                    add_text(child)
-                if not no_tail and tag.tail:
-                    text.append(tag.tail)
-
-            for tag in tweet:
-                add_text(tag, no_tail=True)
-
-            return u''.join(text)
-
-
-        if self.opener is None:
-            self.opener = urllibrequest.build_opener(urllibrequest.HTTPSHandler(context=ssl._create_unverified_context()),
-                                                     urllibrequest.HTTPCookieProcessor(self.cookieJar))
-            self.opener.addheaders = [
-                ('Host', "twitter.com"),
-                ('User-Agent', "Mozilla/5.0 (Windows NT 6.1; Win64; x64)"),
-                ('Accept', "application/json, text/javascript, */*; q=0.01"),
-                ('Accept-Language', "de,en-US;q=0.7,en;q=0.3"),
-                ('X-Requested-With', "XMLHttpRequest"),
-                ('Referer', self.url),
-                ('Connection', "keep-alive")
-            ]
+            ret = {}
+            ret['id']    = int(element.get("data-tweet-id"))
+            conversation = int(element.get("data-conversation-id"))
+            if conversation != ret['id']:
+                ret['conversation'] = conversation
+
+            ret['date']      = datetime.utcfromtimestamp(int(fields.get('time')))
+            ret['user']      = element.get("data-screen-name")
+            ret['user-id']   = element.get("data-user-id")
+            text = fields.get('text')
+            ret['lang']      = text.get("lang") if text is not None else None
+            ret['text']      = TwitterFeed.text(text) if text is not None else u''
+            ret['replies']   = int(fields.get('replies').replace(",", ""))
+            ret['retweets']  = int(fields.get('retweets').replace(",", ""))
+            ret['favorites'] = int(fields.get('favorites').replace(",", ""))
+            quotetweet = fields.get('quote')
+            if quotetweet is not None:
+                ret['quote']         = int(quotetweet.get("data-item-id"))
+                ret['quote-user-id'] = int(quotetweet.get("data-user-id"))
+                ret['quote-user']    = quotetweet.get("data-screen-name")
+
+            #ret['permalink'] = 'https://twitter.com' + element.get("data-permalink-path")
+
+            ret['geo'] = fields.get('geo', '')
+
+            ret['mentions']  = " ".join(TwitterFeed.MENTIONREGEXP.findall(ret['text']))
+            ret['hashtags']  = " ".join(TwitterFeed.HASHTAGREGEXP.findall(ret['text']))
+
+            return ret
+
+        tweets = []
+        tweet = None
+        fields = None
+        for element in lxml.etree.HTML(html).iter(*TwitterFeed.TWEETTAGS):
+            classes = element.get('class')
+            if classes is None:
+                continue
+
+            classes = classes.split()
+            if element.tag == 'div' and 'js-stream-tweet' in classes:
+                if tweet is not None:
+                    tweets.append((tweet, fields))
+                tweet = element
+                fields = {}
+            elif tweet is None:
+                continue
+            elif element.tag == 'span' and 'js-retweet-text' in classes:
+                fields['retweet'] = fields.get('retweet') or u''.join(element.itertext()).strip() != u''
+            elif element.tag == 'span' and 'js-short-timestamp' in classes:
+                if 'time' not in fields and any('time' in small.get('class', '').split() for small in element.iterancestors('small')):
+                    fields['time'] = element.get("data-time")
+            elif element.tag == 'p' and 'js-tweet-text' in classes:
+                fields.setdefault('text', element)
+            elif element.tag == 'div' and 'QuoteTweet-innerContainer' in classes:
+                fields.setdefault('quote', element)
+            elif element.tag == 'span' and 'Tweet-geo' in classes:
+                fields.setdefault('geo', element.get('title'))
+            elif element.tag == 'span':
+                for actionclass, field in TwitterFeed.ACTIONCLASSES.items():
+                    if actionclass in classes and field not in fields:
+                        counts = TwitterFeed.COUNTXPATH(element)
+                        if counts:
+                            fields[field] = counts[0]
+
+        if tweet is not None:
+            tweets.append((tweet, fields))
+
+        ret = []
+        for tweet, fields in tweets:
+            try:
+                built = build(tweet, fields)
+            except (TypeError, AttributeError, ValueError):
+                ret.append(None)
+                break
+
+            if built:
+                ret.append(built)
+
+        return ret
 
+    @staticmethod
+    def fetch(url, position, cookieJar, timeout):
+        """Fetch and parse one page of search results. Returns the position of the following page
+           and the list of tweets, or None if there are no more results or the request failed."""
+        try:
+            dataJson = json.loads(TwitterFeed.POOL.open(url + position,
+                                                        TwitterFeed.HEADERS + [('Referer', url)],
+                                                        cookieJar=cookieJar, timeout=timeout))
+            if dataJson is not None and len(dataJson['items_html'].strip()) > 0:
+                return dataJson['min_position'], TwitterFeed.parse(dataJson['items_html'])
+        except KeyboardInterrupt:
+            raise
+        except:
+            print ("Exception:", sys.exc_info())
+            sys.stderr.write("in response to URL: " + url + position + '\n')
+
+        return None
+
+    # Runs in a background thread, fetching pages into a bounded queue until the results are
+    # exhausted or the feed is discarded. Deliberately holds no reference to the feed itself.
+    @staticmethod
+    def prefetcher(url, position, cookieJar, timeout, pages, stop):
+        while not stop.is_set():
+            page = TwitterFeed.fetch(url, position, cookieJar, timeout)
+            while not stop.is_set():
+                try:
+                    pages.put(page, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+            if page is None:
+                break
+
+            position = page[0]
+
+    def __next__(self):
         while True:
             if self.tweets is None:
-                try:
-                    dataJson = json.loads(self.opener.open(self.url + self.position, timeout=self.timeout).read())
-                    if dataJson is not None and len(dataJson['items_html'].strip()) > 0:
-                        self.position = dataJson['min_position']
-                        self.tweets = PyQuery(dataJson['items_html'], parser=TwitterFeed.PARSER).items('div.js-stream-tweet')
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    print ("Exception:", sys.exc_info())
-                    sys.stderr.write("in response to URL: " + self.url + self.position + '\n')
+                if self.prefetch:
+                    if self.pages is None:
+                        self.pages = queue.Queue(self.prefetch)
+                        self.stop  = threading.Event()
+                        prefetcher = threading.Thread(target=TwitterFeed.prefetcher,
+                                                      args=(self.url, self.position, self.cookieJar, self.timeout, self.pages, self.stop))
+                        prefetcher.daemon = True
+                        prefetcher.start()
+
+                    page = self.pages.get()
+                    # The prefetcher has finished, so a later call will start a new one from the same position.
+                    if page is None:
+                        self.pages = None
+                else:
+                    page = TwitterFeed.fetch(self.url, self.position, self.cookieJar, self.timeout)
+
+                if page is not None:
+                    # Remember where the current page came from so that it can be fetched again
+                    self.pageposition = self.position
+                    self.position, tweets = page
+                    self.tweets = iter(tweets)
 
             if self.tweets is None:
                 raise StopIteration
 
             try:
                 tweet = next(self.tweets)
-                tweetPQ = PyQuery(tweet, parser=TwitterFeed.PARSER)
             except StopIteration:
                 self.tweets = None
                 continue
 
-            # Skip retweets - this doesn't seem to ever happen???
-            retweet = tweetPQ("span.js-retweet-text").text()
-            if retweet != '':
-                continue
-
-            # Build tweet as dictionary
-            ret = {}
-
-            try:
-                ret['id']    = int(tweetPQ.attr("data-tweet-id"))
-                conversation = int(tweetPQ.attr("data-conversation-id"))
-                if conversation != ret['id']:
-                    ret['conversation'] = conversation
-
-                ret['date']      = datetime.utcfromtimestamp(
-                                        int(tweetPQ("small.time span.js-short-timestamp").attr("data-time")))
-                ret['user']      = tweetPQ.attr("data-screen-name")
-                ret['user-id']   = tweetPQ.attr("data-user-id")
-                ret['lang']      = tweetPQ("p.js-tweet-text").attr("lang")
-                ret['text']      = text(tweetPQ("p.js-tweet-text"))
-                ret['replies']   = int(tweetPQ("span.ProfileTweet-action--reply span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
-                ret['retweets']  = int(tweetPQ("span.ProfileTweet-action--retweet span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
-                ret['favorites'] = int(tweetPQ("span.ProfileTweet-action--favorite span.ProfileTweet-actionCount").attr("data-tweet-stat-count").replace(",", ""))
-                quotetweet = tweetPQ("div.QuoteTweet-innerContainer")
-                if quotetweet:
-                    ret['quote']         = int(quotetweet.attr("data-item-id"))
-                    ret['quote-user-id'] = int(quotetweet.attr("data-user-id"))
-                    ret['quote-user']    = quotetweet.attr("data-screen-name")
-
-                #ret['permalink'] = 'https://twitter.com' + tweetPQ.attr("data-permalink-path")
-
-                geoSpan = tweetPQ('span.Tweet-geo')
-                ret['geo'] = geoSpan.attr('title') if geoSpan else ''
-
-                ret['mentions']  = " ".join(TwitterFeed.MENTIONREGEXP.findall(ret['text']))
-                ret['hashtags']  = " ".join(TwitterFeed.HASHTAGREGEXP.findall(ret['text']))
-
-                return ret
-
-            except TypeError:
+            if tweet is None:
                 sys.stderr.write("Unrecognised tweet in response to URL: " + self.url + self.position + '\n')
                 raise StopIteration
 
+            return tweet
+
 class TwitterRead(object):
-    def __init__(self, filename, since=None, until=None, limit=None, blanks=False):
+    def __init__(self, filename, since=None, until=None, limit=None, blanks=False, columns=None):
+        self.since  = since
+        self.until  = until
+        self.limit  = limit
+        self.blanks = blanks
+        self.count  = 0
+        self.filename = filename
+        self.end    = None
+        self.past   = False
+        self.sinceid = None
+
+        # Tests on single columns applied before a row is returned, see where()
+        self.predicates = []
+
+        self.parquet = None
+        if TwitterRead.columnar(filename):
+            self.file = None
+            self.openparquet(filename, columns)
+            return
+
         if filename is None:
             self.file = sys.stdin
         else:
@@ -170,11 +391,6 @@ class TwitterRead(object):
                 self.file = None
                 raise
 
-        self.since  = since
-        self.until  = until
-        self.limit  = limit
-        self.blanks = blanks
-
         # Extract comments at start of file
         self.comments = ''
         while True:
@@ -186,7 +402,387 @@ class TwitterRead(object):
                 break
 
         self.csvreader = csv.DictReader(self.file, fieldnames=self.fieldnames)
-        self.count = 0
+
+        # Integer columns present in this file, worked out once rather than for every row
+        self.intfields = [key for key in TwitterRead.INTFIELDS if key in self.fieldnames]
+
+        # Consecutive tweets often share a timestamp, so remember the last one parsed
+        self.lastdate = None
+        self.lastparsed = None
+
+        # Offset of the first row if the file is seekable
+        self.datastart = None
+        if filename is not None:
+            try:
+                self.datastart = self.file.tell()
+            except (IOError, OSError):
+                pass
+
+        # Use the sidecar index if there is a current one
+        self.index = TwitterIndex.load(filename) if filename is not None else None
+
+        # Rows are in descending date order, so jump straight to the until date when the file is seekable
+        if self.until:
+            until = self.until
+            self.seek(lambda id, date: date < until)
+
+        if columns is not None:
+            self.project(columns)
+
+    INTFIELDS=('id', 'user-id', 'replies', 'retweets', 'favorites', 'conversation', 'quote', 'quote-user-id', 'reply-to', 'reply-to-user-id')
+
+    # Files with these extensions are stored in columnar Parquet format rather than CSV.
+    COLUMNAREXTENSIONS=('.parquet', '.pq')
+
+    @staticmethod
+    def columnar(filename):
+        return filename is not None and os.path.splitext(filename)[1].lower() in TwitterRead.COLUMNAREXTENSIONS
+
+    def openparquet(self, filename, columns):
+        import pyarrow.parquet
+
+        self.parquet = pyarrow.parquet.ParquetFile(filename)
+        metadata = self.parquet.schema.to_arrow_schema().metadata or {}
+        self.comments = metadata.get(b'comments', b'').decode('utf-8')
+
+        self.fieldnames  = self.parquet.schema.names
+        self.readcolumns = self.fieldnames
+        self.datecolumn = self.parquet.schema.names.index('date') if 'date' in self.parquet.schema.names else None
+        self.rowgroup = 0
+        self.rows = iter([])
+        self.datastart = None
+        self.index = None
+
+        if columns is not None:
+            self.project(columns)
+
+    def project(self, columns):
+        # Restrict the columns reported to those given; names not in the file are ignored. A columnar file
+        # then reads only those columns along with the id and date needed to filter rows, while a CSV file
+        # only converts those columns. Call this before reading any rows.
+        self.fieldnames = [key for key in self.fieldnames if key in columns]
+        tested = [column for column, test, value in self.predicates]
+        if self.parquet:
+            self.readcolumns = [key for key in self.parquet.schema.names
+                                    if key in self.fieldnames or key == 'id' or key in tested or (key == 'date' and (self.since or self.until))]
+        else:
+            self.intfields = [key for key in self.intfields if key in columns or key == 'id' or key in tested]
+
+    def where(self, column, test, value, bounds=False):
+        # Only return rows for which test(row[column], value) is true, for example where('lang', operator.eq, 'en').
+        # With bounds set, a range on the date narrows since and until instead, so that the reader can seek or skip
+        # row groups, and a lower bound on the id stops reading at the first row past it. Both rely on the file
+        # being in descending order, so are only for callers that already assume so. Call this before reading any
+        # rows.
+        if bounds and column == 'id' and test in (operator.gt, operator.ge):
+            sinceid = value if test is operator.gt else value - 1
+            if self.sinceid is None or sinceid > self.sinceid:
+                self.sinceid = sinceid
+        elif bounds and column == 'date' and test in (operator.ge, operator.gt, operator.lt, operator.le):
+            if test in (operator.ge, operator.gt):
+                since = value + timedelta(microseconds=1) if test is operator.gt else value
+                if self.since is None or since > self.since:
+                    self.since = since
+            else:
+                until = value + timedelta(microseconds=1) if test is operator.le else value
+                if self.until is None or until < self.until:
+                    self.until = until
+                    if not self.parquet:
+                        self.seek(lambda id, date: date < until)
+        else:
+            self.predicates += [(column, test, value)]
+            if column in TwitterRead.INTFIELDS and not self.parquet and column in self.csvreader.fieldnames and column not in self.intfields:
+                self.intfields += [column]
+
+        if self.parquet and column in self.parquet.schema.names and column not in self.readcolumns:
+            self.readcolumns += [column]
+
+    def headid(self):
+        # Return the id of the first and so newest tweet in the file, without disturbing the reader, or None if
+        # there is none or the file cannot be read twice.
+        if self.parquet:
+            if 'id' not in self.parquet.schema.names:
+                return None
+            for rowgroup in range(self.parquet.num_row_groups):
+                for id in self.parquet.read_row_group(rowgroup, columns=['id']).to_pydict()['id']:
+                    if id is not None:
+                        return id
+            return None
+
+        if self.datastart is None or 'id' not in self.csvreader.fieldnames:
+            return None
+
+        idcol = self.csvreader.fieldnames.index('id')
+        with open(self.filename, 'rU') as infile:
+            infile.seek(self.datastart)
+            for fields in csv.reader(iter(infile.readline, '')):
+                if len(fields) > idcol and fields[idcol] != '':
+                    try:
+                        return int(fields[idcol])
+                    except ValueError:
+                        pass
+
+        return None
+
+    def ranges(self, count):
+        # Split the rest of the file into about count byte ranges that each start at a record boundary, so that
+        # they can be read independently with reopen(). Returns None if the file cannot be split, that is if it is
+        # not a seekable CSV file, or a limit applies across the whole file. Call this before reading any rows.
+        if self.parquet or self.datastart is None or self.limit:
+            return None
+
+        start = self.file.tell()
+        end = os.fstat(self.file.fileno()).st_size
+        offsets = [start]
+        if self.index:
+            # Index entries are known to be at the start of a record
+            entries = [offset for offset, id, date in self.index.entries if start < offset < end]
+            for index in range(1, count):
+                if len(entries) * index // count < len(entries):
+                    offset = entries[len(entries) * index // count]
+                    if offset > offsets[-1]:
+                        offsets += [offset]
+        else:
+            # The csv module only writes quotes around quoted fields and doubled within them, so a line starts a
+            # record if an even number of quotes come before it. Count quotes through the file to find the first
+            # such line after each share of the file. Unlike resync() this cannot be fooled by text that looks
+            # like a record.
+            scan = open(self.filename, 'rb')
+            scan.seek(start)
+            position = start
+            quotes = 0
+            for index in range(1, count):
+                target = start + (end - start) * index // count
+                while position < target:
+                    block = scan.read(min(target - position, 1 << 20))
+                    if not block:
+                        break
+                    quotes += block.count('"')
+                    position += len(block)
+
+                while True:
+                    line = scan.readline()
+                    if not line:
+                        break
+                    quotes += line.count('"')
+                    position += len(line)
+                    if quotes % 2 == 0:
+                        break
+
+                if position >= end:
+                    break
+                if position > offsets[-1]:
+                    offsets += [position]
+
+            scan.close()
+
+        self.file.seek(start)
+        return zip(offsets, offsets[1:] + [end])
+
+    def reopen(self, start, end):
+        # Read only the records that start from start up to end, through a file of the reader's own. This is
+        # for worker processes, which each have a copy of the reader from ranges().
+        self.file.close()
+        self.file = file(self.filename, 'rU')
+        self.file.seek(start)
+        self.end = end
+
+        # Read by line rather than iterating over the file so that tell() stays at the next record
+        self.csvreader = csv.DictReader(iter(self.file.readline, ''), fieldnames=self.csvreader.fieldnames)
+
+    def parallel(self, jobs, chunk=1000):
+        # Generate the remaining rows in order, parsed by worker processes that each read their own ranges of
+        # the file. Falls back to reading the rows here if there is only one job or the file cannot be split.
+        spans = self.ranges(4 * jobs) if jobs > 1 else None
+        if not spans:
+            for row in self:
+                yield row
+            return
+
+        import multiprocessing
+
+        # Worker n reads every n'th range, so that the ranges can be collected in order from each worker in turn
+        queues = [multiprocessing.Queue(4) for job in range(jobs)]
+        def work(job):
+            try:
+                for start, end in spans[job::jobs]:
+                    self.reopen(start, end)
+                    while True:
+                        rows = list(itertools.islice(self, chunk))
+                        if not rows:
+                            break
+                        queues[job].put(rows)
+
+                    # Mark the end of the range, and whether it reached tweets before since
+                    queues[job].put(self.past)
+            except Exception:
+                import traceback
+                queues[job].put(traceback.format_exc())
+
+        workers = [multiprocessing.Process(target=work, args=(job,)) for job in range(jobs)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+
+        try:
+            for index in range(len(spans)):
+                while True:
+                    rows = queues[index % jobs].get()
+                    if rows is True:
+                        return
+                    if rows is False:
+                        break
+                    if isinstance(rows, basestring):
+                        raise RuntimeError("Reader process failed:\n" + rows)
+                    for row in rows:
+                        yield row
+        finally:
+            for worker in workers:
+                worker.terminate()
+
+    def matches(self, row):
+        for column, test, value in self.predicates:
+            try:
+                if not test(row.get(column), value):
+                    return False
+            except TypeError:
+                return False
+
+        return True
+
+    def nextrowgroup(self):
+        # Load the next row group that can contain rows between since and until, using the date
+        # statistics in the file's metadata to skip those that cannot.
+        while self.rowgroup < self.parquet.num_row_groups:
+            rowgroup = self.rowgroup
+            self.rowgroup += 1
+            if self.datecolumn is not None and (self.since or self.until):
+                statistics = self.parquet.metadata.row_group(rowgroup).column(self.datecolumn).statistics
+                if statistics is not None and statistics.has_min_max:
+                    if self.until and statistics.min >= self.until:
+                        continue
+                    if self.since and statistics.max < self.since:
+                        return False
+
+            columns = self.parquet.read_row_group(rowgroup, columns=self.readcolumns).to_pydict()
+            self.rows = (dict(zip(self.readcolumns, values)) for values in zip(*[columns[key] for key in self.readcolumns]))
+            return True
+
+        return False
+
+    # Binary search stops once the boundary is within this many bytes, then steps through the remaining records.
+    SEEKSPAN=16384
+
+    def seekid(self, id):
+        # Position the reader so that the next row is the first with an id no greater than the given one.
+        self.seek(lambda rowid, date: rowid <= id)
+
+    def seek(self, before):
+        # Position the reader at the first tweet for which before(id, date) is true. Rows are in descending
+        # id and date order, so the condition must be false up to some point in the file and true thereafter.
+        # Files without a date column are sought with a date of None.
+        fieldnames = self.csvreader.fieldnames
+        if self.datastart is None or 'id' not in fieldnames:
+            return
+        dated = 'date' in fieldnames
+
+        # Invariant: every tweet before lo fails the condition, and the first tweet after hi passes it.
+        datastart = self.datastart
+        lo = datastart
+        hi = os.fstat(self.file.fileno()).st_size
+        try:
+            if self.index:
+                lo, hi = self.index.span(before)
+                lo = max(lo, datastart)
+
+            while hi - lo > TwitterRead.SEEKSPAN:
+                mid = (lo + hi) // 2
+                record = self.resync(mid)
+                if record is None or before(*record[1:]):
+                    hi = mid
+                else:
+                    lo = record[0]
+
+            # Step through the remaining records to the exact boundary
+            self.file.seek(lo)
+            for fields in csv.reader(iter(self.file.readline, '')):
+                row = dict(zip(fieldnames, fields))
+                if len(fields) == len(fieldnames) and row['id'] != '':
+                    try:
+                        if before(int(row['id']), TwitterRead.parsedate(row['date']) if dated else None):
+                            break
+                    except ValueError:
+                        # A row without a date can still satisfy a condition on id alone
+                        try:
+                            if before(int(row['id']), None):
+                                break
+                        except (TypeError, ValueError):
+                            pass
+
+                lo = self.file.tell()
+        except TypeError:
+            # Dates that cannot be compared with the condition, for example with and without a timezone
+            lo = datastart
+
+        self.file.seek(lo)
+
+    def resync(self, offset):
+        # Find the first record starting at or after offset and return its offset along with the id and date of the
+        # first tweet from there on. Since text can contain quoted newlines, a line is only taken to start a record if it
+        # and the record following it parse as tweets.
+        fieldnames = self.csvreader.fieldnames
+        dated = 'date' in fieldnames
+        self.file.seek(offset - 1)
+        self.file.readline()
+        while True:
+            start = self.file.tell()
+            if not self.file.readline():
+                return None
+
+            self.file.seek(start)
+            id = None
+            date = None
+            valid = 0
+            try:
+                for fields in csv.reader(iter(self.file.readline, '')):
+                    if len(fields) != len(fieldnames):
+                        break
+                    row = dict(zip(fieldnames, fields))
+                    if row['id'] != '':
+                        rowid = int(row['id'])
+                        if id is None:
+                            id = rowid
+                            date = TwitterRead.parsedate(row['date']) if dated else None
+
+                    valid += 1
+                    if valid >= 2 and id is not None:
+                        return start, id, date
+                else:
+                    if valid > 0 and id is not None:
+                        return start, id, date
+            except (csv.Error, TypeError, ValueError, OverflowError):
+                pass
+
+            # Not a record boundary, so try the next line
+            self.file.seek(start)
+            self.file.readline()
+
+    # Dates written by TwitterWrite are 'YYYY-MM-DD HH:MM:SS[.ffffff]', which can be sliced
+    # apart much faster than dateutil can parse them. Anything else goes to dateutil.
+    @staticmethod
+    def parsedate(date):
+        if len(date) in (19, 26) and date[4] == '-' and date[7] == '-' and date[10] in ' T' and date[13] == ':' and date[16] == ':':
+            try:
+                if len(date) == 19:
+                    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                    int(date[11:13]), int(date[14:16]), int(date[17:19]))
+                elif date[19] == '.':
+                    return datetime(int(date[0:4]), int(date[5:7]), int(date[8:10]),
+                                    int(date[11:13]), int(date[14:16]), int(date[17:19]), int(date[20:26]))
+            except ValueError:
+                pass
+
+        return dateparser.parse(date)
 
     def __iter__(self):
         return self
@@ -205,7 +801,13 @@ class TwitterRead(object):
         if self.limit and self.count == self.limit:
             raise StopIteration
 
+        if self.parquet:
+            return self.nextparquet()
+
         while True:
+            if self.end is not None and self.file.tell() >= self.end:
+                raise StopIteration
+
             row = next(self.csvreader)
             if row.get('id', '') == '':
                 if self.blanks:
@@ -216,34 +818,35 @@ class TwitterRead(object):
 
             date = row.get('date')
             if date:
-                try:
-                    row['date'] = dateparser.parse(date)
-                except (TypeError, ValueError):
-                    row['date'] = None
+                if date != self.lastdate:
+                    try:
+                        self.lastparsed = TwitterRead.parsedate(date)
+                    except (TypeError, ValueError):
+                        self.lastparsed = None
+                    self.lastdate = date
+
+                row['date'] = self.lastparsed
 
                 if self.until and row['date'] >= self.until:
                     continue
                 if self.since and row['date'] < self.since:
+                    self.past = True
                     raise StopIteration
 
-            def convert_to_int(key):
-                val = row.get(key)
+            for key in self.intfields:
+                val = row[key]
                 if val is not None:
                     try:
                         row[key] = int(val)
                     except (TypeError, ValueError):
                         row[key] = None
 
-            convert_to_int('id')
-            convert_to_int('user-id')
-            convert_to_int('replies')
-            convert_to_int('retweets')
-            convert_to_int('favorites')
-            convert_to_int('conversation')
-            convert_to_int('quote')
-            convert_to_int('quote-user-id')
-            convert_to_int('reply-to')
-            convert_to_int('reply-to-user-id')
+            if self.sinceid is not None and row['id'] is not None and row['id'] <= self.sinceid:
+                self.past = True
+                raise StopIteration
+
+            if self.predicates and not self.matches(row):
+                continue
 
             break
 
@@ -251,10 +854,190 @@ class TwitterRead(object):
 
         return row
 
+    def nextparquet(self):
+        while True:
+            try:
+                row = next(self.rows)
+            except StopIteration:
+                if self.nextrowgroup():
+                    continue
+                raise
+
+            if row.get('id') is None:
+                if self.blanks:
+                    break
+                else:
+                    continue
+
+            date = row.get('date')
+            if date:
+                if self.until and date >= self.until:
+                    continue
+                if self.since and date < self.since:
+                    raise StopIteration
+
+            if self.sinceid is not None and row['id'] <= self.sinceid:
+                raise StopIteration
+
+            if self.predicates and not self.matches(row):
+                continue
+
+            break
+
+        self.count += 1
+
+        return row
+
+# Sidecar index of a tweet CSV file, recording the offset, id and date of every stride'th tweet and of the
+# last tweet. It is stored as JSON alongside the file and is only used while the file's size and
+# modification time match those recorded when it was built.
+class TwitterIndex(object):
+    def __init__(self, filename, stride=1000):
+        self.filename = filename
+        self.stride   = stride
+        self.size     = None
+        self.mtime    = None
+        self.entries  = []
+
+    STRIDE=1000
+
+    @staticmethod
+    def indexname(filename):
+        return filename + '.idx'
+
+    @staticmethod
+    def load(filename):
+        indexname = TwitterIndex.indexname(filename)
+        if not os.path.isfile(indexname):
+            return None
+
+        try:
+            state = json.load(open(indexname, 'r'))
+            stat = os.stat(filename)
+        except (IOError, OSError, ValueError):
+            return None
+        if state['size'] != stat.st_size or state['mtime'] != stat.st_mtime:
+            return None
+
+        index = TwitterIndex(filename, stride=state['stride'])
+        index.size    = state['size']
+        index.mtime   = state['mtime']
+        index.entries = [(offset, id, TwitterRead.parsedate(date) if date else None) for offset, id, date in state['entries']]
+        return index
+
+    @staticmethod
+    def entry(offset, id, date):
+        # Rows whose date does not parse, such as tweets that could not be hydrated, are indexed by id alone
+        try:
+            return (offset, id, TwitterRead.parsedate(date))
+        except (ValueError, OverflowError):
+            return (offset, id, None)
+
+    def build(self):
+        stat = os.stat(self.filename)
+        infile = file(self.filename, 'rU')
+
+        # Skip comments and header
+        while True:
+            line = infile.readline()
+            if line[:1] != '#':
+                fieldnames = next(csv.reader([line]))
+                break
+
+        if 'id' not in fieldnames or 'date' not in fieldnames:
+            raise RuntimeError("File: " + self.filename + " has no id and date columns to index")
+        idcol   = fieldnames.index('id')
+        datecol = fieldnames.index('date')
+
+        self.entries = []
+        last = None
+        count = 0
+        offset = infile.tell()
+        for fields in csv.reader(iter(infile.readline, '')):
+            if len(fields) == len(fieldnames) and fields[idcol] != '':
+                try:
+                    id = int(fields[idcol])
+                except ValueError:
+                    id = None
+
+                if id is not None:
+                    if count % self.stride == 0:
+                        self.entries.append(TwitterIndex.entry(offset, id, fields[datecol]))
+                        last = None
+                    else:
+                        last = (offset, id, fields[datecol])
+                    count += 1
+
+            offset = infile.tell()
+
+        infile.close()
+        if last is not None:
+            self.entries.append(TwitterIndex.entry(*last))
+
+        self.size  = stat.st_size
+        self.mtime = stat.st_mtime
+        return count
+
+    def save(self):
+        state = {'size':    self.size,
+                 'mtime':   self.mtime,
+                 'stride':  self.stride,
+                 'entries': [(offset, id, date.isoformat() if date else None) for offset, id, date in self.entries]}
+
+        # Write then rename so that readers never see a partial index
+        indexname = TwitterIndex.indexname(self.filename)
+        with open(indexname + '.tmp', 'w') as indexfile:
+            json.dump(state, indexfile)
+        os.rename(indexname + '.tmp', indexname)
+
+    def span(self, before):
+        # Return offsets between which the first tweet satisfying before(id, date) must lie. Entries without a
+        # date are left out if the condition needs one.
+        entries = self.entries
+        undated = [entry for entry in entries if entry[2] is None]
+        if undated:
+            try:
+                before(undated[0][1], None)
+            except TypeError:
+                entries = [entry for entry in entries if entry[2] is not None]
+
+        lo = 0
+        hi = len(entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset, id, date = entries[mid]
+            if before(id, date):
+                hi = mid
+            else:
+                lo = mid + 1
+
+        return (entries[lo - 1][0] if lo > 0 else 0,
+                entries[lo][0] if lo < len(entries) else self.size)
+
 class TwitterWrite(object):
-    def __init__(self, filename, comments=None, fieldnames=None, header=True):
+    def __init__(self, filename, comments=None, fieldnames=None, header=True, append=False):
+        if fieldnames is None:
+            fieldnames = ['user', 'date', 'retweets', 'favorites', 'text', 'lang', 'geo', 'mentions', 'hashtags', 'id']
+
+        self.count = 0
+        self.filename = filename
+        self.closed = False
+
+        self.parquet = None
+        if TwitterRead.columnar(filename):
+            if append:
+                raise RuntimeError("Cannot append to columnar file: " + filename)
+            if os.path.exists(filename):
+                shutil.move(filename, filename + '.bak')
+
+            self.file = None
+            self.openparquet(filename, comments, fieldnames)
+            return
+
         if filename is None:
             self.file = sys.stdout
+        elif append:
+            self.file = file(filename, 'a')
         else:
             if os.path.exists(filename):
                 shutil.move(filename, filename + '.bak')
@@ -264,9 +1047,6 @@ class TwitterWrite(object):
         if comments is not None:
             self.file.write(comments)
 
-        if fieldnames is None:
-            fieldnames = ['user', 'date', 'retweets', 'favorites', 'text', 'lang', 'geo', 'mentions', 'hashtags', 'id']
-
         self.csvwriter = csv.DictWriter(self.file,
                                                fieldnames=fieldnames,
                                                extrasaction='ignore',
@@ -275,12 +1055,1381 @@ class TwitterWrite(object):
         if header:
             self.csvwriter.writeheader()
 
-        self.count = 0
-        self.filename = filename
+    # Number of rows in each row group of a columnar file
+    ROWGROUP=65536
+
+    def openparquet(self, filename, comments, fieldnames):
+        import pyarrow
+        import pyarrow.parquet
+
+        # Ids and counts are stored as 64 bit integers, dates as timestamps and everything else as text.
+        # The comments that head a CSV file are kept in the file metadata.
+        # Kept so that the last row group can be written without importing pyarrow again
+        self.pyarrow = pyarrow
+
+        fields = []
+        for key in fieldnames:
+            if key in TwitterRead.INTFIELDS:
+                fields.append(pyarrow.field(key, pyarrow.int64()))
+            elif key == 'date':
+                fields.append(pyarrow.field(key, pyarrow.timestamp('us')))
+            else:
+                fields.append(pyarrow.field(key, pyarrow.string()))
+
+        self.schema = pyarrow.schema(fields, metadata={b'comments': comments.encode('utf-8')} if comments else None)
+        self.parquet = pyarrow.parquet.ParquetWriter(filename, self.schema)
+        self.fieldnames = fieldnames
+        self.columns = [[] for key in fieldnames]
+
+    @staticmethod
+    def parquetvalue(key, value):
+        if value is None:
+            return None
+        elif key in TwitterRead.INTFIELDS:
+            try:
+                return int(value)
+            except (TypeError, ValueError):
+                return None
+        elif key == 'date':
+            if value == '':
+                return None
+            elif not isinstance(value, datetime):
+                try:
+                    value = TwitterRead.parsedate(value)
+                except (TypeError, ValueError):
+                    return None
+            if value.tzinfo:
+                value = value.astimezone(dateutil.tz.tzutc()).replace(tzinfo=None)
+            return value
+        elif isinstance(value, bytes):
+            return value.decode('utf-8')
+        else:
+            return unicode(value)
+
+    def flushparquet(self):
+        pyarrow = self.pyarrow
+
+        if self.columns[0]:
+            arrays = [pyarrow.array(column, type=field.type) for column, field in zip(self.columns, self.schema)]
+            self.parquet.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+            self.columns = [[] for key in self.fieldnames]
+
+    def close(self):
+        # Write any rows still held for a columnar file along with its footer, and close the file. Call this once
+        # all rows are written, since a columnar file is unreadable until it is closed.
+        if self.closed:
+            return
+
+        self.closed = True
+        if self.parquet:
+            self.flushparquet()
+            self.parquet.close()
+        elif self.file is sys.stdout:
+            self.file.flush()
+        else:
+            self.file.close()
 
     def __del__(self):
-        self.file.close()
+        self.close()
 
     def write(self, row):
-        self.csvwriter.writerow(row)
+        if self.parquet:
+            for key, column in zip(self.fieldnames, self.columns):
+                column.append(TwitterWrite.parquetvalue(key, row.get(key)))
+            if len(self.columns[0]) == TwitterWrite.ROWGROUP:
+                self.flushparquet()
+        else:
+            self.csvwriter.writerow(row)
         self.count += 1
+
+# A Python expression over the fields of a tweet, such as a filter or score given on the command line. Field names
+# become variables by replacing characters other than letters, digits and underscores with underscores, so that
+# for example 'user-id' is user_id. The expression is compiled once into a function of the row that fetches only
+# the fields it uses, rather than passing every field as an argument. A list of expressions evaluates to a list.
+class TwitterExpression(object):
+    def __init__(self, expression, fieldnames, namespace=None):
+        self.namespace = namespace if namespace is not None else {}
+        if isinstance(expression, list):
+            self.body = ast.List(elts=[ast.parse(item.strip(), mode='eval').body for item in expression], ctx=ast.Load())
+        else:
+            self.body = ast.parse(expression.strip(), mode='eval').body
+
+        names = set(node.id for node in ast.walk(self.body) if isinstance(node, ast.Name))
+        self.variables = {}
+        for fieldname in fieldnames:
+            variable = TwitterExpression.BADCHARS.sub('_', fieldname)
+            if variable in names:
+                self.variables[variable] = fieldname
+
+        # Fields the expression refers to, for example to project a reader onto
+        self.columns = [fieldname for fieldname in fieldnames if fieldname in self.variables.values()]
+
+        self.evaluate = self.function(self.body)
+        self.vectorizable = True
+
+    BADCHARS=re.compile(r'[^0-9a-zA-Z_]')
+
+    # Comparisons that can be handed to a reader, and their equivalents with the operands swapped
+    OPERATORS={ast.Eq:    operator.eq,
+               ast.NotEq: operator.ne,
+               ast.Lt:    operator.lt,
+               ast.LtE:   operator.le,
+               ast.Gt:    operator.gt,
+               ast.GtE:   operator.ge,
+               ast.In:    lambda value, collection: value in collection,
+               ast.NotIn: lambda value, collection: value not in collection}
+    SWAPPED={ast.Eq: ast.Eq, ast.NotEq: ast.NotEq, ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt, ast.GtE: ast.LtE}
+
+    def function(self, body):
+        # Bind the fields used on one line then return the value of the expression, moving the expression's
+        # line numbers past that line so that they remain in order.
+        names = set(node.id for node in ast.walk(body) if isinstance(node, ast.Name))
+        module = ast.parse("def evaluate(row):\n    " +
+                           "; ".join([variable + " = row.get(" + repr(fieldname) + ")" for variable, fieldname in sorted(self.variables.items())
+                                                                                        if variable in names] + ["return None"]))
+        body = copy.deepcopy(body)
+        ast.increment_lineno(body, 1)
+        module.body[0].body[-1].value = body
+        ast.fix_missing_locations(module)
+
+        functions = {}
+        exec(compile(module, '<expression>', 'exec'), self.namespace, functions)
+        return functions['evaluate']
+
+    def predicate(self, node):
+        # If the node compares a field with an expression that uses no fields, return the field, test and value.
+        if not isinstance(node, ast.Compare) or len(node.ops) != 1:
+            return None
+
+        left, op, right = node.left, type(node.ops[0]), node.comparators[0]
+        if not (isinstance(left, ast.Name) and left.id in self.variables):
+            if isinstance(right, ast.Name) and right.id in self.variables and op in TwitterExpression.SWAPPED:
+                left, op, right = right, TwitterExpression.SWAPPED[op], left
+            else:
+                return None
+
+        if op not in TwitterExpression.OPERATORS:
+            return None
+        if any(isinstance(node, ast.Name) and node.id in self.variables for node in ast.walk(right)):
+            return None
+
+        value = eval(compile(ast.Expression(body=right), '<expression>', 'eval'), self.namespace)
+        return self.variables[left.id], TwitterExpression.OPERATORS[op], value
+
+    def pushdown(self, reader, bounds=False):
+        # Have the reader apply those parts of a filter that compare a single field with a constant, so that rows
+        # they reject never reach the expression, then recompile the expression without them. Nothing is pushed
+        # down when the reader has a limit, since that counts the rows that the filter rejects. Comparisons of the
+        # date or id only become bounds on reading if bounds is set, as for TwitterRead.where.
+        if reader.limit or isinstance(self.body, ast.List):
+            return
+
+        if isinstance(self.body, ast.BoolOp) and isinstance(self.body.op, ast.And):
+            conjuncts = self.body.values
+        else:
+            conjuncts = [self.body]
+
+        remaining = []
+        for conjunct in conjuncts:
+            predicate = self.predicate(conjunct)
+            if predicate:
+                reader.where(*predicate, bounds=bounds)
+            else:
+                remaining += [conjunct]
+
+        if len(remaining) < len(conjuncts):
+            if len(remaining) == 0:
+                self.body = ast.Name(id='True', ctx=ast.Load())
+            elif len(remaining) == 1:
+                self.body = remaining[0]
+            else:
+                self.body = ast.BoolOp(op=ast.And(), values=remaining)
+
+            self.evaluate = self.function(self.body)
+
+    def evaluatebatch(self, rows, truth=False):
+        # Evaluate the expression over a batch of rows at once, returning a list with one value per row, or with
+        # truth set, whether the value of each row is true. Field values are loaded into NumPy arrays and the
+        # expression is evaluated as array operations, so that for example "retweets + favorites > 10" takes a
+        # few passes over the batch. Parts of the expression that use no fields are evaluated once per batch.
+        # Any expression that cannot be vectorised in this way is evaluated row by row.
+        if self.vectorizable:
+            import numpy
+
+            names = set(node.id for node in ast.walk(self.body) if isinstance(node, ast.Name))
+            columns = {}
+            for variable, fieldname in self.variables.items():
+                if variable not in names:
+                    continue
+                values = [row.get(fieldname) for row in rows]
+                column = numpy.empty(len(values), dtype=object)
+                column[:] = values
+                if fieldname in TwitterRead.INTFIELDS and None not in values:
+                    column = column.astype(numpy.int64)
+                columns[variable] = column
+
+            try:
+                # Have NumPy raise errors such as division by zero rather than quietly carrying on
+                with numpy.errstate(divide='raise', over='raise', invalid='raise'):
+                    if isinstance(self.body, ast.List):
+                        return [list(values) for values in zip(*[self.vectorvalue(numpy, node, columns, len(rows), truth)
+                                                                 for node in self.body.elts])]
+                    else:
+                        return self.vectorvalue(numpy, self.body, columns, len(rows), truth)
+            except NotImplementedError:
+                self.vectorizable = False
+            except (TypeError, ValueError, AttributeError, ArithmeticError):
+                # Leave it to row by row evaluation to report the error, if there really is one
+                pass
+
+        if truth:
+            if isinstance(self.body, ast.List):
+                return [[bool(value) for value in self.evaluate(row)] for row in rows]
+            else:
+                return [bool(self.evaluate(row)) for row in rows]
+        else:
+            return [self.evaluate(row) for row in rows]
+
+    def vectorvalue(self, numpy, node, columns, count, truth):
+        value = self.vector(numpy, node, columns, truth)
+        if not isinstance(value, numpy.ndarray):
+            value = numpy.repeat(numpy.array([value], dtype=object), count)
+        if truth:
+            value = value.astype(bool)
+
+        return value.tolist()
+
+    # Operators that apply element by element to NumPy arrays as they do to single values
+    BINARYOPERATORS={ast.Add:  operator.add,
+                     ast.Sub:  operator.sub,
+                     ast.Mult: operator.mul,
+                     ast.Div:  operator.div if sys.version_info[0] < 3 else operator.truediv,
+                     ast.FloorDiv: operator.floordiv,
+                     ast.Mod:  operator.mod,
+                     ast.Pow:  operator.pow}
+    UNARYOPERATORS={ast.USub: operator.neg,
+                    ast.UAdd: operator.pos}
+
+    def vector(self, numpy, node, columns, truth):
+        # Value of the node over the batch, either an array or a single value that applies to every row. Raises
+        # NotImplementedError for anything that cannot be evaluated over arrays. Where truth is set only the truth
+        # of the value matters, which allows 'and', 'or' and 'not' to be evaluated element by element.
+        if not any(isinstance(child, ast.Name) and child.id in self.variables for child in ast.walk(node)):
+            return eval(compile(ast.Expression(body=node), '<expression>', 'eval'), self.namespace)
+
+        if isinstance(node, ast.Name):
+            return columns[node.id]
+        elif isinstance(node, ast.BinOp) and type(node.op) in TwitterExpression.BINARYOPERATORS:
+            return TwitterExpression.BINARYOPERATORS[type(node.op)](self.vector(numpy, node.left,  columns, False),
+                                                                     self.vector(numpy, node.right, columns, False))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in TwitterExpression.UNARYOPERATORS:
+            return TwitterExpression.UNARYOPERATORS[type(node.op)](self.vector(numpy, node.operand, columns, False))
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return numpy.logical_not(self.truth(numpy, self.vector(numpy, node.operand, columns, True)))
+        elif isinstance(node, ast.BoolOp) and truth:
+            combine = numpy.logical_and if isinstance(node.op, ast.And) else numpy.logical_or
+            return reduce(combine, [self.truth(numpy, self.vector(numpy, value, columns, True)) for value in node.values])
+        elif isinstance(node, ast.Compare):
+            # A chained comparison such as 0 < retweets < 10 is true where each of its comparisons is true
+            result = None
+            left = self.vector(numpy, node.left, columns, False)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = self.vector(numpy, comparator, columns, False)
+                if type(op) in (ast.In, ast.NotIn):
+                    if isinstance(right, numpy.ndarray):
+                        raise NotImplementedError
+                    contains = numpy.frompyfunc(lambda value: value in right, 1, 1)(left).astype(bool)
+                    compared = contains if isinstance(op, ast.In) else numpy.logical_not(contains)
+                elif type(op) in TwitterExpression.OPERATORS:
+                    compared = TwitterExpression.OPERATORS[type(op)](left, right)
+                else:
+                    raise NotImplementedError
+
+                result = compared if result is None else numpy.logical_and(result, compared)
+                left = right
+
+            return result
+
+        raise NotImplementedError
+
+    @staticmethod
+    def truth(numpy, value):
+        return value.astype(bool) if isinstance(value, numpy.ndarray) else bool(value)
+
+# A table of scores keyed by pairs of strings, such as the edges of a network, that holds at most limit pairs in
+# memory. Each string is interned as an int once for the life of the table, and each pair is appended to typed
+# arrays as the ints of its strings and its score, so that it costs PAIRBYTES rather than the few hundred bytes of
+# a dict entry keyed by a tuple of strings. When limit pairs are held they are sorted with NumPy and the scores of
+# each pair combined, and if that still leaves more than half of limit they are written in a sorted run to a file
+# in tempdir. iteritems() merges the runs back together.
+class TwitterPairs(object):
+    def __init__(self, limit=None, tempdir=None):
+        self.limit    = limit
+        self.tempdir  = tempdir
+        self.ids      = {}
+        self.names    = []
+        self.firsts   = array.array('I')
+        self.seconds  = array.array('I')
+        self.scores   = array.array('d')
+        self.integral = True                # Whether every score so far is an int, so that totals are output as ints
+        self.runs     = []
+
+    # Memory per pair, counting two 4 byte ints and an 8 byte score, and the copies made while the pairs are sorted
+    PAIRBYTES=40
+
+    # Number of records to marshal at a time in a run
+    BLOCK=10000
+
+    def id(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return id
+
+    def add(self, first, second, score):
+        if self.integral and not isinstance(score, (int, long)):
+            self.integral = False
+        self.firsts.append(self.id(first))
+        self.seconds.append(self.id(second))
+        self.scores.append(score)
+        if self.limit and len(self.scores) >= self.limit:
+            self.compact()
+            if len(self.scores) > self.limit // 2:
+                self.spill()
+
+    def compact(self, keep=True):
+        # Sort the pairs held by the ints of their strings and combine the scores of each pair, returning the
+        # pairs packed into single ints along with their scores as NumPy arrays. With keep set the combined pairs
+        # are held again, otherwise the table is left empty. The sort is stable so that scores are added in the
+        # order seen, and the arrays are given up as soon as they are copied so that at most PAIRBYTES are used.
+        import numpy
+
+        keys = numpy.frombuffer(self.firsts, dtype=numpy.uint32).astype(numpy.uint64)
+        keys <<= 32
+        keys |= numpy.frombuffer(self.seconds, dtype=numpy.uint32)
+        self.firsts  = array.array('I')
+        self.seconds = array.array('I')
+
+        order  = numpy.argsort(keys, kind='mergesort')
+        keys   = keys[order]
+        scores = numpy.frombuffer(self.scores, dtype=numpy.float64)[order]
+        self.scores = array.array('d')
+        del order
+
+        unique = numpy.empty(len(keys), dtype=bool)
+        unique[:1] = True
+        numpy.not_equal(keys[1:], keys[:-1], out=unique[1:])
+        starts = numpy.flatnonzero(unique)
+        del unique
+        keys   = keys[starts]
+        scores = numpy.add.reduceat(scores, starts) if len(starts) else scores
+        del starts
+
+        if keep:
+            self.firsts.fromstring(buffer((keys >> 32).astype(numpy.uint32)))
+            self.seconds.fromstring(buffer((keys & 0xffffffff).astype(numpy.uint32)))
+            self.scores.fromstring(buffer(scores))
+        return keys, scores
+
+    def pairs(self, keep=True):
+        # Generate the pairs held in memory with their total scores, in order of pair. Pairs are sorted by the
+        # rank of each string, worked out once from the interned strings, and converted a block at a time.
+        import numpy
+
+        keys, scores = self.compact(keep)
+        names = self.names
+        ranks = numpy.empty(len(names), dtype=numpy.uint64)
+        ranks[sorted(xrange(len(names)), key=names.__getitem__)] = numpy.arange(len(names), dtype=numpy.uint64)
+
+        order  = ranks[keys >> 32]
+        order <<= 32
+        order |= ranks[keys & 0xffffffff]
+        order  = numpy.argsort(order)
+
+        integral = self.integral
+        for start in xrange(0, len(order), self.BLOCK):
+            block = order[start:start+self.BLOCK]
+            for key, score in itertools.izip(keys[block].tolist(), scores[block].tolist()):
+                yield names[key >> 32], names[key & 0xffffffff], int(score) if integral else score
+
+    def write(self, records):
+        # Write records, which must already be sorted, to a new run file
+        import marshal, tempfile
+
+        handle, filename = tempfile.mkstemp(suffix='.run', dir=self.tempdir)
+        with os.fdopen(handle, 'wb') as runfile:
+            records = iter(records)
+            while True:
+                block = list(itertools.islice(records, self.BLOCK))
+                if not block:
+                    break
+                marshal.dump(block, runfile)
+
+        self.runs.append(filename)
+
+    @staticmethod
+    def read(filename):
+        import marshal
+
+        with open(filename, 'rb') as runfile:
+            while True:
+                try:
+                    block = marshal.load(runfile)
+                except EOFError:
+                    break
+                for record in block:
+                    yield record
+
+    def spill(self):
+        # Write the pairs held in memory as a run sorted by pair, keeping the interned strings for the pairs to come
+        if self.scores:
+            self.write(self.pairs(keep=False))
+
+    def merge(self, other):
+        # Add the pairs of another table, whose runs become this table's own
+        self.runs += other.runs
+        other.runs = []
+        self.integral = self.integral and other.integral
+        names = other.names
+        for first, second, score in itertools.izip(other.firsts, other.seconds, other.scores):
+            self.add(names[first], names[second], int(score) if other.integral else score)
+
+    def iteritems(self):
+        # Generate each pair and its total score in order of pair
+        if not self.runs:
+            for first, second, score in self.pairs():
+                yield (first, second), score
+            return
+
+        self.spill()
+        last = None
+        for first, second, score in heapq.merge(*[TwitterPairs.read(filename) for filename in self.runs]):
+            if last is not None and (first, second) == last[0]:
+                last[1] += score
+            else:
+                if last is not None:
+                    yield last[0], last[1]
+                last = [(first, second), score]
+
+        if last is not None:
+            yield last[0], last[1]
+
+    def byscore(self, keep=None):
+        # Generate each pair and its total score in descending order of score then of pair, leaving out pairs for
+        # which keep(pair, score) is false. Without runs this is a sort in memory, otherwise the merged pairs are
+        # themselves sorted in runs of at most limit pairs, which are then merged.
+        items = self.iteritems()
+        if keep:
+            items = ((pair, score) for pair, score in items if keep(pair, score))
+
+        if not self.runs:
+            for (first, second), score in sorted(items, key=lambda (pair, score): (-score, pair)):
+                yield (first, second), score
+            return
+
+        sorter = TwitterPairs(tempdir=self.tempdir)
+        while True:
+            block = list(itertools.islice(items, self.limit or None))
+            if not block:
+                break
+            sorter.write(sorted((-score, first, second) for (first, second), score in block))
+
+        for filename in self.runs:
+            os.remove(filename)
+        self.runs = []
+
+        for score, first, second in heapq.merge(*[TwitterPairs.read(filename) for filename in sorter.runs]):
+            yield (first, second), -score
+
+        for filename in sorter.runs:
+            os.remove(filename)
+
+# A graph whose edges are each seen at a series of times with a weight, such as the mentions between users over
+# a run of tweets. Node names are matched regardless of case, and nodes are numbered in order of first appearance.
+# Each spelling of a name is interned once, and each sighting of an edge is kept as its source and target
+# spellings, time and weight in typed arrays, so that memory grows by tens of bytes per sighting. The canonical
+# spelling of a node is its most frequent one.
+class TwitterGraph(object):
+    def __init__(self):
+        self.nodes     = {}                 # Lower case name to node
+        self.names     = []                 # Lower case name of each node
+        self.spellings = {}                 # Spelling to index in spelled
+        self.spelled   = []                 # Each spelling
+        self.spellnode = array.array('l')   # Node of each spelling
+        self.edges     = {}                 # Pair of nodes packed as an int to edge
+        self.pairs     = array.array('l')   # Source and target nodes of each edge, in turn
+
+        # One entry per sighting. Times such as millisecond timestamps can overflow 'l', which is 32 bits on some
+        # platforms, and array has no 64 bit integer type in Python 2, so they are held as doubles, which are exact
+        # for integers below 2**53.
+        self.sources   = array.array('l')
+        self.targets   = array.array('l')
+        self.edgeof    = array.array('l')
+        self.times     = array.array('d')
+        self.weights   = array.array('d')
+
+        # Whether every weight is an int, so that they can be reported as such
+        self.integral  = True
+
+    def spelling(self, name):
+        spelling = self.spellings.get(name)
+        if spelling is None:
+            lower = name.lower()
+            node = self.nodes.get(lower)
+            if node is None:
+                node = self.nodes[lower] = len(self.names)
+                self.names.append(lower)
+
+            spelling = self.spellings[name] = len(self.spelled)
+            self.spelled.append(name)
+            self.spellnode.append(node)
+
+        return spelling
+
+    def add(self, source, target, timestamp, weight=1):
+        source = self.spelling(source)
+        target = self.spelling(target)
+        sourcenode = self.spellnode[source]
+        targetnode = self.spellnode[target]
+        key = sourcenode << 32 | targetnode
+        edge = self.edges.get(key)
+        if edge is None:
+            edge = self.edges[key] = len(self.pairs) // 2
+            self.pairs.append(sourcenode)
+            self.pairs.append(targetnode)
+
+        self.sources.append(source)
+        self.targets.append(target)
+        self.edgeof.append(edge)
+        self.times.append(timestamp)
+        self.weights.append(weight)
+        if self.integral and not isinstance(weight, (int, long)):
+            self.integral = False
+
+    def canonical(self):
+        # Return the canonical spelling of each node, taking the first seen where spellings are equally frequent
+        counts = array.array('l', [0]) * len(self.spelled)
+        for spelling in self.sources:
+            counts[spelling] += 1
+        for spelling in self.targets:
+            counts[spelling] += 1
+
+        best = [None] * len(self.names)
+        for spelling, node in enumerate(self.spellnode):
+            if best[node] is None or counts[spelling] > counts[best[node]]:
+                best[node] = spelling
+
+        return [self.spelled[spelling] for spelling in best]
+
+    @staticmethod
+    def group(keys, count):
+        # Counting sort of keys, which are ints below count. Returns the positions of the keys grouped by key and
+        # otherwise in order, along with where each group starts and ends.
+        offsets = array.array('l', [0]) * (count + 1)
+        for key in keys:
+            offsets[key + 1] += 1
+        for key in range(count):
+            offsets[key + 1] += offsets[key]
+
+        positions = array.array('l', [0]) * len(keys)
+        fill = array.array('l', offsets)
+        for position, key in enumerate(keys):
+            positions[fill[key]] = position
+            fill[key] += 1
+
+        return positions, offsets
+
+    def nodetimes(self):
+        # Generate each node with the times it was seen, as the source then the target of each sighting in turn
+        spellnode = self.spellnode
+        keys = array.array('l', [0]) * (2 * len(self.sources))
+        keys[0::2] = array.array('l', (spellnode[spelling] for spelling in self.sources))
+        keys[1::2] = array.array('l', (spellnode[spelling] for spelling in self.targets))
+
+        positions, offsets = TwitterGraph.group(keys, len(self.names))
+        del keys
+        times = self.times
+        for node in range(len(self.names)):
+            yield node, [int(times[position // 2]) for position in positions[offsets[node]:offsets[node + 1]]]
+
+    def edgetimes(self):
+        # Generate the source and target nodes of each edge with the times and weights of its sightings
+        positions, offsets = TwitterGraph.group(self.edgeof, len(self.pairs) // 2)
+        times   = self.times
+        weights = self.weights
+        weight  = int if self.integral else float
+        for edge in range(len(self.pairs) // 2):
+            sightings = positions[offsets[edge]:offsets[edge + 1]]
+            yield (self.pairs[2 * edge], self.pairs[2 * edge + 1],
+                   [int(times[position]) for position in sightings], [weight(weights[position]) for position in sightings])
+
+# Totals accumulated over a file that only grows at its head, saved along with the id of the newest tweet they
+# cover and the arguments that produced them. A later run with the same arguments need only read the tweets newer
+# than that id, and adds the saved totals to its own. Totals are a list of tables as for TwitterParallel, each a
+# dict or a table of pairs such as TwitterPairs.
+class TwitterState(object):
+    def __init__(self, filename, args):
+        self.filename = filename
+        self.args     = args
+        self.lastid   = None
+
+    # Number of items to pickle at a time
+    BLOCK=10000
+
+    def load(self):
+        # Read the id of the newest tweet covered by the saved totals. Returns False if nothing has been saved.
+        if not os.path.isfile(self.filename):
+            return False
+
+        with open(self.filename, 'rb') as statefile:
+            state = pickle.load(statefile)
+        if state['args'] != self.args:
+            raise RuntimeError("State file: " + self.filename + " was saved with different arguments")
+
+        self.lastid = state['lastid']
+        return True
+
+    def merge(self, totals):
+        # Add the saved totals to the given ones
+        with open(self.filename, 'rb') as statefile:
+            pickle.load(statefile)
+            for total in totals:
+                while True:
+                    block = pickle.load(statefile)
+                    if not block:
+                        break
+                    if isinstance(total, dict):
+                        for key, value in block:
+                            total[key] = total.get(key, 0) + value
+                    else:
+                        for (first, second), value in block:
+                            total.add(first, second, value)
+
+    def save(self, lastid, totals):
+        # Tables are written a block at a time so that a table that has spilled to disk is never all in memory
+        with open(self.filename + '.tmp', 'wb') as statefile:
+            pickle.dump({'args': self.args, 'lastid': lastid}, statefile, pickle.HIGHEST_PROTOCOL)
+            for total in totals:
+                items = total.iteritems()
+                while True:
+                    block = list(itertools.islice(items, self.BLOCK))
+                    pickle.dump(block, statefile, pickle.HIGHEST_PROTOCOL)
+                    if not block:
+                        break
+
+        # Write then rename so that an interruption never leaves a truncated state
+        os.rename(self.filename + '.tmp', self.filename)
+
+# A pool of worker processes that last for a whole run. Rows are handed out in chunks as they are read, and each
+# worker folds them into its own totals with accumulate(row, totals), where totals is a list of dicts mapping keys
+# to numbers. Reading therefore overlaps with the work, with at most about buffer rows, or any number if buffer
+# is zero, waiting for the workers.
+# At the end each worker splits its totals by a hash of the key and passes each share to the worker responsible
+# for it, so that merging is spread across the workers rather than done by a single process. Workers are forked,
+# so accumulate can be any function, including one that refers to variables of the caller. They are started when
+# the first rows are handed out.
+# tables is either the number of dicts in totals, or a list of functions that each make an empty table. A table
+# that spills to disk such as TwitterPairs is passed back whole from each worker, for its runs to be merged.
+class TwitterParallel(object):
+    def __init__(self, jobs, accumulate, tables=1, chunk=1000, buffer=100000):
+        self.jobs       = jobs
+        self.accumulate = accumulate
+        self.tables     = [dict] * tables if isinstance(tables, int) else tables
+        self.chunk      = chunk
+        self.buffer     = buffer
+
+        self.reader  = None
+        self.prepare = None
+        self.workers = None
+
+        # With a single job it is quicker to do the work here
+        if jobs == 1:
+            self.totals = [table() for table in self.tables]
+
+    def start(self):
+        import multiprocessing
+
+        self.tasks   = multiprocessing.Queue(max(self.jobs, self.buffer // self.chunk) if self.buffer else 0)
+        self.shares  = [multiprocessing.Queue() for job in range(self.jobs)]
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=self.work, args=(job,)) for job in range(self.jobs)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def work(self, job):
+        try:
+            totals = [table() for table in self.tables]
+            while True:
+                task = self.tasks.get()
+                if task is None:
+                    break
+
+                # A task is either a chunk of rows or a byte range of the reader's file to read here
+                if isinstance(task, tuple):
+                    self.reader.reopen(*task)
+                    while True:
+                        rows = list(itertools.islice(self.reader, self.chunk))
+                        if not rows:
+                            break
+                        if self.prepare:
+                            rows = self.prepare(rows)
+                        for row in rows:
+                            self.accumulate(row, totals)
+                else:
+                    for row in task:
+                        self.accumulate(row, totals)
+
+            shares = [[{} for table in self.tables] for share in range(self.jobs)]
+            for table, total in enumerate(totals):
+                if isinstance(total, dict):
+                    for key, value in total.iteritems():
+                        shares[hash(key) % self.jobs][table][key] = value
+                else:
+                    total.spill()
+                    shares[job][table] = total
+
+            del totals
+            for share in range(self.jobs):
+                if share != job:
+                    self.shares[share].put(shares[share])
+
+            totals = shares[job]
+            for share in range(self.jobs - 1):
+                for total, received in zip(totals, self.shares[job].get()):
+                    for key, value in received.iteritems():
+                        total[key] = total.get(key, 0) + value
+
+            self.results.put(totals)
+        except Exception:
+            import traceback
+            self.results.put(traceback.format_exc())
+
+    def map(self, rows, prepare=None):
+        # Hand out rows from any iterable. If prepare is given it is applied to each chunk of rows before it is
+        # handed out, and returns the items to be accumulated in their place.
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk))
+            if not chunk:
+                break
+            if prepare:
+                chunk = prepare(chunk)
+
+            if self.jobs == 1:
+                for row in chunk:
+                    self.accumulate(row, self.totals)
+            else:
+                if self.workers is None:
+                    self.start()
+                self.put(chunk)
+
+    def read(self, reader, prepare=None):
+        # Hand out the rows of a TwitterRead. Where its file can be split, each worker reads and parses byte ranges
+        # of the file itself, along with applying prepare, so that rows are neither parsed here nor passed between
+        # processes. Otherwise this is the same as map().
+        spans = reader.ranges(4 * self.jobs) if self.jobs > 1 and self.workers is None else None
+        if not spans:
+            return self.map(reader, prepare)
+
+        self.reader  = reader
+        self.prepare = prepare
+        self.start()
+        for span in spans:
+            self.put(span)
+
+    def put(self, task):
+        # Wait for room in the task queue, watching for a worker that has failed
+        while True:
+            try:
+                self.tasks.put(task, timeout=1)
+                return
+            except queue.Full:
+                try:
+                    self.failed(self.results.get_nowait())
+                except queue.Empty:
+                    pass
+
+    def failed(self, result):
+        for worker in self.workers:
+            worker.terminate()
+
+        # Empty the task queue so that nothing is left waiting to be sent to the workers
+        try:
+            while True:
+                self.tasks.get(timeout=0.1)
+        except queue.Empty:
+            pass
+
+        raise RuntimeError("Worker process failed" + (":\n" + result if isinstance(result, basestring) else "."))
+
+    def reduce(self):
+        # Finish the work and return the merged totals. The workers hold disjoint sets of keys by then, so their
+        # totals only need to be gathered together.
+        if self.jobs == 1:
+            return self.totals
+        if self.workers is None:
+            return [table() for table in self.tables]
+
+        for worker in self.workers:
+            self.put(None)
+
+        totals = [table() for table in self.tables]
+        for count in range(self.jobs):
+            while True:
+                try:
+                    result = self.results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if any(worker.exitcode not in (None, 0) for worker in self.workers):
+                        self.failed(None)
+
+            if not isinstance(result, list):
+                self.failed(result)
+            for total, share in zip(totals, result):
+                if isinstance(total, dict):
+                    total.update(share)
+                else:
+                    total.merge(share)
+
+        for worker in self.workers:
+            worker.join()
+
+        return totals
+
+# Merge tweets from any number of sources (TwitterRead, TwitterFeed or any iterator of rows
+# in descending id order) into a single descending sequence. A heap keyed on tweet id keeps
+# choosing the head source logarithmic in the number of sources. Sources holding the head
+# tweet are 'pacing'; a pacing source that skips the head tweet is reported as missing it,
+# and a blank row in a source (TwitterRead with blanks=True) marks a gap in its coverage.
+@implements_iterator
+class TwitterMerge(object):
+    def __init__(self, verbosity=1, errors=()):
+        self.verbosity = verbosity
+        self.errors    = errors     # Exceptions from reading a source that close it rather than propagate
+        self.error     = False      # Set when a source was closed by one of those exceptions
+
+        self.readers = []
+        self.names   = []
+        self.rows    = []
+        self.rowcnt  = []
+        self.pacing  = set()
+        self.heap    = []
+
+        self.lastid   = None
+        self.lastdate = None
+        self.pending  = False
+
+    def __iter__(self):
+        return self
+
+    @property
+    def head(self):
+        return self.heap[0][1] if self.heap else None
+
+    def add(self, name, reader=None, row=None, rowcnt=0):
+        # Add a source and return its index. If no first row is given it is read from the reader.
+        # A source added without a reader is idle until it is opened.
+        idx = len(self.readers)
+        self.readers += [None]
+        self.names   += [name]
+        self.rows    += [None]
+        self.rowcnt  += [rowcnt]
+        if reader is not None:
+            self.open(idx, reader, row)
+
+        return idx
+
+    def open(self, idx, reader, row=None, pacing=False):
+        if self.readers[idx] is not None:
+            self.close(idx)
+
+        self.readers[idx] = reader
+        if row is None or row['id'] is None:
+            row = self.read(idx)
+        if row is None:
+            self.end(idx)
+            return
+
+        self.rows[idx] = row
+        heapq.heappush(self.heap, (-row['id'], idx))
+        if pacing:
+            self.pacing.add(idx)
+
+    def close(self, idx):
+        if self.rows[idx] is not None:
+            self.heap.remove((-self.rows[idx]['id'], idx))
+            heapq.heapify(self.heap)
+
+        self.readers[idx] = None
+        self.rows[idx]    = None
+        self.rowcnt[idx]  = 0
+        self.pacing.discard(idx)
+
+    def end(self, idx):
+        if self.verbosity >= 2:
+            sys.stderr.write("End of " + self.names[idx] + '\n')
+        if self.verbosity >= 1:
+            sys.stderr.write("Closing " + self.names[idx] + " after " + str(self.rowcnt[idx]) + " rows.\n")
+
+        self.close(idx)
+
+    def read(self, idx):
+        # Read the next row from a source, skipping leading blank rows.
+        while True:
+            try:
+                row = next(self.readers[idx])
+            except StopIteration:
+                return None
+            except self.errors as err:
+                self.error = True
+                if self.verbosity >= 2:
+                    sys.stderr.write(str(err) + '\n')
+                return None
+
+            if row['id'] is not None:
+                if self.verbosity >= 2:
+                    sys.stderr.write("Read id: " + str(row['id']) + " from " + self.names[idx] + '\n')
+                return row
+
+    def matching(self, id):
+        # Indexes of the sources whose current row has the given id, found by descending only
+        # the part of the heap that holds ids no lower than it.
+        matches = []
+        stack = [0]
+        while stack:
+            pos = stack.pop()
+            if pos < len(self.heap) and self.heap[pos][0] <= -id:
+                if self.heap[pos][0] == -id:
+                    matches += [self.heap[pos][1]]
+                stack += [2 * pos + 1, 2 * pos + 2]
+
+        return matches
+
+    def pace(self):
+        # Mark every source holding the head tweet as pacing, typically once all sources are added.
+        if self.heap:
+            for idx in self.matching(-self.heap[0][0]):
+                if idx not in self.pacing:
+                    if self.verbosity >= 2:
+                        sys.stderr.write(self.names[idx] + " is pacing\n")
+                    self.pacing.add(idx)
+
+    def advance(self):
+        # Consume the head tweet from every source that holds it.
+        headidx = self.head
+        self.lastid   = self.rows[headidx]['id']
+        self.lastdate = self.rows[headidx]['date']
+        self.rowcnt[headidx] += 1
+
+        advanced = []
+        gaps = []
+        while self.heap and self.heap[0][0] == -self.lastid:
+            idx = heapq.heappop(self.heap)[1]
+            try:
+                row = next(self.readers[idx])
+            except StopIteration:
+                row = None
+            except self.errors as err:
+                self.error = True
+                row = None
+                if self.verbosity >= 2:
+                    sys.stderr.write(str(err) + '\n')
+
+            if row is None:
+                self.rows[idx] = None
+                self.end(idx)
+            elif row['id'] is None:
+                self.rows[idx] = None
+                gaps += [idx]
+                if self.verbosity >= 1:
+                    sys.stderr.write(self.names[idx] + " has gap after id:" + str(self.lastid) + " - " + self.lastdate.isoformat() + '\n')
+            else:
+                if self.verbosity >= 2:
+                    sys.stderr.write("Read id: " + str(row['id']) + " from " + self.names[idx] + '\n')
+                self.rows[idx] = row
+                heapq.heappush(self.heap, (-row['id'], idx))
+                advanced += [idx]
+
+        # Sources are compared against the head as it stands before those with gaps rejoin
+        headid = -self.heap[0][0] if self.heap else None
+
+        # A source resuming after a gap cannot be pacing until it has caught up with the head.
+        for idx in gaps:
+            self.pacing.discard(idx)
+            row = self.read(idx)
+            if row is None:
+                self.end(idx)
+            else:
+                self.rows[idx] = row
+                heapq.heappush(self.heap, (-row['id'], idx))
+
+        for idx in list(self.pacing):
+            if self.rows[idx]['id'] != headid:
+                sys.stderr.write("WARNING: Missing tweet, id: " + str(headid) + " in file: " + self.names[idx] + '\n')
+                self.pacing.discard(idx)
+
+        if headid is not None:
+            for idx in self.matching(headid):
+                if idx not in self.pacing:
+                    if self.verbosity >= 2:
+                        sys.stderr.write(self.names[idx] + " now pacing.\n")
+                    self.pacing.add(idx)
+
+        if self.verbosity >= 2:
+            sys.stderr.write("Head input is " + (self.names[self.head] if self.head is not None else 'empty') + '\n')
+
+    def __next__(self):
+        # Plain iteration over the merged tweets, for callers that do not need to intervene
+        # between consuming one tweet and choosing the next.
+        if self.pending:
+            self.advance()
+        if self.head is None:
+            raise StopIteration
+
+        self.pending = True
+        return self.rows[self.head]
+
+# Calls to the Twitter API spread across several sets of credentials, each a twitter.Api made without
+# sleep_on_rate_limit. Up to inflight calls run at once on threads, each with the credentials that have the most
+# calls left in the endpoint's rate limit window, going by the headers of their last response. Once every set of
+# credentials is used up, calls wait for the first window to reset. map() hands back results in the order that
+# the items were read, holding early results in a reorder buffer.
+# For endpoints that give no rate limit headers, calls on each set of credentials can be spaced at least interval
+# seconds apart. If backoff is given, calls that fail for a passing reason, such as a network or server error, are
+# also retried, waiting backoff seconds and doubling the wait each time.
+class TwitterApi(object):
+    def __init__(self, apis, endpoint, inflight=4, retry=5, interval=0, backoff=None, verbosity=1):
+        self.apis      = apis
+        self.endpoint  = endpoint
+        self.inflight  = inflight
+        self.retry     = retry
+        self.interval  = interval
+        self.backoff   = backoff
+        self.verbosity = verbosity
+
+        self.lock      = threading.Condition()
+        self.remaining = [0] * len(apis)
+        self.reset     = [0] * len(apis)
+        self.due       = [0] * len(apis)
+        self.busy      = [0] * len(apis)
+        self.stop      = threading.Event()
+
+    # Rate limit window in seconds, assumed when a rate limit error comes without a reset time
+    WINDOW=900
+
+    @staticmethod
+    def credentials(filename):
+        # Make a twitter.Api for each line of a file giving a consumer key and secret, followed by an access token
+        # key and secret unless the credentials are for application-only authentication.
+        import twitter
+
+        apis = []
+        with open(filename, 'r') as credentialfile:
+            for line in credentialfile:
+                fields = line.split()
+                if not fields or fields[0][:1] == '#':
+                    continue
+
+                if len(fields) == 2:
+                    apis.append(twitter.Api(consumer_key=fields[0], consumer_secret=fields[1],
+                                            application_only_auth=True))
+                elif len(fields) == 4:
+                    apis.append(twitter.Api(consumer_key=fields[0], consumer_secret=fields[1],
+                                            access_token_key=fields[2], access_token_secret=fields[3]))
+                else:
+                    raise RuntimeError("Credentials file: " + filename + " has a line without two or four fields")
+
+        return apis
+
+    @staticmethod
+    def codes(error):
+        # The set of Twitter error codes in a TwitterError, empty if it has none
+        if not isinstance(error.message, list):
+            return set()
+        return set(message.get('code') for message in error.message if isinstance(message, dict))
+
+    @staticmethod
+    def ratelimited(error):
+        return 88 in TwitterApi.codes(error)
+
+    # Error codes for Twitter being over capacity or failing internally
+    SERVERERRORS={130, 131}
+
+    @staticmethod
+    def transient(error):
+        # Whether an error might not happen again: a network error, or a server error, which is either one of
+        # SERVERERRORS or a response that is not the JSON error codes that Twitter gives for a bad request.
+        import twitter
+
+        if not isinstance(error, twitter.error.TwitterError):
+            return True
+        codes = TwitterApi.codes(error)
+        return not codes or bool(codes & TwitterApi.SERVERERRORS)
+
+    def acquire(self):
+        # Claim the credentials with the most calls left, counting a window that has reset or that no response
+        # has reported on yet as unlimited, and among those the least busy.
+        with self.lock:
+            while True:
+                now = time.time()
+                best = None
+                for index in range(len(self.apis)):
+                    if self.due[index] > now:
+                        continue
+                    left = (self.remaining[index] if self.reset[index] > now else float('inf')) - self.busy[index]
+                    if left > 0 and (best is None or (left, -self.busy[index]) > (bestleft, -self.busy[best])):
+                        best, bestleft = index, left
+
+                if best is not None:
+                    self.busy[best] += 1
+                    self.due[best] = now + self.interval
+                    return best
+
+                if self.stop.is_set():
+                    raise RuntimeError("Twitter API calls stopped.")
+
+                wait = min(max(self.reset[index], self.due[index]) for index in range(len(self.apis))) - now
+                if self.verbosity >= 2 and wait >= 1:
+                    sys.stderr.write("Waiting " + str(int(wait)) + " seconds for rate limit.\n")
+                self.lock.wait(min(max(wait, 0.01), 60))
+
+    def release(self, index, limited=False):
+        with self.lock:
+            self.busy[index] -= 1
+            api = self.apis[index]
+            try:
+                limit = api.rate_limit.get_limit(api.base_url + self.endpoint)
+                if int(limit.reset) > 0:
+                    self.remaining[index] = int(limit.remaining)
+                    self.reset[index]     = int(limit.reset)
+            except (AttributeError, KeyError, TypeError, ValueError):
+                pass
+
+            if limited:
+                self.remaining[index] = 0
+                if self.reset[index] <= time.time():
+                    self.reset[index] = time.time() + TwitterApi.WINDOW
+
+            self.lock.notify_all()
+
+    def call(self, function, item):
+        # Return function(api, item), retrying with other credentials or after waiting when rate limited
+        import twitter
+
+        retry = self.retry
+        wait  = self.backoff
+        while True:
+            index = self.acquire()
+            limited = False
+            try:
+                return function(self.apis[index], item)
+            except (twitter.error.TwitterError, IOError) as error:
+                limited = isinstance(error, twitter.error.TwitterError) and TwitterApi.ratelimited(error)
+                if not (limited or (self.backoff is not None and TwitterApi.transient(error))) or retry == 0:
+                    raise
+                retry -= 1
+                if self.verbosity >= 2:
+                    sys.stderr.write("Retrying after twitter error: " + str(error) + '\n')
+            finally:
+                self.release(index, limited)
+
+            if not limited:
+                time.sleep(wait)
+                wait *= 2
+
+    def map(self, function, items, skip=None, errors=()):
+        # Generate each item along with function(api, item). Items are read on a thread of their own, no more than
+        # four times inflight ahead of the one to be handed back next. An error from a call or from reading the
+        # items is raised in its turn, unless it is a call's error of one of the types in errors, which is handed
+        # back in place of the result. An item for which skip(item) is true is handed back with None, without
+        # waiting for any credentials.
+        tasks = queue.Queue()
+        slots = threading.Semaphore(4 * self.inflight)
+        done  = {}
+        count = []
+        self.stop.clear()
+
+        def feed():
+            sequence = 0
+            try:
+                for item in items:
+                    slots.acquire()
+                    if self.stop.is_set():
+                        return
+                    tasks.put((sequence, item))
+                    sequence += 1
+            except Exception as error:
+                with self.lock:
+                    done[sequence] = (None, None, error)
+                    sequence += 1
+
+            with self.lock:
+                count.append(sequence)
+                self.lock.notify_all()
+            for worker in range(self.inflight):
+                tasks.put(None)
+
+        def work():
+            while True:
+                task = tasks.get()
+                if task is None or self.stop.is_set():
+                    break
+
+                sequence, item = task
+                try:
+                    result = (item, None if skip and skip(item) else self.call(function, item), None)
+                except errors as error:
+                    result = (item, error, None)
+                except Exception as error:
+                    result = (item, None, error)
+
+                with self.lock:
+                    done[sequence] = result
+                    self.lock.notify_all()
+
+        threads = [threading.Thread(target=feed)] + [threading.Thread(target=work) for worker in range(self.inflight)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            sequence = 0
+            while True:
+                with self.lock:
+                    while sequence not in done and not (count and sequence >= count[0]):
+                        self.lock.wait(1)
+                    if sequence not in done:
+                        return
+
+                    item, result, error = done.pop(sequence)
+
+                slots.release()
+                if error is not None:
+                    raise error
+
+                yield item, result
+                sequence += 1
+        finally:
+            # Let the threads finish any calls they have started, but nothing more
+            self.stop.set()
+            slots.release()
+            for worker in range(self.inflight):
+                tasks.put(None)
+            with self.lock:
+                self.lock.notify_all()
+            for thread in threads:
+                thread.join()
+
+# A single file cache of hydrated tweets and their oEmbed HTML keyed by tweet id, so that tweets fetched by an
+# earlier run need not be fetched again. The retweet and favorite counts of a tweet go on changing, so when fresh
+# counts are wanted a tweet fetched more than ttl seconds ago counts as missing. The cache holds at most size
+# tweets, evicting those least recently used.
+# The profile banners of users are cached alongside, keyed by a user id or by @ and a lower case screen name, and
+# count as missing once fetched more than ttl seconds ago. A user found to have no banner is cached as None.
+class TwitterCache(object):
+    def __init__(self, filename, ttl=None, size=None):
+        import sqlite3
+
+        self.filename = filename
+        self.ttl      = ttl
+        self.size     = size
+
+        # Lookups can come from the thread that reads the input as well as the main thread
+        self.lock = threading.Lock()
+        self.db   = sqlite3.connect(filename, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, fields TEXT, fetched REAL, html TEXT, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tweetsused ON tweets (used)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS banners (user TEXT PRIMARY KEY, banner TEXT, fetched REAL, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS bannersused ON banners (used)')
+
+    # Fields of a hydrated tweet, as written by twitterHydrate
+    FIELDS=['user', 'date', 'text', 'reply-to', 'reply-to-user', 'reply-to-user-id', 'retweets', 'favorites', 'lang', 'geo', 'mentions', 'hashtags', 'user-id']
+
+    # Number of ids to look up in a single query, below the limit on query parameters
+    BLOCK=500
+
+    @staticmethod
+    def status(tweet):
+        # The fields of a twitter.Status
+        return {'user':             tweet.user.screen_name,
+                'date':             datetime.utcfromtimestamp(tweet.created_at_in_seconds).isoformat(),
+                'text':             tweet.text,
+                'reply-to':         tweet.in_reply_to_status_id,
+                'reply-to-user':    tweet.in_reply_to_screen_name,
+                'reply-to-user-id': tweet.in_reply_to_user_id,
+                'retweets':         tweet.retweet_count,
+                'favorites':        tweet.favorite_count,
+                'lang':             tweet.lang,
+                'geo':              tweet.geo,
+                'mentions':         u' '.join([u'@'+user.screen_name for user in tweet.user_mentions]),
+                'hashtags':         u' '.join([u'#'+hashtag.text for hashtag in tweet.hashtags]),
+                'user-id':          tweet.user.id}
+
+    def lookup(self, column, ids, since=None, table='tweets', key='id'):
+        # Dict of column by id for those of ids that are cached with the column filled, marking them as used
+        ids = list(set(ids))
+        found = {}
+        with self.lock, self.db:
+            for start in range(0, len(ids), self.BLOCK):
+                block = ids[start:start+self.BLOCK]
+                query = 'SELECT ' + key + ', ' + column + ' FROM ' + table + ' WHERE ' + column + ' IS NOT NULL AND ' + key + ' IN (' + ','.join('?' * len(block)) + ')'
+                if since is not None:
+                    query += ' AND fetched >= ' + repr(since)
+                found.update(self.db.execute(query, block))
+
+            now = time.time()
+            self.db.executemany('UPDATE ' + table + ' SET used = ? WHERE ' + key + ' = ?', [(now, id) for id in found])
+
+        return found
+
+    def get(self, ids, fresh=False):
+        # Dict of the fields of those of ids that are cached, leaving out any with stale counts if fresh is true
+        since = time.time() - self.ttl if fresh and self.ttl is not None else None
+        return {id: json.loads(fields) for id, fields in self.lookup('fields', ids, since).items()}
+
+    def html(self, ids):
+        # Dict of the oEmbed HTML of those of ids that are cached
+        return self.lookup('html', ids)
+
+    def banners(self, users):
+        # Dict of the profile banners of those of users that were cached within ttl
+        since = time.time() - self.ttl if self.ttl is not None else None
+        return {user: json.loads(banner) for user, banner in self.lookup('banner', users, since, table='banners', key='user').items()}
+
+    def put(self, statuses):
+        # Cache a dict of the fields of tweets by id, keeping any HTML already cached
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO tweets (id, fields, fetched, html, used) '
+                                'VALUES (?, ?, ?, (SELECT html FROM tweets WHERE id = ?), ?)',
+                                [(id, json.dumps(fields), now, id, now) for id, fields in statuses.items()])
+            self.evict()
+
+    def puthtml(self, htmls):
+        # Cache a dict of oEmbed HTML by id, keeping any fields already cached
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO tweets (id, fields, fetched, html, used) '
+                                'VALUES (?, (SELECT fields FROM tweets WHERE id = ?), (SELECT fetched FROM tweets WHERE id = ?), ?, ?)',
+                                [(id, id, id, html, now) for id, html in htmls.items()])
+            self.evict()
+
+    def putbanners(self, banners):
+        # Cache a dict of profile banners by user
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany('INSERT OR REPLACE INTO banners (user, banner, fetched, used) VALUES (?, ?, ?, ?)',
+                                [(user, json.dumps(banner), now, now) for user, banner in banners.items()])
+            self.evict('banners', 'user')
+
+    def evict(self, table='tweets', key='id'):
+        if self.size is not None:
+            excess = self.db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0] - self.size
+            if excess > 0:
+                self.db.execute('DELETE FROM ' + table + ' WHERE ' + key + ' IN (SELECT ' + key + ' FROM ' + table + ' ORDER BY used LIMIT ?)', (excess,))
+
+    def close(self):
+        self.db.close()
@@ -26,8 +26,12 @@ import os
 import shutil
 import unicodecsv
 import re
+import itertools
+import collections
+import tempfile
 from dateutil import parser as dateparser
 import datetime
+from TwitterFeed import TwitterApi, TwitterCache
 
 MENTIONREGEXP=re.compile(r'(@\w+)', re.UNICODE)
 HASHTAGREGEXP=re.compile(r'(#\w+)', re.UNICODE)
@@ -52,6 +56,13 @@ def twitterBanner(arglist):
     parser.add_argument('--access-token-secret', type=str,
                         help='Access token secret for Twitter authentication')
 
+    parser.add_argument(      '--credentials', type=str, help='File of further credentials to share the work, one set per line: consumer key and secret, then access token key and secret')
+    parser.add_argument(      '--inflight',   type=int, default=4, help='Number of lookups to run at once across all credentials')
+
+    parser.add_argument(      '--cache',      type=str, help='File of banners retrieved by earlier runs, to look up before calling Twitter')
+    parser.add_argument(      '--cache-ttl',  type=float, default=168, help='Hours after which cached banners are retrieved again')
+    parser.add_argument(      '--cache-size', type=int, default=1000000, help='Maximum number of users to keep in the cache')
+
     parser.add_argument('-s', '--size', type=str, default='300x100', help='Banner size to fetch')
 
     parser.add_argument('-l', '--limit', type=int, help='Limit number of tweets to process')
@@ -63,10 +74,14 @@ def twitterBanner(arglist):
     parser.add_argument('infile', type=str, nargs='?', help='Input CSV user file, otherwise use stdin')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'no_comments']
+    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'credentials', 'inflight', 'cache', 'cache_ttl', 'cache_size', 'no_comments']
 
+    # Rows are read twice, once for the users to look up and again to write them out, so standard input is
+    # first copied to a temporary file
     if args.infile is None:
-        infile = sys.stdin
+        infile = tempfile.TemporaryFile()
+        shutil.copyfileobj(sys.stdin, infile)
+        infile.seek(0)
     else:
         infile = file(args.infile, 'rU')
 
@@ -80,7 +95,11 @@ def twitterBanner(arglist):
             infieldnames = next(unicodecsv.reader([line]))
             break
 
-    inreader=unicodecsv.DictReader(infile, fieldnames=infieldnames)
+    datastart = infile.tell()
+    def inrows():
+        infile.seek(datastart)
+        inreader=unicodecsv.DictReader(infile, fieldnames=infieldnames)
+        return itertools.islice(inreader, args.limit) if args.limit else inreader
 
     if args.outfile is None:
         outfile = sys.stdout
@@ -113,7 +132,7 @@ def twitterBanner(arglist):
 
         outfile.write(comments + incomments)
 
-    outunicodecsv=unicodecsv.DictWriter(outfile, fieldnames=inreader.fieldnames+ ['banner_url'], extrasaction='ignore', lineterminator=os.linesep)
+    outunicodecsv=unicodecsv.DictWriter(outfile, fieldnames=infieldnames + ['banner_url'], extrasaction='ignore', lineterminator=os.linesep)
     if not args.no_header:
         outunicodecsv.writeheader()
 
@@ -150,30 +169,72 @@ def twitterBanner(arglist):
                 consumer_key=args.consumer_key,
                 consumer_secret=args.consumer_secret,
                 access_token_key=args.access_token_key,
-                access_token_secret=args.access_token_secret,
-                sleep_on_rate_limit=True
+                access_token_secret=args.access_token_secret
         )
 
+    # Rate limits are handled by spreading lookups across the credentials rather than by sleeping
+    apis = [api] + (TwitterApi.credentials(args.credentials) if args.credentials else [])
+
     if args.verbosity >= 2:
         print("Loading tweets.", file=sys.stderr)
 
-    for row in inreader:
-        try:
-            if 'id' in row.keys():
-                userdata  = api.GetProfileBanner(user_id=row['id'])
-            else:
-                userdata  = api.GetProfileBanner(screen_name=row['screen_name'])
+    # Users are looked up by id if there is one, otherwise by screen name, which is not case sensitive
+    def user(row):
+        return row['id'] if 'id' in row.keys() else '@' + row['screen_name'].lower()
+
+    users = collections.OrderedDict()
+    rowcount = 0
+    for row in inrows():
+        users[user(row)] = None
+        rowcount += 1
+
+    cache = TwitterCache(args.cache, ttl=args.cache_ttl * 3600, size=args.cache_size) if args.cache else None
+    banners = cache.banners(users) if cache else {}
+    missing = [key for key in users if key not in banners]
+    if args.verbosity >= 1:
+        print("Retrieving banners for " + str(len(missing)) + " of " + str(len(users)) + " users in " + str(rowcount) + " rows.", file=sys.stderr)
+
+    def banner(api, key):
+        if key[:1] == '@':
+            return api.GetProfileBanner(screen_name=key[1:])
+        else:
+            return api.GetProfileBanner(user_id=key)
 
-            row['banner_url'] = userdata[args.size]['url']
+    # Errors meaning that the page does not exist, the user does not exist, or the user is suspended
+    NOBANNER = {34, 50, 63}
 
-        except twitter.error.TwitterError as error:
+    lookup = TwitterApi(apis, '/users/profile_banner.json', inflight=args.inflight, verbosity=args.verbosity)
+    fetched = {}
+    for key, userdata in lookup.map(banner, missing, errors=(twitter.error.TwitterError,)):
+        if isinstance(userdata, Exception):
             if args.verbosity >= 2:
                 print("Error retrieving banner for ",
-                      ("id " + row['id']) if 'id' in row.keys() else ("screen name " + str(row['screen_name'])),
+                      ("screen name " + key[1:]) if key[:1] == '@' else ("id " + key),
                       file=sys.stderr)
 
+            # Only remember that there is no banner, not that Twitter could not say
+            banners[key] = None
+            if not TwitterApi.codes(userdata) & NOBANNER:
+                continue
+            userdata = None
+
+        banners[key] = fetched[key] = userdata
+        if cache and len(fetched) == 100:
+            cache.putbanners(fetched)
+            fetched = {}
+
+    if cache:
+        cache.putbanners(fetched)
+        cache.close()
+
+    for row in inrows():
+        userdata = banners[user(row)]
+        if userdata and args.size in userdata:
+            row['banner_url'] = userdata[args.size]['url']
+
         outunicodecsv.writerow(row)
 
+    infile.close()
     outfile.close()
 
 if __name__ == '__main__':
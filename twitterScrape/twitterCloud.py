@@ -19,11 +19,10 @@
 from __future__ import print_function
 import argparse
 import sys
-from TwitterFeed import TwitterRead
+import operator
+from TwitterFeed import TwitterRead, TwitterExpression, TwitterParallel, TwitterState
 import string
 import unicodedata
-import re
-import pymp
 from dateutil import parser as dateparser
 from wordcloud import WordCloud
 
@@ -33,13 +32,15 @@ def twitterCloud(arglist):
 
     parser.add_argument('-v', '--verbosity', type=int, default=1)
     parser.add_argument('-j', '--jobs',      type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of tweets to process per batch. Use to limit memory usage with very large files. May affect performance but not results.')
+    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of tweets to read ahead of the worker processes, or zero for unlimited. May affect performance but not results. Use to limit memory usage with very large files.')
+    parser.add_argument(      '--vectorize',  action='store_true', help='Evaluate filter expression over chunks of tweets using NumPy where possible. May affect performance but not results.')
 
     parser.add_argument('-p', '--prelude',    type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',     type=str, help='Python expression evaluated to determine whether tweet is included')
     parser.add_argument(      '--since',      type=str, help='Lower bound tweet date/time in any sensible format.')
     parser.add_argument(      '--until',      type=str, help='Upper bound tweet date/time in any sensible format.')
     parser.add_argument('-l', '--limit',     type=int, help='Limit number of tweets to process')
+    parser.add_argument(      '--state',     type=str, help='File of word scores saved by an earlier run, to which only newer tweets are added before saving them again')
 
     parser.add_argument('-c', '--column',    type=str, default='text', help='Text column')
     parser.add_argument('-s', '--score',     type=str,                 help='Comma separated list of score columns')
@@ -64,9 +65,6 @@ def twitterCloud(arglist):
     if args.verbosity >= 1:
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
-    if args.batch == 0:
-        args.batch = sys.maxint
-
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
@@ -79,11 +77,22 @@ def twitterCloud(arglist):
 
     twitterread  = TwitterRead(args.infile, since=since, until=until, limit=args.limit)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
+    # Only read tweets newer than those already covered by the saved word scores
+    if args.state:
+        if args.infile is None or args.limit:
+            raise RuntimeError("State file requires an input file and no limit.")
+
+        state = TwitterState(args.state, {arg: getattr(args, arg) for arg in ['prelude', 'filter', 'since', 'until', 'column', 'score', 'exclude', 'mode']})
+        headid = twitterread.headid()
+        if state.load():
+            if args.verbosity >= 1:
+                print("Adding tweets after id: " + str(state.lastid) + " to saved word scores.", file=sys.stderr)
+            twitterread.where('id', operator.gt, state.lastid, bounds=True)
+
     if args.filter:
-        exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.filter in locals()
+        filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+        filterexpression.pushdown(twitterread)
+        evalfilter = filterexpression.evaluate
 
     from nltk.corpus import stopwords
     exclude = set(stopwords.words('english'))
@@ -99,72 +108,51 @@ def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
         from nltk.tokenize import RegexpTokenizer
         tokenizer=RegexpTokenizer(r'https?://[^"\' ]+|[@|#]?\w+')
 
+    def accumulate(row, totals):
+        scoredict, = totals
+        if args.filter and not args.vectorize and not evalfilter(row):
+            return
+
+        text = row[args.column]
+        if args.mode == 'textblob':
+            textblob = TextBlob(text, tokenizer=tokenizer)
+            wordlist = []
+            for word in textblob.tokens:
+                if word.isalpha():
+                    lemma = word.lemmatize()
+                    if lemma.lower() not in exclude:
+                        wordlist += [lemma]
+        elif args.mode == 'word':
+            wordlist = [word for word in text.split() if word.lower() not in exclude]
+        else:
+            wordlist = [text]
+
+        for word in wordlist:
+            if score is None:
+                wordscore = 1
+            else:
+                wordscore = 0
+                for col in score:
+                    wordscore += int(row[col])
+
+            scoredict[word] = scoredict.get(word, 0) + wordscore
+
     if args.verbosity >= 1:
         print("Loading twitter data.", file=sys.stderr)
 
-    mergedscoredicts = {}
-    while True:
-        if args.verbosity >= 2:
-            print("Loading twitter batch.", file=sys.stderr)
-
-        rows = []
-        batchcount = 0
-        while batchcount < args.batch:
-            try:
-                rows.append(next(twitterread))
-                batchcount += 1
-            except StopIteration:
-                break
-
-        if batchcount == 0:
-            break
-
-        if args.verbosity >= 2:
-            print("Processing twitter batch.", file=sys.stderr)
-
-        rowcount = len(rows)
-
-        scoredicts = pymp.shared.list()
-        with pymp.Parallel(args.jobs) as p:
-            scoredict = {}
-            for rowindex in p.range(0, rowcount):
-                row = rows[rowindex]
-                if args.filter:
-                    rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-                    if not evalfilter(**rowargs):
-                        continue
-
-                text = row[args.column]
-                if args.mode == 'textblob':
-                    textblob = TextBlob(text, tokenizer=tokenizer)
-                    wordlist = []
-                    for word in textblob.tokens:
-                        if word.isalpha():
-                            lemma = word.lemmatize()
-                            if lemma.lower() not in exclude:
-                                wordlist += [lemma]
-                elif args.mode == 'word':
-                    wordlist = [word for word in text.split() if word.lower() not in exclude]
-                else:
-                    wordlist = [text]
-
-                for word in wordlist:
-                    if score is None:
-                        wordscore = 1
-                    else:
-                        wordscore = 0
-                        for col in score:
-                            wordscore += int(row[col])
-
-                    scoredict[word] = scoredict.get(word, 0) + wordscore
-
-            with p.lock:
-                scoredicts += [scoredict]
-
-        for scoredict in scoredicts:
-            for index in scoredict:
-                mergedscoredicts[index] = mergedscoredicts.get(index, 0) + scoredict[index]
+    parallel = TwitterParallel(args.jobs, accumulate, buffer=args.batch)
+    if args.vectorize and args.filter:
+        # Evaluate the filter over a chunk of tweets at a time
+        parallel.read(twitterread, lambda rows: [row for row, keep in zip(rows, filterexpression.evaluatebatch(rows, truth=True)) if keep])
+    else:
+        parallel.read(twitterread)
+
+    mergedscoredicts, = parallel.reduce()
 
+    if args.state:
+        if state.lastid is not None:
+            state.merge([mergedscoredicts])
+        state.save(max(headid, state.lastid), [mergedscoredicts])
     mergedscoredicts = mergedscoredicts.items()
 
     if args.verbosity >= 1:
@@ -22,9 +22,11 @@ from requests_oauthlib import OAuth1Session
 import twitter
 import os
 import sys
-from TwitterFeed import TwitterRead, TwitterWrite
+from TwitterFeed import TwitterRead, TwitterWrite, TwitterCache, TwitterApi
 import unicodecsv
 import re
+import itertools
+from dateutil import parser as dateparser
 
 def twitterEmbed(arglist):
 
@@ -45,6 +47,14 @@ def twitterEmbed(arglist):
     parser.add_argument(      '--until',      type=str, help='Upper bound tweet date/time in any sensible format.')
     parser.add_argument('-l', '--limit',      type=int, help='Limit number of tweets to process')
 
+    parser.add_argument(      '--inflight',   type=int, default=8, help='Number of requests to run at once')
+    parser.add_argument(      '--rate',       type=float, default=10, help='Maximum number of requests per second')
+    parser.add_argument(      '--retry',      type=int, default=3, help='Number of times to retry a failed request')
+    parser.add_argument(      '--backoff',    type=float, default=1, help='Seconds to wait before the first retry, doubling for each further retry')
+
+    parser.add_argument(      '--cache',      type=str, help='File of tweets hydrated by earlier runs, to look up before calling Twitter')
+    parser.add_argument(      '--cache-size', type=int, default=1000000, help='Maximum number of tweets to keep in the cache')
+
     parser.add_argument('-o', '--outfile', type=str, help='Output CSV file, otherwise use stdout')
     parser.add_argument('--overwrite',     action='store_true', help='Overwrite input fields with hydrated data')
     parser.add_argument('--no-comments',   action='store_true', help='Do not output descriptive comments')
@@ -53,7 +63,7 @@ def twitterEmbed(arglist):
     parser.add_argument('infile', type=str, nargs='?', help='Input CSV file, otherwise use stdin')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'no_comments']
+    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'inflight', 'rate', 'retry', 'backoff', 'cache', 'cache_size', 'no_comments']
 
     until = dateparser.parse(args.until) if args.until else None
     since = dateparser.parse(args.since) if args.since else None
@@ -82,27 +92,57 @@ def twitterEmbed(arglist):
                 elif val is not None:
                     comments += '#     --' + arg + '=' + str(val) + '\n'
 
-        comment += twitterread.comments
+        comments += twitterread.comments
 
     api = twitter.Api()
 
     fieldnames = twitterread.fieldnames
     if 'html' not in fieldnames:
         fieldnames.append('html')
+    if 'html_error' not in fieldnames:
+        fieldnames.append('html_error')
 
     twitterwrite = TwitterWrite(args.outfile, comments=comments, fieldnames=fieldnames, header=not args.no_header)
 
-    for row in twitterread:
-        try:
-            row['html'] = api.GetStatusOembed(row['id'])['html']
-        except twitter.TwitterError as err:
-            if args.verbosity >= 1:
-                print("Failed to retrieve HTML for tweet id: " + str(row['id']))
-                print(err)
-
-            continue
-
+    cache = TwitterCache(args.cache, size=args.cache_size) if args.cache else None
+
+    def rows():
+        # Pair each row with its cached HTML, looking up a block of rows at a time
+        while True:
+            block = list(itertools.islice(twitterread, 100))
+            if len(block) == 0:
+                break
+
+            htmls = cache.html([row['id'] for row in block]) if cache else {}
+            for row in block:
+                yield row, htmls.get(row['id'])
+
+    # Requests all go to the one oEmbed host, so are spaced to keep within the rate between them
+    oembed = TwitterApi([api], '/statuses/oembed.json', inflight=args.inflight, retry=args.retry,
+                        interval=1.0 / args.rate, backoff=args.backoff, verbosity=args.verbosity)
+    for (row, html), result in oembed.map(lambda api, item: api.GetStatusOembed(item[0]['id'])['html'], rows(),
+                                          skip=lambda item: item[1] is not None,
+                                          errors=(twitter.TwitterError, IOError)):
+        if html is None:
+            if isinstance(result, Exception):
+                if args.verbosity >= 1:
+                    print("Failed to retrieve HTML for tweet id: " + str(row['id']), file=sys.stderr)
+                    print(result, file=sys.stderr)
+
+                row['html_error'] = str(result)
+            else:
+                html = result
+                if cache:
+                    cache.puthtml({row['id']: html})
+
+        if html is not None:
+            row['html_error'] = ''
+        row['html'] = html
         twitterwrite.write(row)
 
+    twitterwrite.close()
+    if cache:
+        cache.close()
+
 if __name__ == '__main__':
     twitterEmbed(None)
@@ -21,12 +21,10 @@ import argparse
 import sys
 import os
 import shutil
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterExpression
 import unicodecsv
 import string
 import unicodedata
-import pymp
-import re
 import datetime
 from dateutil import parser as dateparser
 from pytimeparse.timeparse import timeparse
@@ -37,6 +35,9 @@ def twitterFrequency(arglist):
                                      fromfile_prefix_chars='@')
 
     parser.add_argument('-v', '--verbosity',  type=int, default=1)
+    parser.add_argument('-j', '--jobs',       type=int, help='Number of processes parsing the input file, default is number of CPUs')
+    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of tweets to evaluate per batch with --vectorize, or zero for unlimited. May affect performance but not results.')
+    parser.add_argument(      '--vectorize',  action='store_true', help='Evaluate filter and score expressions over each batch using NumPy where possible. May affect performance but not results.')
 
     parser.add_argument('-p', '--prelude',    type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',     type=str, nargs='+', required=True, help='Python expression evaluated to determine whether tweet is included')
@@ -54,10 +55,20 @@ def twitterFrequency(arglist):
     parser.add_argument('--no-header',        action='store_true', help='Do not output CSV header with column names')
 
     parser.add_argument('infile', type=str, nargs='?', help='Input CSV file, otherwise use stdin.')
-    hiddenargs = ['verbosity', 'no_comments']
+    hiddenargs = ['verbosity', 'jobs', 'batch', 'vectorize', 'no_comments']
 
     args = parser.parse_args(arglist)
 
+    if args.jobs is None:
+        import multiprocessing
+        args.jobs = multiprocessing.cpu_count()
+
+    if args.verbosity >= 1:
+        print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
+
+    if args.batch == 0:
+        args.batch = sys.maxint
+
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
@@ -104,14 +115,32 @@ def twitterFrequency(arglist):
 
         outfile.write(comments+twitterread.comments)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
-    exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return [" + ','.join([filteritem for filteritem in args.filter]) + "]" in locals()
-
-    exec "\
-def evalscore(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.score in locals()
+    filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+    scoreexpression  = TwitterExpression(args.score,  twitterread.fieldnames, globals())
+
+    # Tweets come in order from processes that each parse ranges of the input file
+    tweets = twitterread.parallel(args.jobs)
+
+    # Generate each tweet with its score and filter values, evaluated either row by row or a batch at a time
+    def scoredrows():
+        if args.vectorize:
+            while True:
+                batch = []
+                while len(batch) < args.batch:
+                    try:
+                        batch.append(next(tweets))
+                    except StopIteration:
+                        break
+
+                if not batch:
+                    return
+
+                for row, score, filters in zip(batch, scoreexpression.evaluatebatch(batch),
+                                                      filterexpression.evaluatebatch(batch, truth=True)):
+                    yield row, score, filters
+        else:
+            for row in tweets:
+                yield row, scoreexpression.evaluate(row), filterexpression.evaluate(row)
 
     outunicodecsv=unicodecsv.writer(outfile, lineterminator=os.linesep)
     if not args.no_header:
@@ -122,35 +151,30 @@ def evalscore(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twi
 
     rows=[]
     runningscore = [0] * len(args.filter)
-    while True:
-        try:
-            row = next(twitterread)
-        except StopIteration:
-            break
-
-        rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-        row['score']     = evalscore(**rowargs)
+    rowcount = 0
+    for row, score, filters in scoredrows():
+        rowcount += 1
+        row['score']     = score
         row['datesecs']  = calendar.timegm(row['date'].timetuple())
 
         firstrow = rows[0] if len(rows) > 0 else None
         while firstrow and firstrow['datesecs'] - row['datesecs'] > interval:
-            filters = firstrow['filters']
+            firstfilters = firstrow['filters']
             for filteridx in range(len(args.filter)):
-                if filters[filteridx]:
+                if firstfilters[filteridx]:
                     runningscore[filteridx] -= firstrow['score']
 
-            if any(filters):
+            if any(firstfilters):
                 outunicodecsv.writerow([datetime.datetime.utcfromtimestamp(firstrow['datesecs'] - interval)] + runningscore)
 
             del rows[0]
             firstrow = rows[0] if len(rows) else None
 
-        filters = evalfilter(**rowargs)
         for filteridx in range(len(args.filter)):
             if filters[filteridx]:
                 runningscore[filteridx] += row['score']
 
-        if args.limit and twitterread.count == args.limit:
+        if args.limit and rowcount == args.limit:
             break
 
         if not any(filters):
@@ -19,7 +19,7 @@
 from __future__ import print_function
 import argparse
 import sys
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterGraph
 import os
 import shutil
 import unicodecsv
@@ -80,64 +80,26 @@ def twitterFilter(arglist):
     if args.verbosity >= 1:
         print("Loading twitter data.", file=sys.stderr)
 
-    outedgerows = {}
-    outnoderows = {}
-    outnodespellings = {}
-
-    def addnode(id,timestamp):
-        outnodespelling = outnodespellings.get(id.lower(), {})
-        outnodespelling[id] = outnodespelling.get(id, 0) + 1
-        outnodespellings[id.lower()] = outnodespelling
-
-        id = id.lower()
-        outrowtslist = outnoderows.get(id) or []
-        outrowtslist += [rowts]
-        outnoderows[id] = outrowtslist
-
-
-    def addedge(source,target,timestamp):
-        addnode(source,timestamp)
-        addnode(target,timestamp)
-
-        outrowindex  = (source.lower(), target.lower())
-        outrowtslist = outedgerows.get(outrowindex, [])
-        outrowtslist += [rowts]
-        outedgerows[outrowindex] = outrowtslist
-
+    graph = TwitterGraph()
     for row in twitterread:
         rowts = calendar.timegm(row['date'].timetuple()) * 1000
         for mention in row['mentions'].split():
-            addedge(row['user'], mention, rowts)
+            graph.add(row['user'], mention, rowts)
 
         reply = row['reply-to-user']
         if reply != '':
-            addedge(row['user'], reply, rowts)
-
-    canonicalspelling = {}
-    for nodelower, nodespelling in outnodespellings.items():
-        frequencies = list(nodespelling.values())
-        spellings   = list(nodespelling.keys())
-        canonicalspelling[nodelower] = spellings[frequencies.index(max(frequencies))]
-
-    for outrowindex, outrowtslist in outnoderows.items():
-        timestamp = outrowtslist[0]
-        intervals = '<[' + str(timestamp) + ',' + str(timestamp) + ']'
-        for timestamp in outrowtslist[1:]:
-            intervals += ',[' + str(timestamp) + ',' + str(timestamp) + ']'
-        intervals += '>'
-
-        outnodecsv.writerow([outrowindex, canonicalspelling[outrowindex]] + [intervals])
-
+            graph.add(row['user'], reply, rowts)
 
-    for outrowindex, outrowtslist in outedgerows.items():
-        timestamp = outrowtslist[0]
-        intervals = '<[' + str(timestamp) + ',' + str(timestamp) + ']'
-        for timestamp in outrowtslist[1:]:
-            intervals += ',[' + str(timestamp) + ',' + str(timestamp) + ']'
-        intervals += '>'
+    # Gephi interval list with a point interval for each time
+    def intervals(times):
+        return '<' + ','.join(['[' + str(timestamp) + ',' + str(timestamp) + ']' for timestamp in times]) + '>'
 
-        outedgecsv.writerow(list(outrowindex) + [intervals])
+    canonicalspelling = graph.canonical()
+    for node, times in graph.nodetimes():
+        outnodecsv.writerow([graph.names[node], canonicalspelling[node], intervals(times)])
 
+    for source, target, times, weights in graph.edgetimes():
+        outedgecsv.writerow([graph.names[source], graph.names[target], intervals(times)])
 
     outedgefile.close()
     outnodefile.close()
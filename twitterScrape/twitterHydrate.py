@@ -23,10 +23,11 @@ import webbrowser
 import twitter
 import os
 import sys
-from TwitterFeed import TwitterRead, TwitterWrite
+from TwitterFeed import TwitterRead, TwitterWrite, TwitterIndex, TwitterApi, TwitterCache
 import unicodecsv
 import re
-import datetime
+import itertools
+from dateutil import parser as dateparser
 
 MENTIONREGEXP=re.compile(r'(@\w+)', re.UNICODE)
 HASHTAGREGEXP=re.compile(r'(#\w+)', re.UNICODE)
@@ -50,26 +51,49 @@ def twitterHydrate(arglist):
     parser.add_argument('--access-token-secret', type=str,
                         help='Access token secret for Twitter authentication')
 
+    parser.add_argument(      '--credentials', type=str, help='File of further credentials to share the work, one set per line: consumer key and secret, then access token key and secret unless for application-only authentication')
+    parser.add_argument(      '--inflight',   type=int, default=4, help='Number of lookups to run at once across all credentials')
     parser.add_argument(      '--retry',      type=int, default=5, help='Number of times to retry failed Twitter API call')
 
+    parser.add_argument(      '--cache',      type=str, help='File of tweets hydrated by earlier runs, to look up before calling Twitter')
+    parser.add_argument(      '--cache-ttl',  type=float, default=24, help='Hours after which cached retweet and favorite counts are refreshed')
+    parser.add_argument(      '--cache-size', type=int, default=1000000, help='Maximum number of tweets to keep in the cache')
+
     parser.add_argument(      '--since',      type=str, help='Lower bound tweet date/time in any sensible format.')
     parser.add_argument(      '--until',      type=str, help='Upper bound tweet date/time in any sensible format.')
     parser.add_argument('-l', '--limit',      type=int, help='Limit number of tweets to process')
 
     parser.add_argument('-o', '--outfile', type=str, help='Output CSV file, otherwise use stdout')
     parser.add_argument('--overwrite',     action='store_true', help='Overwrite input fields with hydrated data')
+    parser.add_argument('--resume',        action='store_true', help='Append to existing output file, skipping tweets already hydrated')
     parser.add_argument('--no-comments',   action='store_true', help='Do not output descriptive comments')
     parser.add_argument('--no-header',     action='store_true', help='Do not output CSV header with column names')
 
     parser.add_argument('infile', type=str, nargs='?', help='Input CSV file, otherwise use stdin')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'retry', 'no_comments']
+    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'credentials', 'inflight', 'retry', 'cache', 'cache_ttl', 'cache_size', 'resume', 'no_comments']
 
     until = dateparser.parse(args.until) if args.until else None
     since = dateparser.parse(args.since) if args.since else None
 
     twitterread = TwitterRead(args.infile, since=since, until=until, limit=args.limit)
+
+    # Find the last tweet in the existing output, using its index if current
+    resume = None
+    if args.resume and args.outfile and os.path.isfile(args.outfile):
+        if args.infile is None:
+            raise RuntimeError("Resuming requires an input file.")
+
+        outindex = TwitterIndex.load(args.outfile)
+        if outindex is None:
+            outindex = TwitterIndex(args.outfile)
+            outindex.build()
+        if outindex.entries:
+            resume = outindex.entries[-1]
+            if args.verbosity >= 1:
+                print("Resuming from id: " + str(resume[1]), file=sys.stderr)
+
     if args.no_comments:
         comments = None
     else:
@@ -105,8 +129,7 @@ def twitterHydrate(arglist):
         api = twitter.Api(
                     consumer_key=args.consumer_key,
                     consumer_secret=args.consumer_secret,
-                    application_only_auth=True,
-                    sleep_on_rate_limit=True
+                    application_only_auth=True
             )
     else:
         if not all([args.access_token_key, args.access_token_secret]):
@@ -136,80 +159,90 @@ def twitterHydrate(arglist):
                     consumer_key=args.consumer_key,
                     consumer_secret=args.consumer_secret,
                     access_token_key=args.access_token_key,
-                    access_token_secret=args.access_token_secret,
-                    sleep_on_rate_limit=True
+                    access_token_secret=args.access_token_secret
             )
 
+    # Rate limits are handled by spreading lookups across the credentials rather than by sleeping
+    apis = [api] + (TwitterApi.credentials(args.credentials) if args.credentials else [])
+    if args.verbosity >= 1:
+        print("Using " + str(len(apis)) + " sets of credentials.", file=sys.stderr)
+
     GETSTATUS_FIELDS = {'user', 'date', 'text', 'replies', 'retweets', 'favorites', 'reply-to', 'reply-to-user', 'reply-to-user-id', 'lang', 'geo', 'mentions', 'hashtags', 'user-id'}
 
     fieldnames = twitterread.fieldnames + list(GETSTATUS_FIELDS - set(twitterread.fieldnames))
 
-    twitterwrite = TwitterWrite(args.outfile, comments=comments, fieldnames=fieldnames, header=not args.no_header)
+    cache = TwitterCache(args.cache, ttl=args.cache_ttl * 3600, size=args.cache_size) if args.cache else None
 
-    while True:
-        if args.verbosity >= 2:
-            print("Loading twitter batch.", file=sys.stderr)
+    def cached(rows):
+        # Cached tweets for rows, with fresh counts for those rows whose counts are to be filled in
+        counts = lambda row: args.overwrite or row.get('retweets') is None or row.get('favorites') is None
+        statuses = cache.get([row['id'] for row in rows if counts(row)], fresh=True)
+        statuses.update(cache.get([row['id'] for row in rows if not counts(row)]))
+        return statuses
 
-        rows = []
-        while len(rows) < 100:     # Hard code Twitter 100 batch size
-            try:
-                row = next(twitterread)
-                rows.append(row)
+    if resume:
+        # Appending rows is only safe if they line up with the columns already in the output
+        if TwitterRead(args.outfile).fieldnames != fieldnames:
+            raise RuntimeError("Output file: " + args.outfile + " has different columns from this run, so cannot be resumed.")
 
-            except StopIteration:
-                break
+        # Hydrate the last tweet again in case it was not completely written
+        with open(args.outfile, 'r+') as outfile:
+            outfile.truncate(resume[0])
 
-        if len(rows) == 0:
-            break
+        twitterread.seekid(resume[1])
+        twitterwrite = TwitterWrite(args.outfile, fieldnames=fieldnames, header=False, append=True)
+    else:
+        twitterwrite = TwitterWrite(args.outfile, comments=comments, fieldnames=fieldnames, header=not args.no_header)
 
-        retry = args.retry
+    def batches():
+        # Each batch holds up to 100 ids missing from the cache, along with any cached rows read in between
         while True:
-            try:
-                tweets = api.GetStatuses([row['id'] for row in rows], map=True)
+            if args.verbosity >= 2:
+                print("Loading twitter batch.", file=sys.stderr)
+
+            rows     = []
+            statuses = {}
+            missing  = []
+            while len(missing) < 100 and len(rows) < 1000:      # Hard code Twitter 100 batch size
+                chunk = list(itertools.islice(twitterread, 100 - len(missing)))
+                if len(chunk) == 0:
+                    break
+
+                rows += chunk
+                if cache:
+                    statuses.update(cached(chunk))
+                missing += [row['id'] for row in chunk if row['id'] not in statuses]
+
+            if len(rows) == 0:
                 break
-            except twitter.error.TwitterError as error:
-                if args.verbosity >= 2:
-                    print("Twitter error: ", error, file=sys.stderr)
-                for message in error.message:
-                    if message['code'] == 88 and retry > 0:
-                        retry -= 1
-                        break
-                else:
-                    raise
 
+            yield rows, statuses, missing
+
+    # Several lookups are in flight at once, but batches come back in the order they were read
+    lookup = TwitterApi(apis, '/statuses/lookup.json', inflight=args.inflight, retry=args.retry, verbosity=args.verbosity)
+    for (rows, statuses, missing), tweets in lookup.map(lambda api, batch: api.GetStatuses(batch[2], map=True), batches(),
+                                                        skip=lambda batch: len(batch[2]) == 0):
+        fetched = {id: TwitterCache.status(tweet) for id, tweet in (tweets or {}).items() if tweet}
+        if cache:
+            cache.put(fetched)
+            if args.verbosity >= 2:
+                print("Found " + str(len(statuses)) + " tweets in cache, fetched " + str(len(fetched)) + ".", file=sys.stderr)
+
+        statuses.update(fetched)
         for row in rows:
-            tweet = tweets.get(row['id'])
-            if tweet:
-                if args.overwrite or row.get('user') is None:
-                    row['user'] = tweet.user.screen_name
-                if args.overwrite or row.get('date') is None:
-                    row['date'] = datetime.datetime.utcfromtimestamp(tweet.created_at_in_seconds).isoformat()
-                if args.overwrite or row.get('text') is None:
-                    row['text'] = tweet.text
-                if args.overwrite or row.get('reply-to') is None:
-                    row['reply-to'] = tweet.in_reply_to_status_id
-                if args.overwrite or row.get('reply-to-user') is None:
-                    row['reply-to-user'] = tweet.in_reply_to_screen_name
-                if args.overwrite or row.get('reply-to-user-id') is None:
-                    row['reply-to-user-id'] = tweet.in_reply_to_user_id
-                if args.overwrite or row.get('retweets') is None:
-                    row['retweets'] = tweet.retweet_count
-                if args.overwrite or row.get('favorites') is None:
-                    row['favorites'] = tweet.favorite_count
-                if args.overwrite or row.get('lang') is None:
-                    row['lang'] = tweet.lang
-                if args.overwrite or row.get('geo') is None:
-                    row['geo'] = tweet.geo
-                if args.overwrite or row.get('mentions') is None:
-                    row['mentions'] = u' '.join([u'@'+user.screen_name for user in tweet.user_mentions])
-                if args.overwrite or row.get('hashtags') is None:
-                    row['hashtags'] = u' '.join([u'#'+hashtag.text for hashtag in tweet.hashtags])
-                if args.overwrite or row.get('user-id') is None:
-                    row['user-id'] = tweet.user.id
+            status = statuses.get(row['id'])
+            if status:
+                for field in TwitterCache.FIELDS:
+                    if args.overwrite or row.get(field) is None:
+                        row[field] = status[field]
             elif args.verbosity >= 3:
                 print("Tweet id: " + str(row['id']) + " not retrieved.", file=sys.stderr)
 
             twitterwrite.write(row)
 
+    twitterwrite.close()
+    if cache:
+        cache.close()
+
 if __name__ == '__main__':
     twitterHydrate(None)
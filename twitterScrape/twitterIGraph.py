@@ -19,13 +19,12 @@
 from __future__ import print_function
 import argparse
 import sys
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterExpression, TwitterGraph
 import os
 import shutil
 import unicodecsv
 import string
 import unicodedata
-import re
 from dateutil import parser as dateparser
 import calendar
 import datetime
@@ -69,10 +68,7 @@ def twitterIGraph(arglist):
 
     twitterread  = TwitterRead(args.infile, since=since, until=until, limit=args.limit)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
-    exec "\
-def evalweight(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.weight in locals()
+    evalweight = TwitterExpression(args.weight, twitterread.fieldnames, globals()).evaluate
 
     if args.outedgefile is None:
         outedgefile = sys.stdout
@@ -101,61 +97,20 @@ def evalweight(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
     if args.verbosity >= 1:
         print("Loading twitter data.", file=sys.stderr)
 
-    outedgerows = {}
-    outnoderows = {}
-    outnodespellings = {}
-    outnodeids = {}
-
-    def addnode(id,timestamp):
-        nodeid = outnodeids.get(id.lower(), None)
-        if not nodeid:
-            addnode.lastnodeid += 1
-            outnodeids[id.lower()] = addnode.lastnodeid
-
-        outnodespelling = outnodespellings.get(id.lower(), {})
-        outnodespelling[id] = outnodespelling.get(id, 0) + 1
-        outnodespellings[id.lower()] = outnodespelling
-
-        id = id.lower()
-        outrowtslist = outnoderows.get(id) or []
-        outrowtslist += [timestamp]
-        outnoderows[id] = outrowtslist
-
-    addnode.lastnodeid = 0
-
-    def addedge(source,target,timestamp,weight):
-        addnode(source,timestamp)
-        addnode(target,timestamp)
-
-        outrowindex  = (source.lower(), target.lower())
-        outrowtslist = outedgerows.get(outrowindex, [])
-        outrowtslist += [(timestamp,weight)]
-        outedgerows[outrowindex] = outrowtslist
-
-    starttime = sys.maxint
-
+    graph = TwitterGraph()
     for row in twitterread:
         rowts = calendar.timegm(row['date'].timetuple())
-        rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-        weight = evalweight(**rowargs)
-        if rowts < starttime:
-            starttime = rowts
+        weight = evalweight(row)
         for mention in row['mentions'].split():
-            addedge(row['user'], mention, rowts, weight)
+            graph.add(row['user'], mention, rowts, weight)
 
         reply = row['reply-to-user']
         if reply != '':
-            addedge(row['user'], reply, rowts, weight)
-
-    canonicalspelling = {}
-    for nodelower, nodespelling in outnodespellings.items():
-        frequencies = list(nodespelling.values())
-        spellings   = list(nodespelling.keys())
-        canonicalspelling[nodelower] = spellings[frequencies.index(max(frequencies))]
+            graph.add(row['user'], reply, rowts, weight)
 
-    for outrowindex, outrowtslist in outnoderows.items():
-        for outrowts in reversed(outrowtslist):
-            outnodecsv.writerow([outrowts, outrowts+interval, outnodeids[outrowindex]])
+    # Node ids count from one in order of first appearance
+    for node, times in graph.nodetimes():
+        outnodecsv.writerows([[timestamp, timestamp+interval, node+1] for timestamp in reversed(times)])
 
         #starttime = outrowtslist[-1][0]
         #endtime = starttime + interval
@@ -171,9 +126,8 @@ def evalweight(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
         #outnodecsv.writerow([starttime, endtime, outnodeids[outrowindex]])
 
 
-    for outrowindex, outrowtslist in outedgerows.items():
-        for outrowts in outrowtslist:
-            outedgecsv.writerow([outnodeids[outrowindex[0]], outnodeids[outrowindex[1]], outrowts[0], (outrowts[0] + interval), outrowts[1]])
+    for source, target, times, weights in graph.edgetimes():
+        outedgecsv.writerows([[source+1, target+1, timestamp, timestamp+interval, weight] for timestamp, weight in zip(times, weights)])
 
     outedgefile.close()
     outnodefile.close()
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Copyright 2017 Jonathan Schultz
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import argparse
+import sys
+from TwitterFeed import TwitterIndex
+
+def twitterIndex(arglist):
+
+    parser = argparse.ArgumentParser(description='Build sidecar offset indexes for twitter CSV files.',
+                                     fromfile_prefix_chars='@')
+
+    parser.add_argument('-v', '--verbosity', type=int, default=1)
+    parser.add_argument('-s', '--stride',    type=int, default=TwitterIndex.STRIDE, help='Number of tweets between index entries.')
+    parser.add_argument('-f', '--force',     action='store_true', help='Rebuild indexes that are already current.')
+
+    parser.add_argument('infile', type=str, nargs='+', help='Input CSV file(s).')
+
+    args = parser.parse_args(arglist)
+
+    for infile in args.infile:
+        if not args.force and TwitterIndex.load(infile):
+            if args.verbosity >= 1:
+                print("Index of " + infile + " is current.", file=sys.stderr)
+            continue
+
+        index = TwitterIndex(infile, stride=args.stride)
+        count = index.build()
+        index.save()
+        if args.verbosity >= 1:
+            print("Indexed " + str(count) + " tweets in " + infile + " with " + str(len(index.entries)) + " entries.", file=sys.stderr)
+
+if __name__ == '__main__':
+    twitterIndex(None)
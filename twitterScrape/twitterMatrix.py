@@ -21,14 +21,12 @@ import argparse
 import sys
 import os
 import shutil
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterExpression, TwitterParallel
 import unicodecsv
 import string
 import unicodedata
 from dateutil import parser as dateparser
-import pymp
 from igraph import *
-import numpy as np
 
 def twitterMatrix(arglist):
 
@@ -37,7 +35,7 @@ def twitterMatrix(arglist):
 
     parser.add_argument('-v', '--verbosity', type=int, default=1)
     parser.add_argument('-j', '--jobs',      type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to process per batch, or zero for unlimited. May affect performance but not results.')
+    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to read ahead of the worker processes, or zero for unlimited. May affect performance but not results.')
 
     parser.add_argument('-p', '--prelude',    type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',    type=str, help='Python expression lluated to determine whether tweet is included')
@@ -49,6 +47,7 @@ def twitterMatrix(arglist):
     parser.add_argument('-w', '--words',     type=unicode, required=True, help='Comma separated list of words to use in matrix')
 
     parser.add_argument('--textblob', action='store_true', help='Use textblob to tokenise text and lemmatise words')
+    parser.add_argument('--sparse',   action='store_true', help='Output one row per pair of co-occurring words rather than a full matrix, for long word lists')
 
     parser.add_argument('-o', '--outfile',    type=str, help='Output CSV file, otherwise use stdout.')
     parser.add_argument('--no-comments',      action='store_true', help='Do not output descriptive comments')
@@ -66,9 +65,6 @@ def twitterMatrix(arglist):
     if args.verbosity >= 1:
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
-    if args.batch == 0:
-        args.batch = sys.maxint
-
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
@@ -91,6 +87,11 @@ def twitterMatrix(arglist):
     else:
         wordlist = [word.lower() for word in args.words.split(',')]
 
+    # Positions of each word in the word list, allowing for words that are listed more than once
+    wordindexes = {}
+    for index, word in enumerate(wordlist):
+        wordindexes[word] = wordindexes.get(word, []) + [index]
+
     if args.outfile is None:
         outfile = sys.stdout
     else:
@@ -123,79 +124,59 @@ def twitterMatrix(arglist):
 
         outfile.write(comments+twitterread.comments)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
     if args.filter:
-        exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return [" + ','.join([filteritem for filteritem in args.filter]) + "]" in locals()
+        filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+        filterexpression.pushdown(twitterread)
+        evalfilter = filterexpression.evaluate
+
+    # Count co-occurrences keyed by pairs of word list positions, the first lower than the second, so that
+    # memory depends on the number of word pairs that occur rather than the number of tweets.
+    def accumulate(row, totals):
+        cooccurrence, = totals
+        if args.filter and not evalfilter(row):
+            return
+
+        text = row[args.column]
+        if args.textblob:
+            textblob = TextBlob(text, tokenizer=tokenizer)
+            rowwords = set(word.lemmatize() for word in textblob.tokens if word.isalpha())
+        else:
+            rowwords = set(text.split())
+
+        indexes = sorted([index for word in rowwords for index in wordindexes.get(word, [])])
+        for position, first in enumerate(indexes):
+            for second in indexes[position+1:]:
+                pair = (first, second)
+                cooccurrence[pair] = cooccurrence.get(pair, 0) + 1
 
     if args.verbosity >= 1:
         print("Loading twitter data.", file=sys.stderr)
 
-    mergedmatrices = []
-    while True:
-        if args.verbosity >= 2:
-            print("Loading twitter batch.", file=sys.stderr)
-
-        rows = []
-        batchcount = 0
-        while batchcount < args.batch:
-            try:
-                rows.append(next(twitterread))
-                batchcount += 1
-            except StopIteration:
-                break
-
-        if batchcount == 0:
-            break
-
-        if args.verbosity >= 2:
-            print("Processing twitter batch.", file=sys.stderr)
-
-        rowcount = len(rows)
-        matrices = pymp.shared.list()
-        with pymp.Parallel(args.jobs) as p:
-            matrix = []
-            for rowindex in p.range(0, rowcount):
-                row = rows[rowindex]
-                if args.filter:
-                    rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-                    if not evalfilter(**rowargs):
-                        continue
-
-                text = row[args.column]
-                if args.textblob:
-                    textblob = TextBlob(text, tokenizer=tokenizer)
-                    rowwordlist = []
-                    for word in textblob.tokens:
-                        if word.isalpha():
-                            lemma = word.lemmatize()
-                            if lemma.lower() in wordlist:
-                                rowwordlist += [lemma]
-                else:
-                    rowwordlist = [word for word in text.split() if word.lower() in wordlist]
-
-                matrix.append( [int(word in rowwordlist) for word in wordlist] )
-
-            with p.lock:
-                matrices.append(matrix)
-
-        for matrix in matrices:
-            mergedmatrices += list(matrix)
-
-    # Calculate the dot product of the transposed occurrence matrix with the occurrence matrix
-    cooccurrencematrix = np.dot(zip(*mergedmatrices), mergedmatrices)
-    np.fill_diagonal(cooccurrencematrix, 0)
-    cooccurrencematrix = cooccurrencematrix.tolist()
+    parallel = TwitterParallel(args.jobs, accumulate, buffer=args.batch)
+    parallel.read(twitterread)
+
+    mergedcooccurrence, = parallel.reduce()
 
     if args.verbosity >= 1:
         print("Saving co-occurrence matrix.", file=sys.stderr)
 
     outunicodecsv=unicodecsv.writer(outfile, lineterminator=os.linesep)
-    if not args.no_header:
-        outunicodecsv.writerow(['word'] + wordlist)
-    for row in range(0, len(wordlist)):
-        outunicodecsv.writerow([wordlist[row]] + cooccurrencematrix[row])
+    if args.sparse:
+        if not args.no_header:
+            outunicodecsv.writerow(['word1', 'word2', 'count'])
+        for (first, second), count in sorted(mergedcooccurrence.iteritems()):
+            outunicodecsv.writerow([wordlist[first], wordlist[second], count])
+    else:
+        # Write the symmetric matrix a row at a time, with zeroes on the diagonal
+        neighbours = [{} for word in wordlist]
+        for (first, second), count in mergedcooccurrence.iteritems():
+            neighbours[first][second] = count
+            neighbours[second][first] = count
+
+        if not args.no_header:
+            outunicodecsv.writerow(['word'] + wordlist)
+        for row in range(0, len(wordlist)):
+            outunicodecsv.writerow([wordlist[row]] + [neighbours[row].get(column, 0) for column in range(0, len(wordlist))])
     outfile.close()
 
 if __name__ == '__main__':
@@ -19,14 +19,16 @@
 from __future__ import print_function
 import argparse
 import sys
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterExpression, TwitterParallel, TwitterPairs, TwitterState
 import unicodecsv
 import os
 import shutil
+import heapq
+import operator
+import tempfile
 import string
 import unicodedata
 from dateutil import parser as dateparser
-import pymp
 
 def twitterNetwork(arglist):
     parser = argparse.ArgumentParser(description='Twitter network matrix computation.',
@@ -34,13 +36,16 @@ def twitterNetwork(arglist):
 
     parser.add_argument('-v', '--verbosity', type=int, default=1)
     parser.add_argument('-j', '--jobs',      type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to process per batch, or zero for unlimited. May affect performance but not matrices.')
+    parser.add_argument('-b', '--batch',     type=int, default=100000, help='Number of tweets to read ahead of the worker processes, or zero for unlimited. May affect performance but not results.')
+    parser.add_argument(      '--vectorize',  action='store_true', help='Evaluate filter and score expressions over chunks of tweets using NumPy where possible. May affect performance but not results.')
+    parser.add_argument(      '--memory',    type=int, help='Memory in megabytes for holding edges in NumPy-sorted tables, beyond which they are spilled to temporary files. May affect performance but not results.')
 
     parser.add_argument('-p', '--prelude',   type=str, nargs="*", help='Python code to execute before processing')
     parser.add_argument('-f', '--filter',    type=str, help='Python expression evaluated to determine whether tweet is included')
     parser.add_argument(      '--since',     type=str, help='Lower bound tweet date/time in any sensible format.')
     parser.add_argument(      '--until',     type=str, help='Upper bound tweet date/time in any sensible format.')
     parser.add_argument('-l', '--limit',     type=int, help='Limit number of tweets to process')
+    parser.add_argument(      '--state',     type=str, help='File of totals saved by an earlier run, to which only newer tweets are added before saving them again')
 
     parser.add_argument(      '--fromlist',  type=str, required=True, help='Python code evaluated to generate "from" code(s), for example "user"')
     parser.add_argument(      '--tolist',    type=str, required=True, help='Python code evaluated to generate "to" code(s), for example "mentions.split()')
@@ -48,6 +53,7 @@ def twitterNetwork(arglist):
     parser.add_argument('-tt', '--tothreshold', type=float, help='Threshold score for "from" vector to be included')
     parser.add_argument('-ft', '--fromthreshold', type=float, help='Threshold score for "from" vector to be included')
     parser.add_argument('-t',  '--threshold', type=float, help='Threshold score for pair to be included')
+    parser.add_argument(       '--top',       type=int, help='Only output this number of pairs with the highest scores')
 
     parser.add_argument('-o', '--outfile',    type=str, help='Output CSV file, otherwise use stdout.')
     parser.add_argument('--no-comments',      action='store_true', help='Do not output descriptive comments')
@@ -56,7 +62,7 @@ def twitterNetwork(arglist):
     parser.add_argument('infile', type=str, nargs='?', help='Input CSV file, otherwise use stdin.')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'jobs', 'batch', 'no_comments']
+    hiddenargs = ['verbosity', 'jobs', 'batch', 'vectorize', 'memory', 'no_comments']
 
     if args.jobs is None:
         import multiprocessing
@@ -65,9 +71,6 @@ def twitterNetwork(arglist):
     if args.verbosity >= 1:
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
-    if args.batch == 0:
-        args.batch = sys.maxint
-
     if args.prelude:
         if args.verbosity >= 1:
             print("Executing prelude code.", file=sys.stderr)
@@ -87,6 +90,35 @@ def twitterNetwork(arglist):
         outfile = file(args.outfile, 'w')
 
     twitterread  = TwitterRead(args.infile, since=since, until=until, limit=args.limit)
+
+    # Only read tweets newer than those already covered by the saved totals
+    if args.state:
+        if args.infile is None or args.limit:
+            raise RuntimeError("State file requires an input file and no limit.")
+
+        state = TwitterState(args.state, {arg: getattr(args, arg) for arg in ['prelude', 'filter', 'since', 'until', 'fromlist', 'tolist', 'score']})
+        headid = twitterread.headid()
+        if state.load():
+            if args.verbosity >= 1:
+                print("Adding tweets after id: " + str(state.lastid) + " to saved totals.", file=sys.stderr)
+            twitterread.where('id', operator.gt, state.lastid, bounds=True)
+
+    if args.filter:
+        filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+        filterexpression.pushdown(twitterread)
+        evalfilter = filterexpression.evaluate
+
+    scoreexpression = TwitterExpression(args.score,    twitterread.fieldnames, globals())
+    fromexpression  = TwitterExpression(args.fromlist, twitterread.fieldnames, globals())
+    toexpression    = TwitterExpression(args.tolist,   twitterread.fieldnames, globals())
+    evalscore = scoreexpression.evaluate
+    evalfrom  = fromexpression.evaluate
+    evalto    = toexpression.evaluate
+
+    # Only read the columns that the expressions refer to
+    twitterread.project((filterexpression.columns if args.filter else []) +
+                        scoreexpression.columns + fromexpression.columns + toexpression.columns)
+
     if not args.no_comments:
         comments = ((' ' + args.outfile + ' ') if args.outfile else '').center(80, '#') + '\n'
         comments += '# ' + os.path.basename(sys.argv[0]) + '\n'
@@ -111,94 +143,63 @@ def twitterNetwork(arglist):
 
         outfile.write(comments+twitterread.comments)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
-    if args.filter:
-        exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return [" + ','.join([filteritem for filteritem in args.filter]) + "]" in locals()
+    # Add the scores of a tweet, or with --vectorize a tweet and its score, to the edge and node totals
+    def accumulate(row, totals):
+        edge, fromtotal, tototal = totals
+        if args.vectorize:
+            row, rowscore = row
+        else:
+            if args.filter and not evalfilter(row):
+                return
+            rowscore = evalscore(row)
+
+        rowfrom  = evalfrom(row)
+        rowto    = evalto(row)
+
+        if args.verbosity >= 3:
+            print ("From: " + str(rowfrom), file=sys.stderr)
+            print ("To: " + str(rowto), file=sys.stderr)
+
+        for fromitem in rowfrom:
+            for toitem in rowto:
+                if args.memory:
+                    edge.add(fromitem, toitem, rowscore)
+                else:
+                    duple = (fromitem, toitem)
+                    edge[duple] = edge.get(duple, 0) + rowscore
+                fromtotal[fromitem] = fromtotal.get(fromitem, 0) + rowscore
+                tototal[toitem] = tototal.get(toitem, 0) + rowscore
 
-    exec "\
-def evalscore(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.score in locals()
+    if args.verbosity >= 1:
+        print("Loading twitter data.", file=sys.stderr)
 
-    exec "\
-def evalfrom(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.fromlist in locals()
+    # With a memory budget, edges are held in compact tables that each process spills to disk when its share of
+    # the budget is used up
+    if args.memory:
+        tempdir = tempfile.mkdtemp()
+        limit = args.memory * 1024 * 1024 // TwitterPairs.PAIRBYTES // args.jobs
+        tables = [lambda: TwitterPairs(limit, tempdir), dict, dict]
+    else:
+        tables = 3
 
-    exec "\
-def evalto(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.tolist in locals()
+    parallel = TwitterParallel(args.jobs, accumulate, tables=tables, buffer=args.batch)
+    if args.vectorize:
+        # Evaluate the filter and scores over a chunk of tweets at a time
+        def prepare(rows):
+            if args.filter:
+                rows = [row for row, keep in zip(rows, filterexpression.evaluatebatch(rows, truth=True)) if keep]
+            return zip(rows, scoreexpression.evaluatebatch(rows))
 
-    if args.verbosity >= 1:
-        print("Loading twitter data.", file=sys.stderr)
+        parallel.read(twitterread, prepare)
+    else:
+        parallel.read(twitterread)
+
+    mergededge, mergedfromtotal, mergedtototal = parallel.reduce()
 
-    mergededge = {}
-    mergedfromtotal = {}
-    mergedtototal = {}
-    while True:
-        if args.verbosity >= 2:
-            print("Loading twitter batch.", file=sys.stderr)
-
-        rows = []
-        batchcount = 0
-        while batchcount < args.batch:
-            try:
-                rows.append(next(twitterread))
-                batchcount += 1
-            except StopIteration:
-                break
-
-        if batchcount == 0:
-            break
-
-        if args.verbosity >= 2:
-            print("Processing twitter batch.", file=sys.stderr)
-
-        rowcount = len(rows)
-        edges = pymp.shared.list()
-        fromtotals = pymp.shared.list()
-        tototals = pymp.shared.list()
-        with pymp.Parallel(args.jobs) as p:
-            edge = {}
-            fromtotal = {}
-            tototal = {}
-            for rowindex in p.range(0, rowcount):
-                row = rows[rowindex]
-                rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-                if args.filter and not evalfilter(**rowargs):
-                    continue
-
-                rowfrom  = evalfrom(**rowargs)
-                rowto    = evalto(**rowargs)
-                rowscore = evalscore(**rowargs)
-
-                if args.verbosity >= 3:
-                    print ("From: " + str(rowfrom), file=sys.stderr)
-                    print ("To: " + str(rowto), file=sys.stderr)
-
-                for fromitem in rowfrom:
-                    for toitem in rowto:
-                        duple = (fromitem, toitem)
-                        edge[duple] = edge.get(duple, 0) + rowscore
-                        fromtotal[fromitem] = fromtotal.get(fromitem, 0) + rowscore
-                        tototal[toitem] = tototal.get(toitem, 0) + rowscore
-
-            with p.lock:
-                edges.append(edge)
-                fromtotals.append(fromtotal)
-                tototals.append(tototal)
-
-        for edge in edges:
-            for duple in edge.keys():
-                mergededge[duple] = mergededge.get(duple, 0) + edge[duple]
-
-        for fromtotal in fromtotals:
-            for fromitem in fromtotal.keys():
-                mergedfromtotal[fromitem] = mergedfromtotal.get(fromitem, 0) + fromtotal[fromitem]
-
-        for tototal in tototals:
-            for toitem in tototal.keys():
-                mergedtototal[toitem] = mergedtototal.get(toitem, 0) + tototal[toitem]
+    if args.state:
+        if state.lastid is not None:
+            state.merge([mergededge, mergedfromtotal, mergedtototal])
+        state.save(max(headid, state.lastid), [mergededge, mergedfromtotal, mergedtototal])
 
     if args.verbosity >= 1:
         print("Saving network matrix.", file=sys.stderr)
@@ -206,20 +207,28 @@ def evalto(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitte
     outunicodecsv=unicodecsv.writer(outfile, lineterminator=os.linesep)
     if not args.no_header:
         outunicodecsv.writerow(['from', 'to', 'score'])
-    for duple, value in sorted(mergededge.iteritems(), key=lambda (k,v): (-v,k)):
-        fromitem = duple[0]
-        if mergedfromtotal[fromitem] < (args.fromthreshold or 0):
-            continue
-        toitem = duple[1]
-        if mergedtototal[toitem] < (args.tothreshold or 0):
-            continue
-
-        if mergededge[duple] < (args.threshold or 0):
-            continue
+    # Apply the thresholds before ordering the edges, so that only edges that are output need to be sorted
+    def keep(duple, value):
+        return not (value < (args.threshold or 0) or
+                    mergedfromtotal[duple[0]] < (args.fromthreshold or 0) or
+                    mergedtototal[duple[1]] < (args.tothreshold or 0))
+
+    if args.top:
+        # Only the top edges are kept, in a heap, so memory does not depend on the number of edges
+        edges = heapq.nsmallest(args.top, ((duple, value) for duple, value in mergededge.iteritems() if keep(duple, value)),
+                                key=lambda (k,v): (-v,k))
+    elif args.memory:
+        edges = mergededge.byscore(keep)
+    else:
+        edges = sorted(((duple, value) for duple, value in mergededge.iteritems() if keep(duple, value)),
+                       key=lambda (k,v): (-v,k))
 
-        outunicodecsv.writerow([fromitem, toitem, value])
+    for duple, value in edges:
+        outunicodecsv.writerow([duple[0], duple[1], value])
 
     outfile.close()
+    if args.memory:
+        shutil.rmtree(tempdir)
 
 if __name__ == '__main__':
     twitterNetwork(None)
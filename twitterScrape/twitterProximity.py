@@ -23,7 +23,8 @@ import sys
 import unicodecsv
 import string
 import unicodedata
-import pymp
+import itertools
+from TwitterFeed import TwitterParallel
 
 def twitterProximity(arglist):
 
@@ -33,7 +34,7 @@ def twitterProximity(arglist):
     parser.add_argument('-v', '--verbosity', type=int, default=1)
 
     parser.add_argument('-j', '--jobs', type=int, help='Number of parallel tasks, default is number of CPUs')
-    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of tweets to process per batch, or zero for unlimited. May affect performance but not results.')
+    parser.add_argument('-b', '--batch',      type=int, default=100000, help='Number of tweets to read ahead of the worker processes, or zero for unlimited. May affect performance but not results.')
 
     parser.add_argument('-l', '--limit',     type=int, help='Limit number of tweets to process')
 
@@ -62,9 +63,6 @@ def twitterProximity(arglist):
     if args.verbosity >= 1:
         print("Using " + str(args.jobs) + " jobs.", file=sys.stderr)
 
-    if args.batch == 0:
-        args.batch = sys.maxint
-
     keywordlc = args.keyword.lower()
 
     if args.outfile is None:
@@ -118,70 +116,37 @@ def twitterProximity(arglist):
         from nltk.tokenize import RegexpTokenizer
         tokenizer=RegexpTokenizer(r'https?://[^"\' ]+|[@|#]?\w+')
 
+    def accumulate(row, totals):
+        score, = totals
+        if args.textblob:
+            textblob = TextBlob(row['text'], tokenizer=tokenizer)
+            wordlist = textblob.tokens
+        else:
+            wordlist = row['text'].split()
+
+        keywordindices = [index for index,word in enumerate(wordlist)
+                                if keywordlc in word.lower()]
+        if len(keywordindices) > 0:
+            if args.textblob:
+                wordproximity = [(word.lemmatize().lower(), min([abs(index - keywordindex) for keywordindex in keywordindices]))
+                                for index,word in enumerate(wordlist) if word.lower() not in stop]
+            else:
+                wordproximity = [(word.lower(), min([abs(index - keywordindex) for keywordindex in keywordindices]))
+                                for index,word in enumerate(wordlist) if word.lower() not in stop]
+
+            for word,proximity in wordproximity:
+                if proximity > 0:
+                    #wordscore = 1.0
+                    wordscore = 1.0 / proximity
+                    score[word] = score.get(word, 0) + wordscore
+
     if args.verbosity >= 1:
         print("Loading twitter data.", file=sys.stderr)
 
-    mergedscore = {}
-    tweetcount = 0
-    while (tweetcount < args.limit) if args.limit is not None else True:
-        if args.verbosity >= 2:
-            print("Loading twitter batch.", file=sys.stderr)
-
-        rows = []
-        batchtotal = min(args.batch, args.limit - tweetcount) if args.limit is not None else args.batch
-        batchcount = 0
-        while batchcount < batchtotal:
-            try:
-                rows += [next(inreader)]
-                batchcount += 1
-            except StopIteration:
-                break
-
-        if batchcount == 0:
-            break
+    parallel = TwitterParallel(args.jobs, accumulate, buffer=args.batch)
+    parallel.map(itertools.islice(inreader, args.limit))
 
-        if args.verbosity >= 2:
-            print("Processing twitter batch.", file=sys.stderr)
-
-        tweetcount += batchcount
-        rowcount = len(rows)
-
-        scores = pymp.shared.list()
-        with pymp.Parallel(args.jobs) as p:
-            score = {}
-            for rowindex in p.range(0, rowcount):
-                #print("Thread :" + str(p.thread_num) + " score count is " + str(len(score.values())))
-                if args.textblob:
-                    textblob = TextBlob(rows[rowindex]['text'], tokenizer=tokenizer)
-                    wordlist = textblob.tokens
-                else:
-                    wordlist = rows[rowindex]['text'].split()
-
-                keywordindices = [index for index,word in enumerate(wordlist)
-                                        if keywordlc in word.lower()]
-                if len(keywordindices) > 0:
-                    if args.textblob:
-                        wordproximity = [(word.lemmatize().lower(), min([abs(index - keywordindex) for keywordindex in keywordindices]))
-                                        for index,word in enumerate(wordlist) if word.lower() not in stop]
-                    else:
-                        wordproximity = [(word.lower(), min([abs(index - keywordindex) for keywordindex in keywordindices]))
-                                        for index,word in enumerate(wordlist) if word.lower() not in stop]
-
-                    for word,proximity in wordproximity:
-                        if proximity > 0:
-                            #wordscore = 1.0
-                            wordscore = 1.0 / proximity
-                            score[word] = score.get(word, 0) + wordscore
-
-            if args.verbosity >= 1:
-                print("Thread " + str(p.thread_num) + " analysed " + str(len(score)) + " words.", file=sys.stderr)
-
-            with p.lock:
-                scores += [score]
-
-        for score in scores:
-            for word in score:
-                mergedscore[word] = mergedscore.get(word, 0) + score[word]
+    mergedscore, = parallel.reduce()
 
     if args.verbosity >= 1:
         print("Sorting " + str(len(mergedscore)) + " words.", file=sys.stderr)
@@ -45,5 +45,7 @@ def twitterRepair(arglist):
 
         twitterwrite.write(row)
 
+    twitterwrite.close()
+
 if __name__ == '__main__':
     twitterRepair(None)
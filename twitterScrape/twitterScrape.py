@@ -19,13 +19,21 @@
 from __future__ import print_function
 import gooey
 import argparse
-from TwitterFeed import TwitterRead, TwitterWrite
+from TwitterFeed import TwitterRead, TwitterWrite, TwitterMerge
 import sys
 import os
 from dateutil import parser as dateparser
 from datetime import datetime, date, timedelta
 import pytz
 import shutil
+import json
+from future.utils import raise_
+import tempfile
+import threading
+if sys.version_info[0] < 3:
+    import Queue as queue
+else:
+    import queue
 
 def add_arguments(parser):
     parser.description = "Scrape and merge twitter feed."
@@ -44,13 +52,17 @@ def add_arguments(parser):
 
     outputgroup = parser.add_argument_group('Output')
     outputgroup.add_argument('-o', '--outfile',  type=str, widget='FileSaver',
-                             help='Output file, otherwise ureaderse stdout.')
+                             help='Output file, otherwise use stdout. A .parquet extension selects columnar format.')
     outputgroup.add_argument('-n', '--number',   type=int,
                              help='Maximum number of results to output')
     outputgroup.add_argument('--no-comments',    action='store_true',
                              help='Do not output descriptive comments')
     outputgroup.add_argument('--no-header',      action='store_true',
                              help='Do not output CSV header with column names')
+    outputgroup.add_argument('--checkpoint',     type=int, default=1000,
+                             help='Number of tweets scraped between checkpoints of scraping state, or zero for none.')
+    outputgroup.add_argument('--resume',         action='store_true',
+                             help='Resume an interrupted run from its last checkpoint.')
 
     inputgroup = parser.add_argument_group('Input')
     inputgroup.add_argument('infile', type=str, nargs='*', widget='FileChooser',
@@ -62,10 +74,18 @@ def add_arguments(parser):
     advancedgroup.add_argument('-v', '--verbosity', type=int, default=1)
     advancedgroup.add_argument('-t', '--timeout',   type=int, default=5,
                                help='Timeout for socket operations.')
+    advancedgroup.add_argument('-j', '--jobs',      type=int, default=1,
+                               help='Number of twitter feeds to run concurrently over date shards.')
+    advancedgroup.add_argument(      '--shard-days', type=int, default=7,
+                               help='Number of days covered by each date shard when running concurrent feeds.')
+    advancedgroup.add_argument(      '--pool-size', type=int, default=4,
+                               help='Number of idle HTTP connections to keep open for re-use by twitter feeds.')
+    advancedgroup.add_argument(      '--prefetch',  type=int, default=0,
+                               help='Number of twitter feed pages to fetch ahead of processing in a background thread.')
 
     parser.set_defaults(func=twitterScrape)
     parser.set_defaults(build_comments=build_comments)
-    parser.set_defaults(hiddenargs=['hiddenargs', 'verbosity', 'timeout', 'no_comments'])
+    parser.set_defaults(hiddenargs=['hiddenargs', 'verbosity', 'timeout', 'jobs', 'shard_days', 'pool_size', 'prefetch', 'checkpoint', 'resume', 'no_comments'])
 
 @gooey.Gooey(ignore_command=None, force_command='--gui',
              default_cols=1,
@@ -97,14 +117,108 @@ def build_comments(kwargs):
 
     return comments
 
+def twitterGaps(infile, since, until):
+
+    # Find the periods between since and until that no input file covers, most recent first. These are the
+    # periods that the twitter feed is run over when scraping sequentially. A file covers the period from its
+    # oldest to its newest tweet, except where a blank row marks a gap in its coverage. The oldest period
+    # starts at since, which may be None.
+    covered = []
+    for filename in infile:
+        newest = oldest = None
+        for row in TwitterRead(filename, since=since, until=until, blanks=True):
+            if row['id'] is None:
+                if newest is not None:
+                    covered += [(oldest, newest)]
+                newest = oldest = None
+            elif row['date']:
+                if newest is None:
+                    newest = row['date']
+                oldest = row['date']
+
+        if newest is not None:
+            covered += [(oldest, newest)]
+
+    gaps = []
+    gapuntil = until
+    for oldest, newest in sorted(covered, key=lambda period: period[1], reverse=True):
+        if newest < gapuntil:
+            gaps += [(newest, gapuntil)]
+        gapuntil = min(gapuntil, oldest)
+
+    if since is None or gapuntil > since:
+        gaps += [(since, gapuntil)]
+
+    return gaps
+
+def twitterShards(string, user, language, gaps,
+                  verbosity, timeout, jobs, shard_days, pool_size, prefetch):
+
+    # Split each period into date shards, most recent first so that the shard files can be merged
+    # in descending id order. A period with no lower bound is scraped as a single shard.
+    shards = []
+    for since, until in gaps:
+        if since is None:
+            shards += [(None, until)]
+            continue
+
+        sharduntil = until
+        while sharduntil > since:
+            shardsince = max(since, (sharduntil - timedelta(days=shard_days)).replace(hour=0, minute=0, second=0, microsecond=0))
+            shards += [(shardsince, sharduntil)]
+            sharduntil = shardsince
+
+    tempdir = tempfile.mkdtemp(prefix='twitterScrape')
+    shardfiles = [os.path.join(tempdir, 'shard' + str(shardidx) + '.csv') for shardidx in range(len(shards))]
+
+    shardqueue = queue.Queue()
+    for shardidx in range(len(shards)):
+        shardqueue.put(shardidx)
+
+    errors = []
+    def shardworker():
+        while not errors:
+            try:
+                shardidx = shardqueue.get_nowait()
+            except queue.Empty:
+                break
+
+            shardsince, sharduntil = shards[shardidx]
+            if verbosity >= 1:
+                print("Scraping shard until:" + sharduntil.isoformat() + ", since:" + (shardsince.isoformat() if shardsince else ''), file=sys.stderr)
+            try:
+                twitterScrape(string=string, user=user, language=language,
+                              since=shardsince.isoformat() if shardsince else None, until=sharduntil.isoformat(),
+                              outfile=shardfiles[shardidx], number=None, no_comments=True, no_header=False, checkpoint=0,
+                              infile=[], force=True,
+                              verbosity=verbosity, timeout=timeout, comments=None, pool_size=max(pool_size, jobs), prefetch=prefetch)
+            except Exception:
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=shardworker) for job in range(min(jobs, len(shards)))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        while worker.is_alive():
+            worker.join(1)
+
+    if errors:
+        shutil.rmtree(tempdir)
+        raise_(*errors[0])
+
+    return tempdir, shardfiles
+
 def twitterScrape(string, user, language, since, until,
                   outfile, number, no_comments, no_header,
                   infile, force,
-                  verbosity, timeout, comments, **dummy):
+                  verbosity, timeout, comments, jobs=1, shard_days=7, pool_size=4, prefetch=0,
+                  checkpoint=0, resume=False, **dummy):
 
     # Import twitter feed modules if we are going to need them
     if string or user:
         from TwitterFeed import TwitterFeed
+        TwitterFeed.POOL.size = max(pool_size, jobs)
         if sys.version_info[0] < 3:
             import urllib2 as urlliberror
         else:
@@ -121,15 +235,63 @@ def twitterScrape(string, user, language, since, until,
 
     # Handle in situ replacement of output file
     tempoutfile = None
-    if outfile is not None and os.path.isfile(outfile):
+    resumestate = None
+    if outfile is not None:
+        # A columnar output file is only written as a whole, and its partial file keeps its extension
+        if TwitterRead.columnar(outfile):
+            partfile = os.path.splitext(outfile)[0] + '.part' + os.path.splitext(outfile)[1]
+            checkpoint = 0
+        else:
+            partfile = outfile + '.part'
+
+    if resume:
+        if outfile is None:
+            raise RuntimeError("Resuming requires an output file.")
+        if jobs > 1:
+            raise RuntimeError("Resuming is not supported with concurrent scraping.")
+        if TwitterRead.columnar(outfile):
+            raise RuntimeError("Resuming is not supported for columnar output files.")
+
+        # The checkpoint sits alongside whichever file the interrupted run was writing.
+        if os.path.isfile(partfile + '.checkpoint'):
+            infile += [outfile]
+            tempoutfile = partfile
+        elif not os.path.isfile(outfile + '.checkpoint'):
+            raise RuntimeError("No checkpoint found for output file: " + outfile)
+    elif outfile is not None and os.path.isfile(outfile):
         infile += [outfile]
-        tempoutfile = outfile + '.part'
+        tempoutfile = partfile
+
+    checkpointfile = ((tempoutfile or outfile) + '.checkpoint') if outfile is not None else None
+    if resume:
+        resumestate = json.load(open(checkpointfile, 'r'))
+        if resumestate['infile'] != infile:
+            raise RuntimeError("Input files do not match checkpoint: " + checkpointfile)
+
+        resumedate = dateparser.parse(resumestate['lastdate'])
+        if verbosity >= 1:
+            print("Resuming after id: " + str(resumestate['lastid']) + " - " + resumedate.isoformat(), file=sys.stderr)
 
     if no_comments:
         comments = None
     elif len(infile) == 0:
         comments += '#' * 80 + '\n'
 
+    # Scrape date shards of the gaps in the input files concurrently, then merge the shard files as if they
+    # were input files.
+    scraping = bool(string or user)
+    sharddir = None
+    if (string or user) and jobs > 1:
+        gapuntil = until or datetime.utcnow()
+        gaps = [(since, gapuntil)] if force else twitterGaps(infile, since, gapuntil)
+        if since is None and verbosity >= 1:
+            print("Without a since date, the oldest period is scraped by a single feed.", file=sys.stderr)
+
+        sharddir, shardfiles = twitterShards(string, user, language, gaps,
+                                             verbosity, timeout, jobs, shard_days, pool_size, prefetch)
+        infile = infile + shardfiles
+        string = user = None
+
     # Function to simplify reading tweets from CSV or feed
     def nextornone(reader):
         try:
@@ -137,74 +299,111 @@ def twitterScrape(string, user, language, since, until,
         except StopIteration:
             return None
 
+    # Merge input files and twitter feed in descending id order
+    merge = TwitterMerge(verbosity=verbosity,
+                         errors=(urlliberror.HTTPError, urlliberror.URLError) if (string or user) else ())
+
     # Open and read first row from input files
-    inreader = []
-    currow = []
-    rowcnt = []
-    headidx = None
+    fieldnames = None
     for fileidx in range(len(infile)):
         thisinreader = TwitterRead(infile[fileidx], since=since, until=until, blanks=True)
-        comments += thisinreader.comments
+        if comments is not None:
+            comments += thisinreader.comments
 
-        inreader += [thisinreader]
-        if inreader[fileidx].fieldnames != inreader[0].fieldnames:
+        if fieldnames is None:
+            fieldnames = thisinreader.fieldnames
+        elif thisinreader.fieldnames != fieldnames:
             raise RuntimeError("File: " + infile[fileidx] + " has mismatched field names")
 
-        currowitem = nextornone(inreader[fileidx])
-        currow += [currowitem]
-        rowcnt += [0]
-        if currowitem:
-            if headidx is None or currowitem['id'] > currow[headidx]['id']:
-                headidx = fileidx
+        currowitem = nextornone(thisinreader)
+        # Skip rows that were already written before the checkpoint
+        while resumestate and currowitem and (currowitem['id'] is None or currowitem['id'] >= resumestate['lastid']):
+            currowitem = nextornone(thisinreader)
 
-        if verbosity >= 2:
-            if currowitem:
-                print("Read id: " + str(currowitem['id']) + " from " + infile[fileidx], file=sys.stderr)
-            else:
-                print("End of " + infile[fileidx], file=sys.stderr)
+        merge.add(infile[fileidx], thisinreader if currowitem else None, currowitem,
+                  rowcnt=resumestate['rowcnt'][fileidx] if resumestate else 0)
 
-    if headidx is not None and verbosity >= 2:
-        print("Head input is " + infile[headidx], file=sys.stderr)
+    if merge.head is not None and verbosity >= 2:
+        print("Head input is " + infile[merge.head], file=sys.stderr)
 
-    if len(infile) > 0:
-        fieldnames = inreader[0].fieldnames
-    else:
+    if fieldnames is None:
         fieldnames = ['user', 'date', 'text', 'replies', 'retweets', 'favorites', 'conversation', 'quote', 'quote-user', 'quote-user-id', 'lang', 'geo', 'mentions', 'hashtags', 'user-id', 'id']
 
-    twitterwrite = TwitterWrite(tempoutfile if tempoutfile else outfile, comments=comments, fieldnames=fieldnames, header=not no_header)
+    if resumestate:
+        # Discard anything written after the checkpoint then carry on appending
+        with open(tempoutfile or outfile, 'r+') as partfile:
+            partfile.truncate(resumestate['offset'])
+
+        twitterwrite = TwitterWrite(tempoutfile or outfile, fieldnames=fieldnames, header=False, append=True)
+        twitterwrite.count = resumestate['count']
+
+        # Tweets after the checkpoint are all older than the last one written
+        if until is None or until > resumedate:
+            until = resumedate + timedelta(seconds=1)
+    else:
+        twitterwrite = TwitterWrite(tempoutfile if tempoutfile else outfile, comments=comments, fieldnames=fieldnames, header=not no_header)
+
+    def savecheckpoint(twitterwrite):
+        twitterwrite.file.flush()
+        state = {'infile':  infile,
+                 'offset':  twitterwrite.file.tell(),
+                 'count':   twitterwrite.count,
+                 'lastid':  merge.lastid,
+                 'lastdate': merge.lastdate.isoformat(),
+                 'rowcnt':  merge.rowcnt,
+                 'twittersince': twittersince.isoformat() if twittersince else None,
+                 'twitteruntil': twitteruntil.isoformat() if twitteruntil else None,
+                 'url':      None,
+                 'position': None}
+        if merge.readers[twitteridx]:
+            state['url']      = twitterfeed.url
+            state['position'] = twitterfeed.pageposition
+
+        # Write then rename so that an interruption never leaves a truncated checkpoint
+        with open(checkpointfile + '.tmp', 'w') as statefile:
+            json.dump(state, statefile)
+        os.rename(checkpointfile + '.tmp', checkpointfile)
 
     # Prepare twitter feed
     twitterfeed = None
     twittersince = None
+    twitteruntil = None
     httperror = False
-    twitteridx = len(inreader)
-    inreader += [None]
-    currow += [None]
-    rowcnt += [0]
-    infile += ['twitter feed']
+    twitteridx = merge.add('twitter feed', rowcnt=resumestate['rowcnt'][len(infile)] if resumestate else 0)
 
     # Start twitter feed if already needed
-    if (string or user) and (force or until is None or headidx is None or until > currow[headidx]['date']):
-        twittersince = since.date() if since else None
-        if (not force) and (headidx is not None):
-            twittersince = max(twittersince, currow[headidx]['date'].date()) if twittersince else currow[headidx]['date'].date()
-
-        if until:
-            twitteruntil = until.date()
-            if until.time() > datetime.min.time():
-                twitteruntil += timedelta(days=1)
+    resumefeed = resumestate and resumestate['position'] is not None
+    headidx = merge.head
+    if (string or user) and (resumefeed or force or until is None or headidx is None or until > merge.rows[headidx]['date']):
+        if resumefeed:
+            twittersince = dateparser.parse(resumestate['twittersince']).date() if resumestate['twittersince'] else None
+            twitteruntil = dateparser.parse(resumestate['twitteruntil']).date() if resumestate['twitteruntil'] else None
         else:
-            twitteruntil = None
+            twittersince = since.date() if since else None
+            if (not force) and (headidx is not None):
+                twittersince = max(twittersince, merge.rows[headidx]['date'].date()) if twittersince else merge.rows[headidx]['date'].date()
+
+            if until:
+                twitteruntil = until.date()
+                if until.time() > datetime.min.time():
+                    twitteruntil += timedelta(days=1)
+            else:
+                twitteruntil = None
 
         while True:
             if verbosity >= 1:
                 print("Opening twitter feed with until:" + (twitteruntil.isoformat() if twitteruntil else '') + ", since:" + (twittersince.isoformat() if twittersince else ''), file=sys.stderr)
             try:
                 twitterfeed = TwitterFeed(language=language, user=user, query=string,
-                                          until=twitteruntil, since=twittersince, timeout=timeout)
+                                          until=twitteruntil, since=twittersince, timeout=timeout, prefetch=prefetch)
+                if resumefeed:
+                    if twitterfeed.url != resumestate['url']:
+                        raise RuntimeError("Twitter query does not match checkpoint: " + checkpointfile)
+                    twitterfeed.position = resumestate['position']
+
                 currowitem = nextornone(twitterfeed)
                 while currowitem:
-                    if not until or currowitem['date'] < until:
+                    if (not until or currowitem['date'] < until) and (not resumestate or currowitem['id'] < resumestate['lastid']):
                         break
                     currowitem = nextornone(twitterfeed)
 
@@ -218,132 +417,71 @@ def twitterScrape(string, user, language, since, until,
             if currowitem:
                 print("Read id: " + str(currowitem['id']) + " from twitter feed", file=sys.stderr)
 
-        currow[twitteridx] = currowitem
         if currowitem:
-            inreader[twitteridx] = twitterfeed
-            if headidx is None or currowitem['id'] > currow[headidx]['id']:
-                headidx = twitteridx
-                if verbosity >= 2:
-                    print("Head input is twitter feed", file=sys.stderr)
+            merge.open(twitteridx, twitterfeed, currowitem)
+            if merge.head == twitteridx and verbosity >= 2:
+                print("Head input is twitter feed", file=sys.stderr)
         else:
             twitterfeed = None
             if verbosity >= 1:
                 print("Twitter feed returned no results", file=sys.stderr)
 
-    pacing = [(headidx is not None and currow[fileidx] and currow[fileidx]['id'] == currow[headidx]['id'])
-                    for fileidx in range(len(inreader))]
+    merge.pace()
 
-    if verbosity >= 2:
-        for fileidx in range(len(inreader)):
-            if pacing[fileidx]:
-                print(infile[fileidx] + " is pacing", file=sys.stderr)
-
-    if headidx is None:
+    if merge.head is None:
         if verbosity >= 1:
             print("Nothing to do.", file=sys.stderr)
-        sys.exit()
-
-    # Main loop
+        twitterwrite.close()
+        if resumestate:
+            os.remove(checkpointfile)
+        if sharddir:
+            shutil.rmtree(sharddir)
+        return
+
+    # Main loop, counting the tweets scraped since the last checkpoint but not those copied from input files
+    scraped = 0
     while True:
+        headrow = merge.rows[merge.head]
         # Catch twitter feed that has run past lower bound
-        if since and currow[headidx]['date'] < since:
+        if since and headrow['date'] < since:
             break
 
-        twitterwrite.write(currow[headidx])
+        twitterwrite.write(headrow)
+        if merge.head == twitteridx:
+            scraped += 1
         if number and twitterwrite.count == number:
             break
 
-        rowcnt[headidx] += 1
-        lastid = currow[headidx]['id']
-        lastdatetime = currow[headidx]['date']
-
-        for fileidx in range(len(inreader)):
-            if currow[fileidx] and currow[fileidx]['id'] == lastid:
-                currowid = currow[fileidx]['id']
-                currowdate = currow[fileidx]['date']
-                try:
-                    currow[fileidx] = nextornone(inreader[fileidx])
-                except (urlliberror.HTTPError, urlliberror.URLError) as err:
-                    httperror = True
-                    if verbosity >= 2:
-                        print(err, file=sys.stderr)
+        # Advance every input holding the tweet just written, noting whether the feed runs out
+        feedactive = merge.readers[twitteridx] is not None
+        merge.advance()
+        lastid = merge.lastid
+        lastdatetime = merge.lastdate
+        if feedactive and merge.readers[twitteridx] is None:
+            twitterfeed = None
+            if merge.error:
+                httperror = True
+                merge.error = False
 
-                if verbosity >= 2:
-                    if currow[fileidx]:
-                        print("Read id: " + str(currow[fileidx]['id']) + " from " + infile[fileidx], file=sys.stderr)
-                    else:
-                        print("End of " + infile[fileidx], file=sys.stderr)
-                if currow[fileidx] is None:
-                    if verbosity >= 1:
-                        print("Closing " + infile[fileidx] + " after " + str(rowcnt[fileidx]) + " rows.", file=sys.stderr)
-                    rowcnt[fileidx] = 0
-                    pacing[fileidx] = False
-                    inreader[fileidx] = None
-                    if fileidx == twitteridx:
-                        twitterfeed = None
-                # Test for blank record in CSV
-                elif currow[fileidx]['id'] == None:
-                    currow[fileidx] = None
-                    if verbosity >= 1:
-                        print(infile[fileidx] + " has gap after id:" + str(currowid) + " - " + currowdate.isoformat(), file=sys.stderr)
-
-        headidx = None
-        for fileidx in range(len(inreader)):
-            if currow[fileidx] and (headidx is None or currow[fileidx]['id'] > currow[headidx]['id']):
-                headidx = fileidx
-
-        nextheadidx = headidx
-        for fileidx in range(len(inreader)):
-            if inreader[fileidx]:
-                # The follow section is executed following a blank line in a CSV file
-                if currow[fileidx] is None:
-                    currow[fileidx] = nextornone(inreader[fileidx])
-                    if verbosity >= 2:
-                        if currow[fileidx]:
-                            print("Read id: " + str(currow[fileidx]['id']) + " from " + infile[fileidx], file=sys.stderr)
-                        else:
-                            print("End of " + infile[fileidx], file=sys.stderr)
-                    pacing[fileidx] = False
-                    if currow[fileidx] is None:
-                        if verbosity >= 1:
-                            print("Closing " + infile[fileidx] + " after " + str(rowcnt[fileidx]) + " rows.", file=sys.stderr)
-                        rowcnt[fileidx] = 0
-                        inreader[fileidx] = None
-                    elif nextheadidx is None or currow[fileidx]['id'] > currow[nextheadidx]['id']:
-                        nextheadidx = fileidx
-
-                if currow[fileidx]:
-                    if pacing[fileidx]:
-                        if currow[fileidx]['id'] != currow[headidx]['id']:
-                            print("WARNING: Missing tweet, id: " + str(currow[headidx]['id']) + " in file: " + infile[fileidx], file=sys.stderr)
-                            pacing[fileidx] = False
-                    elif headidx is not None:
-                        if currow[fileidx]['id'] == currow[headidx]['id']:
-                            if verbosity >= 2:
-                                print(infile[fileidx] + " now pacing.", file=sys.stderr)
-                            pacing[fileidx] = True
-
-        headidx = nextheadidx
-        if verbosity >= 2:
-            print("Head input is " + (infile[headidx] if headidx is not None else 'empty'), file=sys.stderr)
+        if checkpoint and checkpointfile and scraped >= checkpoint:
+            savecheckpoint(twitterwrite)
+            scraped = 0
 
         # Stop reading twitter feed if it is now paced by an input file
-        if (not force) and inreader[twitteridx] and any(pacing[0:-1]):
+        if (not force) and merge.readers[twitteridx] and any(idx != twitteridx for idx in merge.pacing):
             if verbosity >= 1:
-                print("Closing twitter feed after " + str(rowcnt[twitteridx]) + " rows.", file=sys.stderr)
+                print("Closing twitter feed after " + str(merge.rowcnt[twitteridx]) + " rows.", file=sys.stderr)
 
             # Remember last date from twitter feed so we can re-use the feed later.
-            twitterdate = currow[twitteridx]['date'].date()
-            currow[twitteridx] = None
-            rowcnt[twitteridx] = 0
-            pacing[twitteridx] = False
-            inreader[twitteridx] = None
+            twitterdate = merge.rows[twitteridx]['date'].date()
+            merge.close(twitteridx)
 
         # If no file is now pacing, try opening a new twitter feed
-        while (string or user) and not any(pacing):
+        while (string or user) and not merge.pacing:
+            headidx = merge.head
             newsince = since.date() if since else None
             if (not force) and (headidx is not None):
-                newsince = max(newsince or date.min, currow[headidx]['date'].date())
+                newsince = max(newsince or date.min, merge.rows[headidx]['date'].date())
 
             # Continue with current twitter feed if since dates match and last retrieved is same day
             # as we are looking for
@@ -379,9 +517,10 @@ def twitterScrape(string, user, language, since, until,
                     print("Opening twitter feed with until:" + twitteruntil.isoformat() + ", since:" + (twittersince.isoformat() if twittersince else ''), file=sys.stderr)
 
                 twitterfeed = TwitterFeed(language=language, user=user, query=string,
-                                        until=twitteruntil, since=twittersince)
+                                        until=twitteruntil, since=twittersince, prefetch=prefetch)
 
             if twitterfeed:
+                feedpacing = False
                 try:
                     if verbosity >= 1:
                         print("Searching twitter feed for id:" + str(lastid), file=sys.stderr)
@@ -397,7 +536,7 @@ def twitterScrape(string, user, language, since, until,
                         if currowitem['id'] == lastid:
                             currowitem = nextornone(twitterfeed)
                             if currowitem:
-                                pacing[twitteridx] = True
+                                feedpacing = True
                                 if verbosity >= 2:
                                     print("Twitter feed now pacing.", file=sys.stderr)
 
@@ -407,12 +546,9 @@ def twitterScrape(string, user, language, since, until,
                         print(err, file=sys.stderr)
 
                 if currowitem:
-                    inreader[twitteridx] = twitterfeed
-                    currow[twitteridx] = currowitem
-                    if headidx is None or currowitem['id'] > currow[headidx]['id']:
-                        headidx = twitteridx
-                        if verbosity >= 2:
-                            print("Head input is twitter feed", file=sys.stderr)
+                    merge.open(twitteridx, twitterfeed, currowitem, pacing=feedpacing)
+                    if merge.head == twitteridx and verbosity >= 2:
+                        print("Head input is twitter feed", file=sys.stderr)
 
                     break
                 else:
@@ -420,18 +556,25 @@ def twitterScrape(string, user, language, since, until,
                     if verbosity >= 1:
                         print("End of twitter feed", file=sys.stderr)
 
-        if not any(pacing):
+        if not merge.pacing:
             twitterwrite.write({})
-            if headidx is not None:
-                print("Possible missing tweets between id: " + str(lastid) + " - " + lastdatetime.isoformat() + " and " + str(currow[headidx]['id']) + " - " + currow[headidx]['date'].isoformat(), file=sys.stderr)
+            if merge.head is not None:
+                headrow = merge.rows[merge.head]
+                print("Possible missing tweets between id: " + str(lastid) + " - " + lastdatetime.isoformat() + " and " + str(headrow['id']) + " - " + headrow['date'].isoformat(), file=sys.stderr)
             else:
                 print("Possible missing tweets after id: " + str(lastid) + " - " + lastdatetime.isoformat(), file=sys.stderr)
                 break
 
     # Finish up
-    del twitterwrite
+    twitterwrite.close()
     if tempoutfile:
         shutil.move(tempoutfile, outfile)
+    if checkpointfile and os.path.isfile(checkpointfile):
+        os.remove(checkpointfile)
+    if scraping and verbosity >= 1:
+        print("Opened " + str(TwitterFeed.POOL.opened) + " connections, reused " + str(TwitterFeed.POOL.reused) + ".", file=sys.stderr)
+    if sharddir:
+        shutil.rmtree(sharddir)
 
 def main():
     kwargs = parse_arguments()
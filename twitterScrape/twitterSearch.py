@@ -25,7 +25,7 @@ import twitter
 import sys
 import os
 import shutil
-from TwitterFeed import TwitterWrite
+from TwitterFeed import TwitterWrite, TwitterCache
 import string
 from dateutil import parser as dateparser
 import calendar
@@ -78,10 +78,14 @@ def add_arguments(parser):
     advancedgroup.add_argument('-v', '--verbosity', type=int, default=1)
     advancedgroup.add_argument('-m', '--maxid',  type=str,
                                help='Maximum status id')
+    advancedgroup.add_argument('--cache',        type=str, widget='FileSaver',
+                               help='File of hydrated tweets to add the results to')
+    advancedgroup.add_argument('--cache-size',   type=int, default=1000000,
+                               help='Maximum number of tweets to keep in the cache')
 
     parser.set_defaults(func=twitterSearch)
     parser.set_defaults(build_comments=build_comments)
-    parser.set_defaults(hiddenargs=['verbosity', 'auth_file', 'consumer_key', 'consumer_secret', 'app_only_auth', 'access_token_key', 'access_token_secret', 'no_comments'])
+    parser.set_defaults(hiddenargs=['verbosity', 'auth_file', 'consumer_key', 'consumer_secret', 'app_only_auth', 'access_token_key', 'access_token_secret', 'cache', 'cache_size', 'no_comments'])
 
 @gooey.Gooey(ignore_command=None, force_command='--gui',
              default_cols=1,
@@ -117,7 +121,7 @@ def build_comments(kwargs):
 def twitterSearch(string, user, language, geo, since, until,
                   outfile, number, no_comments, no_header,
                   auth_file, consumer_key, consumer_secret, app_only_auth, access_token_key, access_token_secret,
-                  verbosity, maxid, comments, **dummy):
+                  verbosity, maxid, cache, cache_size, comments, **dummy):
 
     until = str(calendar.timegm(dateparser.parse(until).utctimetuple())) if until else None
     since = str(calendar.timegm(dateparser.parse(since).utctimetuple())) if since else None
@@ -197,6 +201,9 @@ def twitterSearch(string, user, language, geo, since, until,
 
         authfile.close()
 
+    # Search results are cached so that hydrating them later need not call Twitter again
+    cache = TwitterCache(cache, size=cache_size) if cache else None
+
     tweetcount = 0
     if maxid is None:
         maxid = None
@@ -224,6 +231,9 @@ def twitterSearch(string, user, language, geo, since, until,
         if len(tweets) == 0:
             break
 
+        if cache:
+            cache.put({tweet.id: TwitterCache.status(tweet) for tweet in tweets})
+
         for tweet in tweets:
             if tweet.retweeted_status is None:
                 twitterwrite.write({
@@ -252,7 +262,10 @@ def twitterSearch(string, user, language, geo, since, until,
 
         maxid = tweets[-1].id - 1
 
-    del twitterwrite
+    if cache:
+        cache.close()
+
+    twitterwrite.close()
 
 def main():
     kwargs = parse_arguments()
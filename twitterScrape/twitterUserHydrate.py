@@ -26,10 +26,22 @@ import os
 import shutil
 import unicodecsv
 import re
+import itertools
+from TwitterFeed import TwitterRead, TwitterExpression, TwitterApi
+from dateutil import parser as dateparser
 
 MENTIONREGEXP=re.compile(r'(@\w+)', re.UNICODE)
 HASHTAGREGEXP=re.compile(r'(#\w+)', re.UNICODE)
 
+# Output columns for hydrated users, declared so that the header does not depend on which fields the first user has
+USERFIELDS=['id', 'id_str', 'screen_name', 'name', 'description', 'location', 'url', 'lang', 'time_zone', 'utc_offset',
+            'created_at', 'followers_count', 'friends_count', 'favourites_count', 'listed_count', 'statuses_count',
+            'protected', 'verified', 'geo_enabled', 'contributors_enabled', 'is_translator', 'following', 'follow_request_sent',
+            'notifications', 'email', 'default_profile', 'default_profile_image', 'profile_background_color',
+            'profile_background_image_url', 'profile_background_tile', 'profile_user_background_image', 'profile_banner_url',
+            'profile_image_url', 'profile_link_color', 'profile_sidebar_fill_color', 'profile_text_color',
+            'withheld_in_countries', 'withheld_scope', 'status']
+
 def twitterUserHydrate(arglist):
 
     parser = argparse.ArgumentParser(description='Retrieve twitter users from ID.',
@@ -49,35 +61,57 @@ def twitterUserHydrate(arglist):
     parser.add_argument('--access-token-secret', type=str,
                         help='Access token secret for Twitter authentication')
 
+    parser.add_argument(      '--credentials', type=str, help='File of further credentials to share the work, one set per line: consumer key and secret, then access token key and secret unless for application-only authentication')
+    parser.add_argument(      '--inflight',   type=int, default=4, help='Number of lookups to run at once across all credentials')
     parser.add_argument(      '--retry',      type=int, default=5, help='Number of times to retry failed Twitter API call')
 
-    parser.add_argument('-l', '--limit',      type=int, help='Limit number of tweets to process')
+    parser.add_argument('-t', '--tweets',     action='store_true', help='Input is a tweet file, whose authors and the users they reply to or mention are hydrated')
+    parser.add_argument('-f', '--filter',     type=str, help='Python expression evaluated to determine whether tweet is included')
+    parser.add_argument(      '--since',      type=str, help='Lower bound tweet date/time in any sensible format.')
+    parser.add_argument(      '--until',      type=str, help='Upper bound tweet date/time in any sensible format.')
+    parser.add_argument('-l', '--limit',      type=int, help='Limit number of tweets or users to process')
 
     parser.add_argument('-o', '--outfile', type=str, help='Output CSV file, otherwise use stdout')
     parser.add_argument('--no-comments',   action='store_true', help='Do not output descriptive comments')
     parser.add_argument('--no-header',     action='store_true', help='Do not output CSV header with column names')
 
-    parser.add_argument('infile', type=str, nargs='?', help='Input CSV file, otherwise use stdin')
+    parser.add_argument('infile', type=str, nargs='?', help='Input CSV file of users with screen_name or id, otherwise use stdin')
 
     args = parser.parse_args(arglist)
-    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'retry', 'no_comments']
+    hiddenargs = ['verbosity', 'consumer_key', 'consumer_secret', 'application_only_auth', 'access_token_key', 'access_token_secret', 'credentials', 'inflight', 'retry', 'no_comments']
+
+    if args.tweets:
+        until = dateparser.parse(args.until) if args.until else None
+        since = dateparser.parse(args.since) if args.since else None
+
+        twitterread = TwitterRead(args.infile, since=since, until=until, limit=args.limit)
+        incomments = twitterread.comments
+        infieldnames = []
 
-    if args.infile is None:
-        infile = sys.stdin
+        if args.filter:
+            filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+            filterexpression.pushdown(twitterread)
+            evalfilter = filterexpression.evaluate
     else:
-        infile = file(args.infile, 'rU')
-
-    # Skip comments at start of infile.
-    incomments = ''
-    while True:
-        line = infile.readline()
-        if line[:1] == '#':
-            incomments += line
+        if args.filter or args.since or args.until:
+            raise RuntimeError("Filter, since and until only apply to tweet input.")
+
+        if args.infile is None:
+            infile = sys.stdin
         else:
-            infieldnames = next(unicodecsv.reader([line]))
-            break
+            infile = file(args.infile, 'rU')
+
+        # Skip comments at start of infile.
+        incomments = ''
+        while True:
+            line = infile.readline()
+            if line[:1] == '#':
+                incomments += line
+            else:
+                infieldnames = next(unicodecsv.reader([line]))
+                break
 
-    inreader=unicodecsv.DictReader(infile, fieldnames=infieldnames)
+        inreader=unicodecsv.DictReader(infile, fieldnames=infieldnames)
 
     if args.outfile is None:
         outfile = sys.stdout
@@ -120,8 +154,7 @@ def twitterUserHydrate(arglist):
         api = twitter.Api(
                     consumer_key=args.consumer_key,
                     consumer_secret=args.consumer_secret,
-                    application_only_auth=True,
-                    sleep_on_rate_limit=True
+                    application_only_auth=True
             )
     else:
         if not all([args.access_token_key, args.access_token_secret]):
@@ -151,53 +184,84 @@ def twitterUserHydrate(arglist):
                     consumer_key=args.consumer_key,
                     consumer_secret=args.consumer_secret,
                     access_token_key=args.access_token_key,
-                    access_token_secret=args.access_token_secret,
-                    sleep_on_rate_limit=True
+                    access_token_secret=args.access_token_secret
             )
 
-    if args.verbosity >= 1:
-        print("Loading users.", file=sys.stderr)
+    # Rate limits are handled by spreading lookups across the credentials rather than by sleeping
+    apis = [api] + (TwitterApi.credentials(args.credentials) if args.credentials else [])
+
+    if args.tweets:
+        if args.verbosity >= 1:
+            print("Loading tweets.", file=sys.stderr)
+
+        # Collect the users named in the tweets, as twitterUsers does
+        users = {}
+        for row in twitterread:
+            if args.filter and not evalfilter(row):
+                continue
+
+            users[row['user'].lower()] = row['user']
+            if row.get('reply-to-user'):
+                users[row['reply-to-user'].lower()] = row['reply-to-user']
+            for mention in (row.get('mentions', '') or '').split():
+                mention = mention.lstrip('@')
+                users[mention.lower()] = mention
 
-    fieldnames = None
-    while True:
         if args.verbosity >= 2:
-            print("Loading batch.", file=sys.stderr)
+            print("Loaded ", twitterread.count, " tweets, ", len(users), " users. ", file=sys.stderr)
 
-        rows = []
-        while len(rows) < 100:
-            try:
-                rows.append(next(inreader))
-            except StopIteration:
-                break
+        rows = iter([{'screen_name': users[user]} for user in sorted(users)])
+    else:
+        rows = itertools.islice(inreader, args.limit) if args.limit else inreader
 
-        if len(rows) == 0:
-            break
+    if args.verbosity >= 1:
+        print("Loading users.", file=sys.stderr)
+
+    fieldnames = infieldnames + [fieldname for fieldname in USERFIELDS if fieldname not in infieldnames]
+    outunicodecsv=unicodecsv.DictWriter(outfile, fieldnames=fieldnames, extrasaction='ignore', lineterminator=os.linesep)
+    if not args.no_header:
+        outunicodecsv.writeheader()
 
-        retry = args.retry
+    def batches():
         while True:
-            try:
-                userdata  = api.UsersLookup(screen_name=[row['screen_name'].encode('utf-8') for row in rows])
+            if args.verbosity >= 2:
+                print("Loading batch.", file=sys.stderr)
+
+            batch = list(itertools.islice(rows, 100))     # Hard code Twitter 100 batch size
+            if len(batch) == 0:
                 break
-            except twitter.error.TwitterError as error:
-                for message in error.message:
-                    if message['code'] == 88 and retry > 0:
-                        if args.verbosity >= 2:
-                            print("Retrying after twitter error: ", error, file=sys.stderr)
-                        retry -= 1
-                        break
-                else:
-                    raise
-
-        for userdatum in userdata:
-            userdict = userdatum.AsDict()
-            if not fieldnames:
-                fieldnames = infieldnames + userdict.keys() + list({'default_profile', 'default_profile_image', 'follow_request_sent', 'geo_enabled', 'is_translator', 'profile_background_tile', 'profile_user_background_image', 'protected', 'verified', 'withheld_in_countries', 'withheld_scope'} - set(infieldnames) - set(userdict.keys()))
-
-                outunicodecsv=unicodecsv.DictWriter(outfile, fieldnames=fieldnames,                                        extrasaction='ignore', lineterminator=os.linesep)
-                if not args.no_header:
-                    outunicodecsv.writeheader()
-
-            outunicodecsv.writerow(userdict)
+
+            yield batch
+
+    # Users are looked up by id where the input has one, otherwise by screen name
+    def lookup(api, batch):
+        userids = [row['id'] for row in batch if row.get('id')]
+        screennames = [row['screen_name'].lstrip('@').encode('utf-8') for row in batch if not row.get('id')]
+        try:
+            return api.UsersLookup(user_id=userids or None, screen_name=screennames or None)
+        except twitter.error.TwitterError as error:
+            # Twitter reports an error rather than an empty result when none of the users exist
+            if isinstance(error.message, list) and any(isinstance(message, dict) and message.get('code') == 17 for message in error.message):
+                return []
+            raise
+
+    usersapi = TwitterApi(apis, '/users/lookup.json', inflight=args.inflight, retry=args.retry, verbosity=args.verbosity)
+    for batch, userdata in usersapi.map(lookup, batches()):
+        byid   = {str(userdatum.id): userdatum for userdatum in userdata}
+        byname = {userdatum.screen_name.lower(): userdatum for userdatum in userdata}
+        for row in batch:
+            if row.get('id'):
+                userdatum = byid.get(str(row['id']))
+            else:
+                userdatum = byname.get(row['screen_name'].lstrip('@').lower())
+
+            if userdatum is None:
+                if args.verbosity >= 3:
+                    print("User: " + (row.get('id') or row['screen_name']) + " not retrieved.", file=sys.stderr)
+                continue
+
+            row.update(userdatum.AsDict())
+            outunicodecsv.writerow(row)
 
     outfile.close()
 
@@ -21,9 +21,8 @@ import argparse
 import sys
 import os
 import shutil
-from TwitterFeed import TwitterRead
+from TwitterFeed import TwitterRead, TwitterExpression
 import unicodecsv
-import re
 from dateutil import parser as dateparser
 import datetime
 
@@ -101,11 +100,10 @@ def twitterUsers(arglist):
 
         outfile.write(comments + twitterread.comments)
 
-    argbadchars = re.compile(r'[^0-9a-zA-Z_]')
     if args.filter:
-            exec "\
-def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in twitterread.fieldnames]) + ",**kwargs):\n\
-    return " + args.filter in locals()
+        filterexpression = TwitterExpression(args.filter, twitterread.fieldnames, globals())
+        filterexpression.pushdown(twitterread)
+        evalfilter = filterexpression.evaluate
 
     if args.verbosity >= 1:
         print("Loading tweets.", file=sys.stderr)
@@ -115,11 +113,7 @@ def evalfilter(" + ','.join([argbadchars.sub('_', fieldname) for fieldname in tw
         try:
             while True:
                 row = next(twitterread)
-                if args.filter:
-                    rowargs = {argbadchars.sub('_', key): value for key, value in row.iteritems()}
-                    if evalfilter(**rowargs):
-                        break
-                else:
+                if not args.filter or evalfilter(row):
                     break
 
             users[row['user'].lower()] = row['user']